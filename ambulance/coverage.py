@@ -0,0 +1,304 @@
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.contrib.gis.db.models import Extent
+
+from emstrack.latlon import earth_radius
+from emstrack.latlon_batch import distances_to
+
+from .models import Ambulance, AmbulanceStatus, Location, LocationType
+
+from environs import Env
+
+env = Env()
+logger = logging.getLogger(__name__)
+
+# The service region is rasterised into square cells and the distances from the center of every cell
+# to every available ambulance are kept in memory, one column per ambulance. When ambulances move,
+# only their columns are recomputed, and the distance to the nearest ambulance only where it changed.
+
+# cell side, meters
+COVERAGE_CELL_SIZE = env.float('DJANGO_COVERAGE_CELL_SIZE', default=500)
+
+# default coverage radius, meters
+COVERAGE_RADIUS = env.float('DJANGO_COVERAGE_RADIUS', default=5000)
+
+# average speed used to convert minutes into a radius, km/h
+COVERAGE_SPEED = env.float('DJANGO_COVERAGE_SPEED', default=40)
+
+# service region as min_longitude,min_latitude,max_longitude,max_latitude;
+# by default the extent of the bases and hospitals, enlarged by the coverage radius
+COVERAGE_REGION = env.list('DJANGO_COVERAGE_REGION', subcast=float, default=[])
+
+# largest grid computed
+MAXIMUM_CELLS = 250000
+
+# grids kept in memory
+MAXIMUM_GRIDS = 4
+
+METERS_PER_DEGREE = math.radians(earth_radius)
+
+
+class CoverageGrid:
+    """
+    Centers of the cells of about cell_size meters covering bbox, row by row from the south-west corner.
+    """
+
+    def __init__(self, bbox, cell_size=COVERAGE_CELL_SIZE):
+
+        (west, south, east, north) = bbox
+        if not (west < east and south < north):
+            raise ValueError('Empty region')
+
+        self.bbox = tuple(bbox)
+        self.height = cell_size / METERS_PER_DEGREE
+        self.width = self.height / max(math.cos(math.radians((south + north) / 2)), 1e-6)
+        self.columns = math.ceil((east - west) / self.width)
+        self.rows = math.ceil((north - south) / self.height)
+        if self.rows * self.columns > MAXIMUM_CELLS:
+            raise ValueError('Region has more than {} cells'.format(MAXIMUM_CELLS))
+
+        (longitude, latitude) = np.meshgrid(west + (np.arange(self.columns) + 0.5) * self.width,
+                                            south + (np.arange(self.rows) + 0.5) * self.height)
+        self.longitude = longitude.ravel()
+        self.latitude = latitude.ravel()
+
+    @property
+    def size(self):
+        return self.longitude.size
+
+
+class CoverageEngine:
+    """
+    Distances from the cells of a grid to a set of ambulances, updated incrementally as they move.
+    """
+
+    def __init__(self, grid):
+
+        self.grid = grid
+        self.lock = threading.RLock()
+
+        # ambulance id by column and column and position by ambulance id
+        self.ids = []
+        self.positions = {}
+        self.distances = np.empty((grid.size, 8), dtype=np.float32)
+
+        # distance to and column of the nearest ambulance of each cell
+        self.nearest = np.full(grid.size, np.inf, dtype=np.float32)
+        self.argnearest = np.full(grid.size, -1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _refresh(self, cells):
+        # recompute the nearest ambulance of cells from the distance matrix
+        count = len(self.ids)
+        if count == 0:
+            self.nearest[cells] = np.inf
+            self.argnearest[cells] = -1
+            return
+        distances = self.distances[cells, :count]
+        self.argnearest[cells] = np.argmin(distances, axis=1)
+        self.nearest[cells] = np.min(distances, axis=1)
+
+    def move(self, ambulance_id, longitude, latitude):
+        """
+        Add ambulance_id at longitude and latitude, or move it there.
+        """
+
+        with self.lock:
+
+            previous = self.positions.get(ambulance_id)
+            if previous is not None and previous[1:] == (longitude, latitude):
+                return False
+
+            column = distances_to(self.grid.longitude, self.grid.latitude,
+                                  longitude, latitude).astype(np.float32)
+
+            if previous is None:
+                index = len(self.ids)
+                if index == self.distances.shape[1]:
+                    self.distances = np.concatenate((self.distances, np.empty_like(self.distances)), axis=1)
+                self.ids.append(ambulance_id)
+            else:
+                index = previous[0]
+                # cells whose nearest ambulance moved away
+                farther = np.flatnonzero((self.argnearest == index) & (column > self.distances[:, index]))
+
+            self.distances[:, index] = column
+            self.positions[ambulance_id] = (index, longitude, latitude)
+
+            if previous is not None:
+                self._refresh(farther)
+
+            closer = column < self.nearest
+            self.nearest[closer] = column[closer]
+            self.argnearest[closer] = index
+
+            return True
+
+    def remove(self, ambulance_id):
+        """
+        Remove ambulance_id, if present.
+        """
+
+        with self.lock:
+
+            previous = self.positions.pop(ambulance_id, None)
+            if previous is None:
+                return False
+
+            # move the last column into the one removed
+            index = previous[0]
+            last = len(self.ids) - 1
+            stale = np.flatnonzero(self.argnearest == index)
+            if index != last:
+                last_id = self.ids[last]
+                self.ids[index] = last_id
+                self.positions[last_id] = (index, ) + self.positions[last_id][1:]
+                self.distances[:, index] = self.distances[:, last]
+                self.argnearest[self.argnearest == last] = index
+            self.ids.pop()
+
+            self._refresh(stale)
+
+            return True
+
+    def update(self, positions):
+        """
+        Make the ambulances those in positions, a dictionary of (longitude, latitude) by ambulance id.
+        Returns the number of ambulances added, moved or removed.
+        """
+
+        with self.lock:
+
+            changes = 0
+            for ambulance_id in set(self.positions) - set(positions):
+                changes += self.remove(ambulance_id)
+            for (ambulance_id, (longitude, latitude)) in positions.items():
+                changes += self.move(ambulance_id, longitude, latitude)
+
+            return changes
+
+    def nearest_distances(self, exclude=()):
+        """
+        Distance from each cell to the nearest ambulance not in exclude, infinite if there is none.
+        """
+
+        with self.lock:
+
+            excluded = {self.positions[id][0] for id in exclude if id in self.positions}
+            if not excluded:
+                return self.nearest.copy()
+
+            columns = [index for index in range(len(self.ids)) if index not in excluded]
+            if not columns:
+                return np.full(self.grid.size, np.inf, dtype=np.float32)
+            return np.min(self.distances[:, columns], axis=1)
+
+    def covered(self, radius, exclude=()):
+        """
+        Whether each cell is within radius meters of an ambulance not in exclude.
+        """
+        return self.nearest_distances(exclude) <= radius
+
+
+# engines by grid, most recently used last
+_engines = OrderedDict()
+_engines_lock = threading.Lock()
+
+
+def get_engine(bbox, cell_size=COVERAGE_CELL_SIZE):
+    """
+    The engine of the grid of bbox and cell_size, created on first use.
+    """
+
+    key = (tuple(bbox), cell_size)
+    with _engines_lock:
+        engine = _engines.pop(key, None)
+        if engine is None:
+            engine = CoverageEngine(CoverageGrid(bbox, cell_size))
+        _engines[key] = engine
+        while len(_engines) > MAXIMUM_GRIDS:
+            _engines.popitem(last=False)
+    return engine
+
+
+def get_available_positions():
+    """
+    Position of the active and available ambulances, by ambulance id.
+    """
+    return {id: location.coords
+            for (id, location) in Ambulance.objects
+                .filter(active=True, status=AmbulanceStatus.AV.name, location__isnull=False)
+                .values_list('id', 'location')}
+
+
+def get_service_region(radius=COVERAGE_RADIUS):
+    """
+    COVERAGE_REGION, or the extent of the bases and hospitals enlarged by radius meters, or None.
+    """
+
+    if COVERAGE_REGION:
+        return tuple(COVERAGE_REGION)
+
+    extent = Location.objects \
+        .filter(type__in=[LocationType.b.name, LocationType.h.name]) \
+        .aggregate(extent=Extent('location'))['extent']
+    if extent is None:
+        return None
+
+    (west, south, east, north) = extent
+    height = radius / METERS_PER_DEGREE
+    width = height / max(math.cos(math.radians(max(abs(south), abs(north)))), 1e-6)
+    return (max(west - width, -180.0), max(south - height, -90.0),
+            min(east + width, 180.0), min(north + height, 90.0))
+
+
+def minutes_to_radius(minutes, speed=COVERAGE_SPEED):
+    """
+    Meters driven in minutes at speed km/h.
+    """
+    return minutes * speed * 1000 / 60
+
+
+def get_coverage(bbox, radius, cell_size=COVERAGE_CELL_SIZE, ambulance_ids=None, exclude=()):
+    """
+    Coverage of the grid of bbox and cell_size by the available ambulances, restricted to
+    ambulance_ids if not None, with and without the ambulances in exclude.
+    The engine is brought up to date with the ambulances that moved since it was last used.
+    """
+
+    engine = get_engine(bbox, cell_size)
+    with engine.lock:
+
+        changes = engine.update(get_available_positions())
+        logger.debug('get_coverage: {} ambulances changed'.format(changes))
+
+        if ambulance_ids is None:
+            ignored = set()
+        else:
+            ignored = set(engine.ids) - set(ambulance_ids)
+        baseline = engine.covered(radius, ignored)
+        covered = engine.covered(radius, ignored | set(exclude)) if exclude else baseline
+        ambulances = [id for id in engine.ids if id not in ignored and id not in exclude]
+
+    grid = engine.grid
+    uncovered = np.flatnonzero(~covered)
+    return {
+        'bbox': grid.bbox,
+        'radius': radius,
+        'cells': grid.size,
+        'cell_width': grid.width,
+        'cell_height': grid.height,
+        'ambulances': sorted(ambulances),
+        'baseline': float(np.mean(baseline)),
+        'coverage': float(np.mean(covered)),
+        'uncovered': {
+            'longitude': grid.longitude[uncovered].tolist(),
+            'latitude': grid.latitude[uncovered].tolist()
+        }
+    }
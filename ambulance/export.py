@@ -0,0 +1,147 @@
+import csv
+import io
+import json
+import logging
+
+from django.db.models import F, FloatField, Func
+
+from .models import AmbulanceUpdate
+
+from environs import Env
+
+env = Env()
+logger = logging.getLogger(__name__)
+
+# rows fetched from the server-side cursor at a time
+EXPORT_CHUNK_SIZE = env.int('DJANGO_EXPORT_CHUNK_SIZE', default=2000)
+
+# exported columns, in order
+FIELDS = ['ambulance_id', 'ambulance_identifier', 'status', 'capability', 'orientation',
+          'longitude', 'latitude', 'timestamp', 'comment', 'updated_by_username', 'updated_on']
+
+# output formats and their content types
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'geojson': 'application/geo+json',
+}
+
+
+def get_export_rows(ambulance_ids, start, end, chunk_size=None):
+    """
+    Iterate over the updates of the ambulances in [start, end), as dictionaries of FIELDS
+    ordered by ambulance and timestamp, fetched through a server-side cursor.
+    """
+
+    updates = AmbulanceUpdate.objects \
+        .filter(ambulance_id__in=ambulance_ids, timestamp__gte=start, timestamp__lt=end) \
+        .annotate(ambulance_identifier=F('ambulance__identifier'),
+                  updated_by_username=F('updated_by__username'),
+                  longitude=Func(F('location'), function='ST_X', output_field=FloatField()),
+                  latitude=Func(F('location'), function='ST_Y', output_field=FloatField())) \
+        .order_by('ambulance_id', 'timestamp', 'id') \
+        .values(*FIELDS)
+
+    return updates.iterator(chunk_size=chunk_size or EXPORT_CHUNK_SIZE)
+
+
+def export_ndjson(rows):
+    """
+    One JSON object per line.
+    """
+    for row in rows:
+        row['timestamp'] = row['timestamp'].isoformat()
+        row['updated_on'] = row['updated_on'].isoformat()
+        yield json.dumps(row) + '\n'
+
+
+def export_csv(rows):
+    """
+    CSV with a header line.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FIELDS)
+
+    writer.writeheader()
+    for row in rows:
+        row['timestamp'] = row['timestamp'].isoformat()
+        row['updated_on'] = row['updated_on'].isoformat()
+        writer.writerow(row)
+
+        # flush the buffer one line at a time
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def export_geojson(rows):
+    """
+    FeatureCollection with one LineString per ambulance, or a Point for an ambulance with a single update.
+    Coordinates are streamed as they are read, the properties of each feature follow its geometry.
+    """
+
+    def properties(first, last, count):
+        return json.dumps({'ambulance_id': first['ambulance_id'],
+                           'ambulance_identifier': first['ambulance_identifier'],
+                           'start': first['timestamp'].isoformat(),
+                           'end': last['timestamp'].isoformat(),
+                           'count': count})
+
+    def coordinates(row):
+        return '[{}, {}]'.format(json.dumps(row['longitude']), json.dumps(row['latitude']))
+
+    def close(first, last, count):
+        if count == 1:
+            # a single update is a point
+            return '\n{"type": "Feature", "geometry": {"type": "Point", "coordinates": ' + coordinates(first) + \
+                   '}, "properties": ' + properties(first, last, count) + '}'
+        return ']}, "properties": ' + properties(first, last, count) + '}'
+
+    yield '{"type": "FeatureCollection", "features": ['
+
+    first = last = None
+    count = 0
+    for row in rows:
+
+        if first is None or row['ambulance_id'] != first['ambulance_id']:
+
+            # close the previous feature
+            if first is not None:
+                yield close(first, last, count) + ','
+
+            # the first update of a feature is held until the type of its geometry is known
+            first = row
+            count = 0
+
+        elif count == 1:
+            # open a line with the first update
+            yield '\n{"type": "Feature", "geometry": {"type": "LineString", "coordinates": [' + coordinates(first)
+
+        if count:
+            yield ', ' + coordinates(row)
+        last = row
+        count += 1
+
+    # close the last feature
+    if first is not None:
+        yield close(first, last, count)
+
+    yield ']}\n'
+
+
+def export_updates(ambulance_ids, start, end, output_format='ndjson', chunk_size=None):
+    """
+    Iterate over the updates of the ambulances in [start, end) as chunks of text in the given format.
+    Memory use does not depend on the number of updates.
+    """
+
+    if output_format == 'ndjson':
+        exporter = export_ndjson
+    elif output_format == 'csv':
+        exporter = export_csv
+    elif output_format == 'geojson':
+        exporter = export_geojson
+    else:
+        raise ValueError("Unknown export format '{}'".format(output_format))
+
+    return exporter(get_export_rows(ambulance_ids, start, end, chunk_size))
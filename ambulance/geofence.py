@@ -0,0 +1,298 @@
+import logging
+import math
+import threading
+from collections import namedtuple
+from functools import partial
+
+from django.db import transaction
+
+from emstrack.latlon import earth_radius
+from emstrack.util import is_on_commit_pending
+
+from .models import AmbulanceCall, AmbulanceCallStatus, AmbulanceStatus, Location, LocationType, Waypoint, \
+    WaypointStatus
+from .serializers import AmbulanceSerializer, WaypointSerializer
+
+from environs import Env
+
+env = Env()
+logger = logging.getLogger(__name__)
+
+# Ambulance positions are matched against bases, hospitals and the locations of active waypoints
+# held in memory, in a grid of cells about as large as a geofence, so that evaluating a position
+# is one dictionary lookup and a few distances, without queries.
+
+# evaluate positions received by mqttclient
+GEOFENCE_ENABLED = env.bool('DJANGO_GEOFENCE_ENABLED', default=True)
+
+# geofence radius, meters
+GEOFENCE_RADIUS = env.float('DJANGO_GEOFENCE_RADIUS', default=100)
+
+# ambulances leave a geofence only when farther than this times its radius, to absorb gps jitter
+GEOFENCE_HYSTERESIS = env.float('DJANGO_GEOFENCE_HYSTERESIS', default=1.5)
+
+# set 'At hospital', 'At base', 'At incident' or 'At waypoint' when a bound ambulance arrives
+GEOFENCE_STATUS = env.bool('DJANGO_GEOFENCE_STATUS', default=False)
+
+# set waypoints to 'Visiting' on arrival and to 'Visited' on departure
+GEOFENCE_WAYPOINTS = env.bool('DJANGO_GEOFENCE_WAYPOINTS', default=False)
+
+ARRIVAL = 'arrival'
+DEPARTURE = 'departure'
+
+# status transitions on arrival by location type, from bound to at
+ARRIVAL_STATUS = {
+    LocationType.h.name: (AmbulanceStatus.HB.name, AmbulanceStatus.AH.name),
+    LocationType.b.name: (AmbulanceStatus.BB.name, AmbulanceStatus.AB.name),
+    LocationType.i.name: (AmbulanceStatus.PB.name, AmbulanceStatus.AP.name),
+    LocationType.w.name: (AmbulanceStatus.WB.name, AmbulanceStatus.AW.name),
+}
+
+METERS_PER_DEGREE = math.radians(earth_radius)
+
+# locations with fences of their own
+FENCE_LOCATION_TYPES = (LocationType.b.name, LocationType.h.name)
+
+# waypoints with fences, if their call is accepted
+FENCE_WAYPOINT_STATUSES = (WaypointStatus.C.name, WaypointStatus.V.name)
+
+# whether a reload has been requested on the current thread
+_pending = threading.local()
+
+
+class Fence(namedtuple('Fence', ['location_id', 'type', 'longitude', 'latitude', 'radius',
+                                 'ambulance_id', 'waypoint_id'])):
+    """
+    A circle around a location; waypoint fences only apply to the ambulance of their call.
+    """
+
+    def distance(self, longitude, latitude):
+        # equirectangular approximation, accurate at geofence scales
+        x = (longitude - self.longitude) * math.cos(math.radians(self.latitude))
+        y = latitude - self.latitude
+        return METERS_PER_DEGREE * math.sqrt(x * x + y * y)
+
+
+class GeofenceIndex:
+    """
+    Fences in a grid of cells, and the fences each ambulance is currently in.
+    """
+
+    def __init__(self, fences=(), cell_size=None):
+
+        fences = list(fences)
+        if cell_size is None:
+            radius = max((fence.radius for fence in fences), default=GEOFENCE_RADIUS)
+            cell_size = radius * GEOFENCE_HYSTERESIS / METERS_PER_DEGREE
+        self.cell_size = cell_size
+
+        self.fences = set()
+        self.grid = {}
+        for fence in fences:
+            self.add(fence)
+
+        # fences by ambulance id
+        self.inside = {}
+
+    def cell(self, longitude, latitude):
+        return int(math.floor(longitude / self.cell_size)), int(math.floor(latitude / self.cell_size))
+
+    def add(self, fence):
+        """
+        Add fence to every cell its departure circle overlaps.
+        """
+
+        radius = fence.radius * GEOFENCE_HYSTERESIS / METERS_PER_DEGREE
+        cos_latitude = max(math.cos(math.radians(fence.latitude)), 1e-6)
+        (x0, y0) = self.cell(fence.longitude - radius / cos_latitude, fence.latitude - radius)
+        (x1, y1) = self.cell(fence.longitude + radius / cos_latitude, fence.latitude + radius)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                self.grid.setdefault((x, y), []).append(fence)
+        self.fences.add(fence)
+
+    def replace(self, fences):
+        """
+        Replace the fences, keeping the state of ambulances in fences that did not change.
+        """
+
+        index = GeofenceIndex(fences)
+        (self.cell_size, self.grid, self.fences) = (index.cell_size, index.grid, index.fences)
+
+        # removed fences are forgotten without departures
+        self.inside = {ambulance_id: inside & self.fences
+                       for (ambulance_id, inside) in self.inside.items()
+                       if inside & self.fences}
+
+    def locate(self, ambulance_id, longitude, latitude):
+        """
+        Move ambulance_id to longitude and latitude. Returns a list of (event, fence),
+        arrivals before departures.
+        """
+
+        inside = self.inside.get(ambulance_id, frozenset())
+
+        current = set()
+        for fence in self.grid.get(self.cell(longitude, latitude), ()):
+            if fence.ambulance_id is not None and fence.ambulance_id != ambulance_id:
+                continue
+            distance = fence.distance(longitude, latitude)
+            if distance <= fence.radius or (fence in inside and distance <= fence.radius * GEOFENCE_HYSTERESIS):
+                current.add(fence)
+
+        if current == inside:
+            return []
+
+        if current:
+            self.inside[ambulance_id] = current
+        else:
+            self.inside.pop(ambulance_id, None)
+
+        return [(ARRIVAL, fence) for fence in current - inside] + \
+               [(DEPARTURE, fence) for fence in inside - current]
+
+    def reload(self):
+        self.replace(get_fences())
+        logger.info('Geofence index reloaded with {} fences'.format(len(self.fences)))
+
+
+def get_fences(radius=None):
+    """
+    Fences around bases, active hospitals and the locations of the active waypoints of accepted calls.
+    """
+    radius = radius or GEOFENCE_RADIUS
+
+    fences = []
+    locations = Location.objects \
+        .filter(type__in=FENCE_LOCATION_TYPES) \
+        .exclude(hospital__active=False) \
+        .only('id', 'type', 'location')
+    for location in locations:
+        if location.location is not None:
+            fences.append(Fence(location.id, location.type, location.location.x, location.location.y,
+                                radius, None, None))
+
+    waypoints = Waypoint.objects \
+        .filter(status__in=FENCE_WAYPOINT_STATUSES,
+                ambulance_call__status=AmbulanceCallStatus.A.name,
+                location__isnull=False) \
+        .select_related('location', 'ambulance_call')
+    for waypoint in waypoints:
+        location = waypoint.location
+        if location.location is not None:
+            fences.append(Fence(location.id, location.type, location.location.x, location.location.y,
+                                radius, waypoint.ambulance_call.ambulance_id, waypoint.id))
+
+    return fences
+
+
+def apply_geofence_event(event, fence, ambulance, user):
+    """
+    Carry out the status and waypoint transitions enabled for event on ambulance, on behalf of user.
+    """
+    logger.info("Ambulance '{}' {} at location {}, waypoint {}".format(ambulance.identifier, event,
+                                                                       fence.location_id, fence.waypoint_id))
+
+    if GEOFENCE_STATUS and event == ARRIVAL and fence.type in ARRIVAL_STATUS:
+        (bound, at) = ARRIVAL_STATUS[fence.type]
+        if ambulance.status == bound:
+            serializer = AmbulanceSerializer(ambulance, data={'status': at}, partial=True)
+            serializer.is_valid(raise_exception=True)
+            serializer.save(updated_by=user)
+
+    if GEOFENCE_WAYPOINTS and fence.waypoint_id is not None:
+        if event == ARRIVAL:
+            (current, status) = (WaypointStatus.C.name, WaypointStatus.V.name)
+        else:
+            (current, status) = (WaypointStatus.V.name, WaypointStatus.D.name)
+        waypoint = Waypoint.objects.filter(id=fence.waypoint_id, status=current).first()
+        if waypoint is not None:
+            serializer = WaypointSerializer(waypoint, data={'status': status}, partial=True)
+            serializer.is_valid(raise_exception=True)
+            serializer.save(updated_by=user, publish=True)
+
+
+def get_fence_state(instance):
+    """
+    Values of a location, hospital, waypoint or ambulance call that its fences depend on.
+    Deferred fields are not loaded, so they read as None.
+    """
+    values = instance.__dict__
+    if isinstance(instance, Location):
+        location = values.get('location')
+        return values.get('type'), getattr(location, 'coords', location), values.get('active')
+    if isinstance(instance, Waypoint):
+        return values.get('status') in FENCE_WAYPOINT_STATUSES, values.get('location_id'), \
+            values.get('ambulance_call_id')
+    return values.get('status') == AmbulanceCallStatus.A.name, values.get('ambulance_id')
+
+
+def changes_fences(instance, previous, deleted=False):
+    """
+    Whether saving or deleting instance changes the fences, given its state when loaded, None if new.
+    """
+
+    current = None if deleted else get_fence_state(instance)
+    if current == previous:
+        return False
+    states = [state for state in (previous, current) if state is not None]
+
+    if isinstance(instance, Location):
+        if any(type in FENCE_LOCATION_TYPES for (type, _, _) in states):
+            return True
+        # other locations only have fences as locations of active waypoints, which are deleted with them
+        return previous is not None and not deleted and \
+            Waypoint.objects.filter(location=instance, status__in=FENCE_WAYPOINT_STATUSES,
+                                    ambulance_call__status=AmbulanceCallStatus.A.name).exists()
+
+    if isinstance(instance, Waypoint):
+        calls = [ambulance_call_id for (active, location_id, ambulance_call_id) in states
+                 if active and location_id is not None]
+        return bool(calls) and \
+            AmbulanceCall.objects.filter(id__in=calls, status=AmbulanceCallStatus.A.name).exists()
+
+    # ambulance calls
+    return any(accepted for (accepted, _) in states) and \
+        Waypoint.objects.filter(ambulance_call=instance, status__in=FENCE_WAYPOINT_STATUSES,
+                                location__isnull=False).exists()
+
+
+def geofence_changed(instance, created=False, deleted=False):
+    """
+    Reload the geofence index if saving or deleting instance changes the fences,
+    and remember the state of instance for its next save.
+    """
+
+    previous = None if created else getattr(instance, '_fence_state', None)
+    if changes_fences(instance, previous, deleted):
+        geofence_reload()
+    instance._fence_state = get_fence_state(instance)
+
+
+def geofence_reload_flush():
+
+    # retrieve and reset pending reload
+    pending = getattr(_pending, 'reload', False)
+    _pending.reload = False
+    if not pending:
+        # already flushed
+        return
+
+    if env.bool("DJANGO_ENABLE_MQTT_PUBLISH", default=True):
+        # signal mqttclient through mqtt
+        from mqtt.publish import SingletonPublishClient
+        SingletonPublishClient().publish_message({'geofence': 'reload'})
+
+
+def geofence_reload():
+    """
+    Ask mqttclient to reload its geofence index once, when the current transaction commits.
+    """
+
+    if not getattr(_pending, 'reload', False) or not is_on_commit_pending(_pending.flush):
+        # nothing pending, or left over from a transaction that rolled back
+        _pending.flush = partial(geofence_reload_flush)
+    _pending.reload = True
+
+    # only the first callback to run finds a pending reload to flush
+    transaction.on_commit(_pending.flush)
@@ -0,0 +1,152 @@
+import logging
+from datetime import timedelta, timezone as dt_timezone
+
+from django.db.models import Count, F, FloatField, Func, Max
+from django.db.models.functions import Floor, TruncDate
+
+from .mileage import day_start
+from .models import AmbulanceUpdate, HeatmapDay, HeatmapLayer, LocationType, Waypoint
+
+logger = logging.getLogger(__name__)
+
+# Points are binned into square cells of 360 / 2 ** level degrees, numbered from longitude -180
+# and latitude -90, so that the cells of a level do not depend on the range or the region requested
+
+MINIMUM_LEVEL = 2
+MAXIMUM_LEVEL = 20
+
+
+def cell_size(level):
+    return 360.0 / 2 ** level
+
+
+def get_points(layer, start, end, ambulance_ids=None):
+    """
+    Points of layer in [start, end): a queryset and the names of its location and timestamp fields.
+    Ambulance positions are updates; incidents are the incident waypoints of calls, by call creation.
+    If ambulance_ids is not None, only the points of those ambulances are included.
+    """
+
+    if layer == HeatmapLayer.p.name:
+        points = AmbulanceUpdate.objects.filter(timestamp__gte=start, timestamp__lt=end)
+        if ambulance_ids is not None:
+            points = points.filter(ambulance_id__in=ambulance_ids)
+        return points, 'location', 'timestamp'
+
+    elif layer == HeatmapLayer.i.name:
+        points = Waypoint.objects.filter(location__type=LocationType.i.name,
+                                         ambulance_call__call__created_at__gte=start,
+                                         ambulance_call__call__created_at__lt=end)
+        if ambulance_ids is not None:
+            points = points.filter(ambulance_call__ambulance_id__in=ambulance_ids)
+        return points, 'location__location', 'ambulance_call__call__created_at'
+
+    raise ValueError("Unknown heatmap layer '{}'".format(layer))
+
+
+def compute_cells(layer, start, end, level, ambulance_ids=None):
+    """
+    Number of points of layer in [start, end) by cell (x, y), grouped in the database,
+    restricted to the ambulances in ambulance_ids if not None.
+    Incidents are counted once per call, even when the call has several ambulances.
+    """
+
+    (points, location, timestamp) = get_points(layer, start, end, ambulance_ids)
+    size = cell_size(level)
+    longitude = Func(F(location), function='ST_X', output_field=FloatField())
+    latitude = Func(F(location), function='ST_Y', output_field=FloatField())
+    count = Count('ambulance_call__call', distinct=True) if layer == HeatmapLayer.i.name else Count('id')
+
+    cells = points \
+        .annotate(x=Floor((longitude + 180.0) / size), y=Floor((latitude + 90.0) / size)) \
+        .values('x', 'y') \
+        .annotate(count=count) \
+        .order_by() \
+        .values_list('x', 'y', 'count')
+
+    return {(int(x), int(y)): count for (x, y, count) in cells}
+
+
+def merge_cells(cells, other):
+    """
+    Accumulate other into cells, in place.
+    """
+    for (cell, count) in other.items():
+        cells[cell] = cells.get(cell, 0) + count
+    return cells
+
+
+def get_day_cells(layer, level, first_day, last_day):
+    """
+    Number of points of layer by cell in the days in [first_day, last_day), from the cache
+    when the points of the day have not changed since they were binned.
+    """
+
+    (points, location, timestamp) = get_points(layer, day_start(first_day), day_start(last_day))
+
+    # number, last id and last update of the points of each day
+    fingerprints = points \
+        .annotate(date=TruncDate(timestamp)) \
+        .values('date') \
+        .annotate(count=Count('id'), last_id=Max('id'), last_updated=Max('updated_on')) \
+        .order_by()
+
+    cache = {day.date: day
+             for day in HeatmapDay.objects.filter(layer=layer, level=level, date__gte=first_day, date__lt=last_day)}
+
+    cells = {}
+    hits = 0
+    for fingerprint in fingerprints:
+
+        day = cache.get(fingerprint['date'])
+        if day is not None and day.count == fingerprint['count'] and day.last_id == fingerprint['last_id'] \
+                and day.last_updated == fingerprint['last_updated']:
+            hits += 1
+            day_cells = {(x, y): count for (x, y, count) in day.cells}
+        else:
+            # compute and cache
+            start = day_start(fingerprint['date'])
+            day_cells = compute_cells(layer, start, start + timedelta(days=1), level)
+            HeatmapDay.objects.update_or_create(
+                layer=layer, level=level, date=fingerprint['date'],
+                defaults={'count': fingerprint['count'], 'last_id': fingerprint['last_id'],
+                          'last_updated': fingerprint['last_updated'],
+                          'cells': [[x, y, count] for ((x, y), count) in day_cells.items()]})
+
+        merge_cells(cells, day_cells)
+
+    logger.debug('get_day_cells: {} cached days used'.format(hits))
+
+    return cells
+
+
+def get_heatmap(layer, start, end, level, ambulance_ids=None):
+    """
+    Number of points of layer in [start, end) by cell (x, y) of the given level.
+    Whole days are binned once and cached; the partial days at the ends of the range are binned each time.
+    The cache covers the whole fleet: points restricted to the ambulances in ambulance_ids, if not None,
+    are binned each time.
+    """
+
+    start = start.astimezone(dt_timezone.utc)
+    end = end.astimezone(dt_timezone.utc)
+
+    if ambulance_ids is not None:
+        return compute_cells(layer, start, end, level, ambulance_ids)
+
+    # whole days in the range
+    first_day = (start - timedelta(microseconds=1)).date() + timedelta(days=1)
+    last_day = end.date()
+
+    if first_day >= last_day:
+        # no whole day
+        return compute_cells(layer, start, end, level)
+
+    cells = get_day_cells(layer, level, first_day, last_day)
+
+    # partial days at the ends of the range
+    for (partial_start, partial_end) in ((start, day_start(first_day)), (day_start(last_day), end)):
+        if partial_start < partial_end:
+            merge_cells(cells, compute_cells(layer, partial_start, partial_end, level))
+
+    return cells
@@ -0,0 +1,142 @@
+import logging
+import math
+
+from django.contrib.gis.geos import Point
+from django.db import connection, transaction
+
+from emstrack.latlon import calculate_distance, earth_radius
+from emstrack.models import defaults
+
+from .models import Location, LocationType, Waypoint
+
+from environs import Env
+
+env = Env()
+logger = logging.getLogger(__name__)
+
+# Incident and waypoint locations closer than this to an existing location of the same type
+# reuse it instead of creating a new one, meters; 0 disables
+LOCATION_MERGE_RADIUS = env.float('DJANGO_LOCATION_MERGE_RADIUS', default=10)
+
+# types of locations created on the fly by calls and waypoints
+MERGE_TYPES = (LocationType.i.name, LocationType.w.name)
+
+# locations are only merged when these are the same
+MATCH_FIELDS = ('type', 'name', 'number', 'street', 'unit', 'neighborhood', 'city', 'state', 'zipcode', 'country')
+
+METERS_PER_DEGREE = math.radians(earth_radius)
+
+# Pairs of matching locations within radius, the older first, in one indexed self-join;
+# locations at the default point have no coordinates of their own and are never paired
+DUPLICATES_SQL = """
+SELECT a.id, b.id
+FROM {table} AS a
+JOIN {table} AS b
+    ON {match} AND b.id > a.id AND ST_DWithin(a.location, b.location, %(degrees)s)
+WHERE a.type = ANY(%(types)s)
+    AND ST_DistanceSphere(a.location, b.location) <= %(radius)s
+    AND NOT ST_Equals(a.location, ST_GeomFromText(%(default)s, 4326))
+    AND NOT ST_Equals(b.location, ST_GeomFromText(%(default)s, 4326))
+ORDER BY a.id, b.id
+"""
+
+
+def radius_degrees(radius, latitude=0.0):
+    """
+    Degrees that span at least radius meters in any direction at latitude.
+    """
+    return radius / (METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6))
+
+
+def find_location(location, radius=None):
+    """
+    The location closest to the unsaved location with the same MATCH_FIELDS, if within radius meters, or None.
+    """
+
+    radius = LOCATION_MERGE_RADIUS if radius is None else radius
+    point = location.location
+    if radius <= 0 or point is None or point.equals(defaults['location']):
+        return None
+
+    candidates = Location.objects \
+        .filter(location__dwithin=(point, radius_degrees(radius, point.y)),
+                **{field: getattr(location, field) for field in MATCH_FIELDS})
+
+    # closest, then oldest
+    distances = [(calculate_distance(location.location, point), location.id, location) for location in candidates]
+    distances = [item for item in distances if item[0] <= radius]
+    if not distances:
+        return None
+    return min(distances, key=lambda item: item[:2])[2]
+
+
+def get_or_create_location(location, user, radius=None):
+    """
+    Reuse an incident or waypoint location with the same address within radius meters
+    of the validated location data, or create one. Locations without coordinates are always created.
+    """
+
+    new = Location(**location, updated_by=user)
+    if new.type in MERGE_TYPES and isinstance(location.get('location'), Point):
+        existing = find_location(new, radius)
+        if existing is not None:
+            logger.debug("Reusing location '{}'".format(existing.id))
+            return existing
+
+    new.save()
+    return new
+
+
+def find_duplicates(types=MERGE_TYPES, radius=None):
+    """
+    Map of duplicate location ids to the id of the location they duplicate, of the given types.
+    Each location is merged into the oldest location within radius that is not itself a duplicate.
+    """
+
+    radius = LOCATION_MERGE_RADIUS if radius is None else radius
+    if radius <= 0:
+        return {}
+
+    # the widest span of radius in the table, at the highest latitude
+    with connection.cursor() as cursor:
+        table = connection.ops.quote_name(Location._meta.db_table)
+        cursor.execute('SELECT max(abs(ST_Y(location))) FROM {}'.format(table))
+        (latitude, ) = cursor.fetchone()
+        match = ' AND '.join('b.{0} = a.{0}'.format(connection.ops.quote_name(field)) for field in MATCH_FIELDS)
+        cursor.execute(DUPLICATES_SQL.format(table=table, match=match),
+                       {'degrees': radius_degrees(radius, latitude or 0.0), 'types': list(types),
+                        'radius': radius, 'default': defaults['location'].wkt})
+        pairs = cursor.fetchall()
+
+    duplicates = {}
+    for (original, duplicate) in pairs:
+        if original in duplicates or duplicate in duplicates:
+            continue
+        duplicates[duplicate] = original
+
+    return duplicates
+
+
+@transaction.atomic
+def merge_locations(types=MERGE_TYPES, radius=None):
+    """
+    Merge duplicate locations of the given types: waypoints are repointed to the original location
+    and duplicates deleted. Returns the numbers of locations merged and of waypoints repointed.
+    """
+
+    duplicates = find_duplicates(types, radius)
+    if not duplicates:
+        return 0, 0
+
+    # one update per original location
+    originals = {}
+    for (duplicate, original) in duplicates.items():
+        originals.setdefault(original, []).append(duplicate)
+
+    waypoints = 0
+    for (original, merged) in originals.items():
+        waypoints += Waypoint.objects.filter(location_id__in=merged).update(location_id=original)
+
+    Location.objects.filter(id__in=list(duplicates)).delete()
+
+    return len(duplicates), waypoints
@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ambulance.models import Ambulance
+from ambulance.export import export_updates, FORMATS
+
+
+class Command(BaseCommand):
+    help = 'Export ambulance updates as NDJSON, CSV or GeoJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ambulance', nargs='+', type=int, default=None,
+                            help='ids of the ambulances to export, all if omitted')
+        parser.add_argument('--start', default=None,
+                            help='start of the range to export, by default one day before end')
+        parser.add_argument('--end', default=None,
+                            help='end of the range to export, by default now')
+        parser.add_argument('--format', dest='output_format', choices=sorted(FORMATS), default='ndjson')
+        parser.add_argument('--output', default=None,
+                            help='file to write to, standard output if omitted')
+        parser.add_argument('--chunk', type=int, default=None,
+                            help='rows fetched from the database at a time')
+
+    @staticmethod
+    def parse(value):
+        if value is None:
+            return None
+        timestamp = parse_datetime(value)
+        if timestamp is None:
+            raise CommandError("Invalid timestamp '{}'".format(value))
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        return timestamp
+
+    def handle(self, *args, **options):
+
+        verbosity = options['verbosity']
+        end = self.parse(options['end']) or timezone.now()
+        start = self.parse(options['start']) or end - timedelta(days=1)
+
+        ambulances = Ambulance.objects.all()
+        if options['ambulance'] is not None:
+            ambulances = ambulances.filter(id__in=options['ambulance'])
+
+        rows = export_updates(ambulances.values('id'), start, end, options['output_format'], options['chunk'])
+
+        size = 0
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                for text in rows:
+                    file.write(text)
+                    size += len(text)
+        else:
+            for text in rows:
+                self.stdout.write(text, ending='')
+
+        if verbosity > 0 and options['output']:
+            self.stdout.write(self.style.SUCCESS(">> Exported {} characters to '{}'".format(size,
+                                                                                        options['output'])))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from ambulance.locations import LOCATION_MERGE_RADIUS, MERGE_TYPES, find_duplicates, merge_locations
+
+
+class Command(BaseCommand):
+    help = 'Merge incident and waypoint locations that duplicate an older location close by'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--radius', type=float, default=LOCATION_MERGE_RADIUS,
+                            help='largest distance between duplicates, meters')
+        parser.add_argument('--type', nargs='+', choices=MERGE_TYPES, default=list(MERGE_TYPES),
+                            dest='types',
+                            help='types of the locations to merge')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='report duplicates without merging')
+
+    def handle(self, *args, **options):
+
+        verbosity = options['verbosity']
+
+        if options['dry_run']:
+
+            duplicates = find_duplicates(options['types'], options['radius'])
+            if verbosity > 0:
+                self.stdout.write(self.style.SUCCESS(">> Found {} duplicate locations".format(len(duplicates))))
+                if verbosity > 1:
+                    for (duplicate, original) in sorted(duplicates.items()):
+                        self.stdout.write("   {} -> {}".format(duplicate, original))
+            return
+
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(">> Merging locations"))
+
+        (locations, waypoints) = merge_locations(options['types'], options['radius'])
+
+        if verbosity > 0:
+            self.stdout.write("   {} locations merged, {} waypoints repointed".format(locations, waypoints))
+            self.stdout.write(self.style.SUCCESS("<< Done"))
@@ -0,0 +1,98 @@
+import time
+
+import numpy as np
+from django.contrib.auth.models import User, Group
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+
+from ambulance.models import Ambulance, AmbulanceCapability, AmbulanceStatus
+from ambulance.nearest import get_nearest_ambulances
+from ambulance.viewsets import AmbulanceViewSet
+from equipment.models import EquipmentHolder
+from login.models import GroupAmbulancePermission
+
+
+class Command(BaseCommand):
+    help = 'Measure the latency of nearest ambulance queries on a synthetic fleet; nothing is kept'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ambulances', type=int, default=10000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--k', type=int, default=5)
+        parser.add_argument('--radius', type=float, default=0.5,
+                            help='degrees around the center where ambulances and incidents are placed')
+        parser.add_argument('--center', type=float, nargs=2, default=[-117.1, 32.7],
+                            metavar=('LONGITUDE', 'LATITUDE'))
+
+    def handle(self, *args, **options):
+
+        verbosity = options['verbosity']
+        (longitude, latitude) = options['center']
+        radius = options['radius']
+        n = options['ambulances']
+        rng = np.random.RandomState(0)
+
+        superuser = User.objects.filter(is_superuser=True).first()
+        if superuser is None:
+            raise CommandError('A superuser is needed to own the synthetic ambulances')
+
+        statuses = [AmbulanceStatus.AV.name, AmbulanceStatus.PB.name, AmbulanceStatus.AH.name]
+        capabilities = [AmbulanceCapability.B.name, AmbulanceCapability.A.name]
+
+        with transaction.atomic():
+
+            if verbosity > 0:
+                self.stdout.write(self.style.SUCCESS(">> Creating {} ambulances".format(n)))
+
+            holders = EquipmentHolder.objects.bulk_create([EquipmentHolder() for _ in range(n)])
+            ambulances = Ambulance.objects.bulk_create([
+                Ambulance(identifier='benchmark-{}'.format(i), equipmentholder=holder,
+                          capability=capabilities[i % len(capabilities)], status=statuses[i % len(statuses)],
+                          location=Point(longitude + rng.uniform(-radius, radius),
+                                         latitude + rng.uniform(-radius, radius), srid=4326),
+                          updated_by=superuser)
+                for (i, holder) in enumerate(holders)], batch_size=1000)
+
+            # a dispatcher who can read every other ambulance through a group, as served by the api
+            dispatcher = User.objects.create(username='benchmark-dispatcher')
+            dispatcher.userprofile.is_dispatcher = True
+            dispatcher.userprofile.save()
+            group = Group.objects.create(name='benchmark-dispatchers')
+            dispatcher.groups.add(group)
+            GroupAmbulancePermission.objects.bulk_create([
+                GroupAmbulancePermission(group=group, ambulance=ambulance, can_read=True, can_write=False)
+                for ambulance in ambulances[::2]], batch_size=1000)
+
+            for table in (Ambulance._meta.db_table, GroupAmbulancePermission._meta.db_table):
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE {}'.format(connection.ops.quote_name(table)))
+
+            for user in (superuser, dispatcher):
+
+                # the queryset of the nearest action
+                viewset = AmbulanceViewSet()
+                viewset.request = RequestFactory().get('/')
+                viewset.request.user = user
+
+                # time queries at random incidents
+                times = []
+                for _ in range(options['queries']):
+                    (x, y) = (longitude + rng.uniform(-radius, radius), latitude + rng.uniform(-radius, radius))
+                    start = time.perf_counter()
+                    get_nearest_ambulances(viewset.get_queryset(), x, y, options['k'],
+                                           capability=[AmbulanceCapability.A.name])
+                    times.append(time.perf_counter() - start)
+
+                times = 1000 * np.array(times)
+                self.stdout.write('{} ambulances, {} queries, k={}, {}: '
+                                  'median {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms'.format(
+                                      n, len(times), options['k'], 'dispatcher' if user == dispatcher else 'superuser',
+                                      np.median(times), np.percentile(times, 95), times.max()))
+
+            # discard the synthetic fleet
+            transaction.set_rollback(True)
+
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS("<< Done"))
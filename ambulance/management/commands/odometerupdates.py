@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ambulance.models import Ambulance
+from ambulance.odometer import update_odometers
+
+
+class Command(BaseCommand):
+    help = 'Compute the odometers of ambulance updates, e.g. to backfill existing history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ambulance', nargs='+', type=int, default=None,
+                            help='ids of the ambulances to process, all if omitted')
+        parser.add_argument('--start', default=None,
+                            help='recompute from this timestamp on, from the first update if omitted')
+
+    def handle(self, *args, **options):
+
+        verbosity = options['verbosity']
+        start = options['start']
+        if start is not None:
+            start = parse_datetime(start)
+            if start is None:
+                raise CommandError("Invalid timestamp '{}'".format(options['start']))
+            if timezone.is_naive(start):
+                start = timezone.make_aware(start)
+
+        ambulances = Ambulance.objects.all()
+        if options['ambulance'] is not None:
+            ambulances = ambulances.filter(id__in=options['ambulance'])
+
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(">> Computing odometers"))
+
+        for ambulance in ambulances.order_by('id'):
+            count = update_odometers(ambulance.id, start)
+            if verbosity > 0:
+                self.stdout.write("   {}: {} updates".format(ambulance.identifier, count))
+
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS("<< Done"))
@@ -0,0 +1,237 @@
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ambulance.models import AmbulanceUpdate
+
+
+def month_start(date, months=0):
+    """
+    First instant of the month of date, shifted by months, in UTC.
+    """
+    index = date.year * 12 + date.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+class Command(BaseCommand):
+    help = 'Manage monthly partitions of the ambulance update history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--setup', action='store_true',
+                            help='convert the ambulance update table into a partitioned table, if not already')
+        parser.add_argument('--ahead', type=int, default=3,
+                            help='number of future monthly partitions to create')
+        parser.add_argument('--retention', type=int, default=None,
+                            help='detach partitions older than this number of months')
+        parser.add_argument('--archive-schema', default='archive',
+                            help='schema detached partitions are moved to')
+        parser.add_argument('--drop', action='store_true',
+                            help='drop detached partitions instead of archiving them')
+        parser.add_argument('--brin', action='store_true',
+                            help='add BRIN indexes on timestamp to partitions that are no longer written')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.table = AmbulanceUpdate._meta.db_table
+        self.quote = connection.ops.quote_name
+
+    def execute_sql(self, sql, params=None):
+        if self.verbosity > 1:
+            self.stdout.write('   {}'.format(sql))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if cursor.description is None:
+                return None
+            return cursor.fetchall()
+
+    def is_partitioned(self):
+        rows = self.execute_sql("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [self.table])
+        return bool(rows) and rows[0][0] == 'p'
+
+    def get_partitions(self):
+        """
+        Return a list of (name, upper bound) of the partitions, the upper bound is None for the default partition.
+        """
+
+        rows = self.execute_sql("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+                                "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                                "WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname", [self.table])
+        partitions = []
+        for (name, bound) in rows:
+            match = re.search(r"TO \('([^']+)'\)", bound)
+            if match is None:
+                partitions.append((name, None))
+            else:
+                # e.g. '2026-01-01 00:00:00+00'
+                upper = match.group(1)
+                if re.search(r'[+-]\d\d$', upper):
+                    upper += ':00'
+                partitions.append((name, parse_datetime(upper)))
+        return partitions
+
+    @transaction.atomic
+    def setup(self):
+        """
+        Convert the table into a table partitioned by month on timestamp.
+        The existing table is kept as the partition for everything up to the end of the current month.
+        """
+
+        quote = self.quote
+        table = self.table
+        legacy = table + '_legacy'
+        bound = month_start(timezone.now(), 1)
+
+        if self.verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(">> Partitioning '{}'".format(table)))
+
+        # rename table and its indexes
+        self.execute_sql('ALTER TABLE {} RENAME TO {}'.format(quote(table), quote(legacy)))
+        indexes = self.execute_sql("SELECT indexname, indexdef FROM pg_indexes "
+                                   "WHERE schemaname = current_schema() AND tablename = %s", [legacy])
+        constraints = self.execute_sql("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                                       "WHERE conrelid = to_regclass(%s) AND contype = 'f'", [legacy])
+        for (name, definition) in indexes:
+            self.execute_sql('ALTER INDEX {} RENAME TO {}'.format(quote(name), quote(name[:50] + '_legacy')))
+
+        # ids must come from a sequence shared by all partitions:
+        # replace an identity column by a plain sequence
+        (sequence, identity) = self.execute_sql("SELECT pg_get_serial_sequence(%s, 'id'), attidentity "
+                                                "FROM pg_attribute WHERE attrelid = to_regclass(%s) "
+                                                "AND attname = 'id'", [legacy, legacy])[0]
+        if identity:
+            sequence = quote(table + '_id_seq')
+            self.execute_sql('ALTER TABLE {} ALTER COLUMN "id" DROP IDENTITY'.format(quote(legacy)))
+            self.execute_sql('CREATE SEQUENCE {}'.format(sequence))
+            self.execute_sql("SELECT setval(%s, (SELECT COALESCE(MAX(id), 0) + 1 FROM {}), false)".format(
+                quote(legacy)), [sequence])
+            self.execute_sql("ALTER TABLE {} ALTER COLUMN \"id\" SET DEFAULT nextval(%s::regclass)".format(
+                quote(legacy)), [sequence])
+
+        # create partitioned table with the same columns, indexes and foreign keys;
+        # the primary key of a partitioned table must include the partition key
+        self.execute_sql('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+                         'PARTITION BY RANGE ("timestamp")'.format(quote(table), quote(legacy)))
+        self.execute_sql('ALTER TABLE {} ADD PRIMARY KEY ("id", "timestamp")'.format(quote(table)))
+        self.execute_sql('ALTER SEQUENCE {} OWNED BY {}."id"'.format(sequence, quote(table)))
+        for (name, definition) in indexes:
+            if ' UNIQUE ' in definition:
+                # primary key
+                continue
+            definition = re.sub(r' ON (ONLY )?(\S+\.)?"?{}"? '.format(re.escape(legacy)),
+                                ' ON {} '.format(quote(table)), definition)
+            self.execute_sql(definition)
+        for (name, definition) in constraints:
+            self.execute_sql('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(quote(table),
+                                                                         quote(name[:50] + '_part'),
+                                                                         definition))
+
+        # attach existing rows; a validated check constraint avoids a second scan while locked
+        self.execute_sql('ALTER TABLE {} ADD CONSTRAINT {} CHECK ("timestamp" < %s) NOT VALID'.format(
+            quote(legacy), quote(legacy + '_bound')), [bound])
+        self.execute_sql('ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(quote(legacy), quote(legacy + '_bound')))
+        self.execute_sql('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (MINVALUE) TO (%s)'.format(
+            quote(table), quote(legacy)), [bound])
+
+        # catch rows outside of the created partitions
+        self.execute_sql('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(quote(table + '_default'), quote(table)))
+
+    @transaction.atomic
+    def create_partition(self, start):
+        """
+        Create the partition for the month starting at start, moving any matching rows out of the default partition.
+        """
+
+        quote = self.quote
+        table = self.table
+        partition = '{}_p{:%Y%m}'.format(table, start)
+        end = month_start(start, 1)
+
+        if self.verbosity > 0:
+            self.stdout.write("   Creating partition '{}'".format(partition))
+
+        self.execute_sql('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(
+            quote(partition), quote(table)))
+        self.execute_sql('WITH moved AS (DELETE FROM {} WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *) '
+                         'INSERT INTO {} SELECT * FROM moved'.format(quote(table + '_default'), quote(partition)),
+                         [start, end])
+        self.execute_sql('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)'.format(
+            quote(table), quote(partition)), [start, end])
+
+    def detach_partition(self, partition):
+
+        quote = self.quote
+
+        if self.verbosity > 0:
+            self.stdout.write("   Detaching partition '{}'".format(partition))
+
+        with transaction.atomic():
+            self.execute_sql('ALTER TABLE {} DETACH PARTITION {}'.format(quote(self.table), quote(partition)))
+            if self.drop:
+                self.execute_sql('DROP TABLE {}'.format(quote(partition)))
+            else:
+                self.execute_sql('CREATE SCHEMA IF NOT EXISTS {}'.format(quote(self.archive_schema)))
+                self.execute_sql('ALTER TABLE {} SET SCHEMA {}'.format(quote(partition),
+                                                                      quote(self.archive_schema)))
+
+    def add_brin_index(self, partition):
+
+        if self.verbosity > 0:
+            self.stdout.write("   Indexing partition '{}'".format(partition))
+
+        self.execute_sql('CREATE INDEX IF NOT EXISTS {} ON {} USING brin ("timestamp")'.format(
+            self.quote(partition[:50] + '_ts_brin'), self.quote(partition)))
+
+    def handle(self, *args, **options):
+
+        self.verbosity = options['verbosity']
+        self.drop = options['drop']
+        self.archive_schema = options['archive_schema']
+
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partitioning requires PostgreSQL')
+
+        if not self.is_partitioned():
+            if not options['setup']:
+                raise CommandError("'{}' is not partitioned, run with --setup first".format(self.table))
+            self.setup()
+
+        now = timezone.now()
+        current = month_start(now)
+        partitions = self.get_partitions()
+        bounds = {upper for (_, upper) in partitions if upper is not None}
+
+        # create partitions ahead of time
+        if self.verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(">> Creating partitions"))
+        for months in range(options['ahead'] + 1):
+            start = month_start(now, months)
+            if month_start(start, 1) not in bounds and start >= max(bounds, default=start):
+                self.create_partition(start)
+
+        # partitions no longer written
+        closed = [(name, upper) for (name, upper) in self.get_partitions()
+                  if upper is not None and upper <= current]
+
+        # retention policy
+        if options['retention'] is not None:
+            if self.verbosity > 0:
+                self.stdout.write(self.style.SUCCESS(">> Applying retention of {} months".format(options['retention'])))
+            cutoff = month_start(now, -options['retention'])
+            for (name, upper) in closed:
+                if upper <= cutoff:
+                    self.detach_partition(name)
+            closed = [(name, upper) for (name, upper) in closed if upper > cutoff]
+
+        # brin indexes
+        if options['brin']:
+            if self.verbosity > 0:
+                self.stdout.write(self.style.SUCCESS(">> Adding BRIN indexes"))
+            for (name, _) in closed:
+                self.add_brin_index(name)
+
+        if self.verbosity > 0:
+            self.stdout.write(self.style.SUCCESS("<< Done"))
@@ -0,0 +1,88 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ambulance.models import Ambulance, AmbulanceUpdate, AmbulanceUpdateRollup, RollupResolution
+from ambulance.rollups import update_rollups
+
+
+class Command(BaseCommand):
+    help = 'Compute ambulance update rollups that are missing or out of date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ambulance', nargs='+', type=int, default=None,
+                            help='ids of the ambulances to process, all if omitted')
+        parser.add_argument('--start', default=None,
+                            help='start of the range to recompute, by default the earliest update '
+                                 'saved since the last run')
+        parser.add_argument('--end', default=None,
+                            help='end of the range to recompute, by default now')
+        parser.add_argument('--chunk', type=int, default=24,
+                            help='hours processed per transaction')
+
+    @staticmethod
+    def parse(value):
+        if value is None:
+            return None
+        timestamp = parse_datetime(value)
+        if timestamp is None:
+            raise CommandError("Invalid timestamp '{}'".format(value))
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        return timestamp
+
+    def handle(self, *args, **options):
+
+        verbosity = options['verbosity']
+        chunk = timedelta(hours=options['chunk'])
+        start = self.parse(options['start'])
+        end = self.parse(options['end']) or timezone.now()
+
+        ambulances = Ambulance.objects.all()
+        if options['ambulance'] is not None:
+            ambulances = ambulances.filter(id__in=options['ambulance'])
+
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(">> Computing rollups"))
+
+        for ambulance in ambulances.order_by('id'):
+
+            # range of the updates
+            limits = AmbulanceUpdate.objects.filter(ambulance=ambulance) \
+                .aggregate(first=Min('timestamp'), last=Max('timestamp'))
+            if limits['first'] is None:
+                continue
+
+            # resume from the updates saved after the newest one rolled up, late ones included
+            ambulance_start = start
+            ambulance_end = end
+            if ambulance_start is None:
+                newest_id = AmbulanceUpdateRollup.objects \
+                    .filter(ambulance=ambulance, resolution=RollupResolution.m.name) \
+                    .aggregate(newest=Max('newest_id'))['newest']
+                if newest_id is not None:
+                    saved = AmbulanceUpdate.objects.filter(ambulance=ambulance, id__gt=newest_id) \
+                        .aggregate(first=Min('timestamp'), last=Max('timestamp'))
+                    if saved['first'] is None:
+                        # up to date
+                        continue
+                    ambulance_start = saved['first']
+                    ambulance_end = min(end, saved['last'])
+            ambulance_start = max(ambulance_start or limits['first'], limits['first'])
+            ambulance_end = min(ambulance_end, limits['last'])
+
+            count = 0
+            chunk_start = ambulance_start
+            while chunk_start <= ambulance_end:
+                chunk_end = min(chunk_start + chunk, ambulance_end)
+                count += update_rollups(ambulance.id, chunk_start, chunk_end)
+                chunk_start = chunk_end + timedelta(microseconds=1)
+
+            if verbosity > 0:
+                self.stdout.write("   {}: {} minute buckets".format(ambulance.identifier, count))
+
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS("<< Done"))
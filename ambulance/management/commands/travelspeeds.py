@@ -0,0 +1,56 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ambulance.models import Ambulance
+from ambulance.speeds import compute_speeds, save_speeds, SPEED_LEVEL
+
+
+class Command(BaseCommand):
+    help = 'Compute travel speeds by grid cell and hour of the week from ambulance updates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ambulance', nargs='+', type=int, default=None,
+                            help='ids of the ambulances to learn from, all if omitted')
+        parser.add_argument('--start', default=None,
+                            help='start of the range to learn from, by default --weeks before the end')
+        parser.add_argument('--end', default=None,
+                            help='end of the range to learn from, by default now')
+        parser.add_argument('--weeks', type=int, default=8,
+                            help='weeks to learn from if --start is omitted')
+        parser.add_argument('--level', type=int, default=SPEED_LEVEL,
+                            help='grid level of the cells')
+
+    @staticmethod
+    def parse(value):
+        if value is None:
+            return None
+        timestamp = parse_datetime(value)
+        if timestamp is None:
+            raise CommandError("Invalid timestamp '{}'".format(value))
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        return timestamp
+
+    def handle(self, *args, **options):
+
+        verbosity = options['verbosity']
+        end = self.parse(options['end']) or timezone.now()
+        start = self.parse(options['start']) or end - timedelta(weeks=options['weeks'])
+        level = options['level']
+
+        ambulances = Ambulance.objects.all()
+        if options['ambulance'] is not None:
+            ambulances = ambulances.filter(id__in=options['ambulance'])
+
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(">> Computing travel speeds from {} to {}".format(start, end)))
+
+        totals = compute_speeds(ambulances.order_by('id').values_list('id', flat=True), start, end, level)
+        count = save_speeds(totals, level)
+
+        if verbosity > 0:
+            self.stdout.write("   {} cells, {:.0f} hours driven".format(count, totals.time.sum() / 3600))
+            self.stdout.write(self.style.SUCCESS("<< Done"))
@@ -0,0 +1,244 @@
+import itertools
+import logging
+import math
+from collections import OrderedDict
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.db.models import Count, F, FloatField, Func, Max
+from django.db.models.functions import TruncDate
+
+from emstrack import latlon_batch
+from emstrack.latlon import earth_radius
+
+from .models import AmbulanceUpdate, AmbulanceMileage
+
+logger = logging.getLogger(__name__)
+
+# Same parameters and algorithm as calculateMotionStatistics and segmentHistory in static/js/map-tools.js
+
+# points closer than this are not counted as movement, meters
+MOVING_DISTANCE_THRESHOLD = 5
+
+# speeds at or below this are not counted as movement, m/s
+MOVING_SPEED_THRESHOLD = 5 / 3.6
+
+# faster speeds are outliers, m/s
+MAXIMUM_SPEED = 180 / 3.6
+
+# speed low-pass filter coefficient
+FILTER_COEFFICIENT = 0.25
+
+# regularization of the speed calculation
+EPSILON = 1e-4
+
+# start a new segment when points are farther apart than separation[1] meters, or interval[1] seconds,
+# or both farther than separation[0] meters and interval[0] seconds
+SEPARATION_RADIUS = (10, 1000)
+TIME_INTERVAL = (2 * 60, 60 * 60)
+
+STATISTICS = ('count', 'distance', 'time', 'moving_distance', 'moving_time', 'max_speed')
+
+
+def empty_statistics():
+    return OrderedDict((name, 0 if name == 'count' else 0.0) for name in STATISTICS)
+
+
+def merge_statistics(statistics, other):
+    """
+    Accumulate other into statistics, in place.
+    """
+    for name in STATISTICS:
+        if name == 'max_speed':
+            statistics[name] = max(statistics[name], other[name])
+        else:
+            statistics[name] += other[name]
+    return statistics
+
+
+def segment_starts(longitude, latitude, timestamps):
+    """
+    Indices of the first point of each segment of a track in ascending order of timestamps, in seconds.
+    """
+
+    distance = latlon_batch.track_distances(longitude, latitude)
+    interval = np.diff(np.asarray(timestamps, dtype=float))
+    breaks = (distance > SEPARATION_RADIUS[1]) | (interval > TIME_INTERVAL[1]) | \
+             ((interval > TIME_INTERVAL[0]) & (distance > SEPARATION_RADIUS[0]))
+
+    return np.concatenate([[0], np.flatnonzero(breaks) + 1])
+
+
+def segment_statistics(lat, lon, cos_lat, timestamps):
+    """
+    Statistics of a segment given latitudes and longitudes in radians, the cosines of the latitudes
+    and timestamps in seconds. Points that move too little and outliers are skipped; speeds are filtered.
+    """
+
+    statistics = empty_statistics()
+    if len(timestamps) == 0:
+        return statistics
+
+    last_speed = MOVING_SPEED_THRESHOLD
+    last = 0
+    for current in range(1, len(timestamps)):
+
+        # haversine distance to the last point retained
+        a = math.sin((lat[current] - lat[last]) / 2) ** 2 + \
+            cos_lat[last] * cos_lat[current] * math.sin((lon[current] - lon[last]) / 2) ** 2
+        distance = earth_radius * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+        if distance < MOVING_DISTANCE_THRESHOLD:
+            # not enough movement
+            continue
+
+        duration = abs(timestamps[current] - timestamps[last])
+        statistics['distance'] += distance
+        statistics['time'] += duration
+
+        # regularized speed to avoid singularities
+        speed = (distance * duration) / (duration * duration + EPSILON)
+        if speed > MAXIMUM_SPEED:
+            # outlier
+            continue
+
+        # filter speed
+        speed = (1 - FILTER_COEFFICIENT) * last_speed + FILTER_COEFFICIENT * speed
+        statistics['max_speed'] = max(statistics['max_speed'], speed)
+
+        if speed > MOVING_SPEED_THRESHOLD:
+            statistics['moving_distance'] += distance
+            statistics['moving_time'] += duration
+
+        last_speed = speed
+        last = current
+
+    return statistics
+
+
+def calculate_mileage(longitude, latitude, timestamps):
+    """
+    Mileage statistics of a track given longitudes and latitudes in degrees and timestamps in seconds,
+    in ascending order of timestamps. Distances are in meters, times in seconds and speeds in m/s.
+    """
+
+    statistics = empty_statistics()
+    if len(timestamps) == 0:
+        return statistics
+
+    lat = np.radians(np.asarray(latitude, dtype=float))
+    lon = np.radians(np.asarray(longitude, dtype=float))
+    cos_lat = np.cos(lat)
+    timestamps = np.asarray(timestamps, dtype=float)
+
+    # segments are independent; plain lists are faster to index in the loop
+    starts = segment_starts(longitude, latitude, timestamps)
+    ends = np.append(starts[1:], len(timestamps))
+    for (start, end) in zip(starts, ends):
+        merge_statistics(statistics, segment_statistics(lat[start:end].tolist(), lon[start:end].tolist(),
+                                                        cos_lat[start:end].tolist(),
+                                                        timestamps[start:end].tolist()))
+    statistics['count'] = len(timestamps)
+
+    return statistics
+
+
+def compute_mileage(ambulance_ids, start, end):
+    """
+    Mileage statistics by ambulance id of the updates of the ambulances in [start, end).
+    """
+
+    rows = AmbulanceUpdate.objects \
+        .filter(ambulance_id__in=ambulance_ids, timestamp__gte=start, timestamp__lt=end) \
+        .annotate(longitude=Func(F('location'), function='ST_X', output_field=FloatField()),
+                  latitude=Func(F('location'), function='ST_Y', output_field=FloatField())) \
+        .order_by('ambulance_id', 'timestamp', 'id') \
+        .values_list('ambulance_id', 'longitude', 'latitude', 'timestamp')
+
+    statistics = {}
+    for (ambulance_id, updates) in itertools.groupby(rows, key=lambda row: row[0]):
+        (_, longitude, latitude, timestamps) = zip(*updates)
+        statistics[ambulance_id] = calculate_mileage(longitude, latitude, [t.timestamp() for t in timestamps])
+
+    return statistics
+
+
+def day_start(date):
+    return datetime.combine(date, time(), tzinfo=dt_timezone.utc)
+
+
+def get_day_mileage(ambulance_ids, first_day, last_day):
+    """
+    Mileage statistics by ambulance id of the days in [first_day, last_day), from the cache
+    when the updates of the day have not changed since they were computed.
+    """
+
+    start = day_start(first_day)
+    end = day_start(last_day)
+
+    # number and last id of the updates of each ambulance and day
+    fingerprints = AmbulanceUpdate.objects \
+        .filter(ambulance_id__in=ambulance_ids, timestamp__gte=start, timestamp__lt=end) \
+        .annotate(date=TruncDate('timestamp')) \
+        .values('ambulance_id', 'date') \
+        .annotate(count=Count('id'), last_id=Max('id')) \
+        .order_by()
+
+    cache = {(mileage.ambulance_id, mileage.date): mileage
+             for mileage in AmbulanceMileage.objects.filter(ambulance_id__in=ambulance_ids,
+                                                            date__gte=first_day, date__lt=last_day)}
+
+    statistics = {}
+    hits = 0
+    for fingerprint in fingerprints:
+
+        key = (fingerprint['ambulance_id'], fingerprint['date'])
+        mileage = cache.get(key)
+        if mileage is not None and mileage.count == fingerprint['count'] \
+                and mileage.last_id == fingerprint['last_id']:
+            hits += 1
+        else:
+            # compute and cache
+            day = day_start(fingerprint['date'])
+            values = compute_mileage([fingerprint['ambulance_id']], day, day + timedelta(days=1))
+            values = values.get(fingerprint['ambulance_id'], empty_statistics())
+            values['count'] = fingerprint['count']
+            (mileage, created) = AmbulanceMileage.objects.update_or_create(
+                ambulance_id=fingerprint['ambulance_id'], date=fingerprint['date'],
+                defaults={'last_id': fingerprint['last_id'], **values})
+
+        merge_statistics(statistics.setdefault(fingerprint['ambulance_id'], empty_statistics()),
+                         {name: getattr(mileage, name) for name in STATISTICS})
+
+    logger.debug('get_day_mileage: {} cached days used'.format(hits))
+
+    return statistics
+
+
+def get_mileage(ambulance_ids, start, end):
+    """
+    Mileage statistics by ambulance id of the updates of the ambulances in [start, end).
+    Whole days are computed once and cached; segments are split at midnight, UTC.
+    Ambulances without updates in the range are omitted.
+    """
+
+    ambulance_ids = list(ambulance_ids)
+    start = start.astimezone(dt_timezone.utc)
+    end = end.astimezone(dt_timezone.utc)
+
+    # whole days in the range
+    first_day = (start - timedelta(microseconds=1)).date() + timedelta(days=1)
+    last_day = end.date()
+
+    if first_day >= last_day:
+        # no whole day
+        return compute_mileage(ambulance_ids, start, end)
+
+    statistics = get_day_mileage(ambulance_ids, first_day, last_day)
+
+    # partial days at the ends of the range
+    for (partial_start, partial_end) in ((start, day_start(first_day)), (day_start(last_day), end)):
+        if partial_start < partial_end:
+            for (ambulance_id, values) in compute_mileage(ambulance_ids, partial_start, partial_end).items():
+                merge_statistics(statistics.setdefault(ambulance_id, empty_statistics()), values)
+
+    return statistics
@@ -1,9 +1,12 @@
+import io
 import logging
+from datetime import datetime
 from enum import Enum
 
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.auth.models import User
-from django.db import transaction
+from django.db import connection, transaction
 from django.db.models import Max
 from django.utils import timezone
 from django.urls import reverse
@@ -18,6 +21,12 @@ from emstrack.sms import client as sms_client
 
 from equipment.models import EquipmentHolder
 
+from .odometer import advance, set_odometers
+
+from environs import Env
+
+env = Env()
+
 logger = logging.getLogger(__name__)
 
 
@@ -155,13 +164,17 @@ class Ambulance(PublishMixin,
                               choices=make_choices(AmbulanceStatus),
                               default=AmbulanceStatus.UK.name)
 
-    # location
+    # location, with a GiST index for nearest ambulance queries, see ambulance.nearest
     orientation = models.FloatField(_('orientation'), default=0.0)
     location = models.PointField(_('location'), srid=4326, default=defaults['location'])
 
     # timestamp
     timestamp = models.DateTimeField(_('timestamp'), default=timezone.now)
 
+    # odometer in meters and moving time in seconds, as of the latest update
+    odometer = models.FloatField(_('odometer'), default=0.0)
+    moving_time = models.FloatField(_('moving time'), default=0.0)
+
     # active
     active = models.BooleanField(_('active'), default=True)
 
@@ -219,6 +232,19 @@ class Ambulance(PublishMixin,
                 self._loaded_values['capability'] != self.capability or \
                 self._loaded_values['comment'] != self.comment:
 
+            # advance odometer from the previous location only if odometer has not changed
+            # late updates are left to AmbulanceUpdate, which repairs the updates after them
+            late = False
+            if loaded_values and self._loaded_values.get('odometer') == self.odometer:
+                if self.timestamp >= self._loaded_values['timestamp']:
+                    (self.odometer, self.moving_time) = advance(self._loaded_values['location'],
+                                                                self._loaded_values['timestamp'],
+                                                                self._loaded_values['odometer'],
+                                                                self._loaded_values.get('moving_time', 0.0),
+                                                                self.location, self.timestamp)
+                else:
+                    late = True
+
             # save to Ambulance
             super().save(*args, **kwargs)
 
@@ -228,11 +254,17 @@ class Ambulance(PublishMixin,
             data = {k: getattr(self, k)
                     for k in ('capability', 'status', 'orientation',
                               'location', 'timestamp',
-                              'comment', 'updated_by', 'updated_on')}
+                              'comment', 'updated_by', 'updated_on',
+                              'odometer', 'moving_time')}
             data['ambulance'] = self
+            if late:
+                data['odometer'] = data['moving_time'] = None
             obj = AmbulanceUpdate(**data)
             obj.save()
 
+            # compare the next save of this instance with the values just saved
+            self.set_loaded_values()
+
             # logger.debug('UPDATE SAVED')
 
             # # model changed
@@ -245,6 +277,9 @@ class Ambulance(PublishMixin,
             # save only to Ambulance
             super().save(*args, **kwargs)
 
+            # compare the next save of this instance with the values just saved
+            self.set_loaded_values()
+
             # logger.debug('SAVED')
 
             # # model changed
@@ -266,6 +301,9 @@ class Ambulance(PublishMixin,
             from mqtt.cache_clear import mqtt_cache_clear
             mqtt_cache_clear()
 
+    def set_loaded_values(self):
+        self._loaded_values = {field.attname: getattr(self, field.attname) for field in self._meta.concrete_fields}
+
     def publish(self, **kwargs):
 
         # publish to mqtt
@@ -319,17 +357,177 @@ class AmbulanceUpdate(UpdatedByHistoryModel):
     orientation = models.FloatField(_('orientation'), default=0.0)
     location = models.PointField(_('location'), srid=4326, default=defaults['location'])
 
-    # timestamp, indexed
+    # timestamp, indexed; the table is partitioned by month on timestamp, see the partitionupdates command
     timestamp = models.DateTimeField(_('timestamp'), db_index=True, default=timezone.now)
 
+    # odometer in meters and moving time in seconds since the first update, see ambulance.odometer
+    odometer = models.FloatField(_('odometer'), null=True, blank=True)
+    moving_time = models.FloatField(_('moving time'), null=True, blank=True)
+
     class Meta:
         indexes = [
+            # also serves keyset pagination on (timestamp, id)
             models.Index(
-                fields=['ambulance', 'timestamp'],
+                fields=['ambulance', 'timestamp', 'id'],
                 name='ambulance_timestamp_idx',
             ),
         ]
 
+    def save(self, *args, **kwargs):
+
+        # calculate odometer if not given
+        if self._state.adding and self.odometer is None:
+            set_odometers([self])
+
+        # save to AmbulanceUpdate
+        super().save(*args, **kwargs)
+
+        # update rollups when the transaction commits, if DJANGO_ROLLUP_ON_INGEST
+        from .rollups import schedule_rollups
+        schedule_rollups(self.ambulance_id, self.timestamp)
+
+    # batches at least this large are inserted with COPY
+    copy_threshold = env.int('DJANGO_UPDATES_COPY_THRESHOLD', default=5000)
+
+    @classmethod
+    def bulk_insert(cls, updates):
+        """
+        Insert updates of a single ambulance in one statement, bulk_create or COPY for large batches,
+        and set their ids.
+        """
+
+        if not updates:
+            return updates
+
+        # calculate odometers if not given
+        if any(update.odometer is None for update in updates):
+            set_odometers(updates)
+
+        if len(updates) >= cls.copy_threshold and connection.vendor == 'postgresql':
+            cls.copy_insert(updates)
+        else:
+            cls.objects.bulk_create(updates)
+
+        # update rollups when the transaction commits, if DJANGO_ROLLUP_ON_INGEST
+        from .rollups import schedule_rollups
+        timestamps = [update.timestamp for update in updates]
+        schedule_rollups(updates[0].ambulance_id, min(timestamps), max(timestamps))
+
+        return updates
+
+    @classmethod
+    def copy_insert(cls, updates):
+
+        table = cls._meta.db_table
+        fields = cls._meta.concrete_fields
+        quote = connection.ops.quote_name
+
+        with connection.cursor() as cursor:
+
+            # reserve ids, COPY cannot return them
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                           [table, len(updates)])
+            for (update, (id,)) in zip(updates, cursor.fetchall()):
+                update.id = id
+
+            # strings are quoted so that only None becomes NULL
+            buffer = io.StringIO()
+            for update in updates:
+                row = []
+                for field in fields:
+                    value = getattr(update, field.attname)
+                    if value is None:
+                        row.append('')
+                    elif isinstance(value, bool):
+                        row.append('t' if value else 'f')
+                    elif isinstance(value, (int, float)):
+                        row.append(repr(value))
+                    else:
+                        if isinstance(value, GEOSGeometry):
+                            value = value.ewkt
+                        elif isinstance(value, datetime):
+                            value = value.isoformat()
+                        row.append('"{}"'.format(str(value).replace('"', '""')))
+                buffer.write(','.join(row) + '\n')
+            buffer.seek(0)
+
+            cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                quote(table), ', '.join(quote(field.column) for field in fields)), buffer)
+
+
+class RollupResolution(Enum):
+    m = _('minute')
+    h = _('hour')
+
+
+class AmbulanceUpdateRollup(models.Model):
+    """
+    Summary of the ambulance updates in a time bucket, maintained by ambulance.rollups.
+    """
+
+    # ambulance
+    ambulance = models.ForeignKey(Ambulance,
+                                  on_delete=models.CASCADE,
+                                  verbose_name=_('ambulance'))
+
+    # bucket resolution and start
+    resolution = models.CharField(_('resolution'), max_length=1,
+                                  choices=make_choices(RollupResolution))
+    bucket = models.DateTimeField(_('bucket'))
+
+    # first and last positions in the bucket
+    first_location = models.PointField(_('first location'), srid=4326, null=True, blank=True)
+    first_timestamp = models.DateTimeField(_('first timestamp'), null=True, blank=True)
+    last_location = models.PointField(_('last location'), srid=4326, null=True, blank=True)
+    last_timestamp = models.DateTimeField(_('last timestamp'), null=True, blank=True)
+
+    # distance travelled in meters
+    distance = models.FloatField(_('distance'), default=0.0)
+
+    # seconds spent in each status, e.g. {'AV': 45.0, 'PB': 15.0}
+    status_duration = models.JSONField(_('status duration'), default=dict)
+
+    # number of updates in the bucket
+    count = models.IntegerField(_('count'), default=0)
+
+    # id of the newest update in the bucket, the last one saved; updates saved later have larger ids
+    newest_id = models.BigIntegerField(_('newest update id'), null=True, blank=True)
+
+    class Meta:
+        unique_together = ('ambulance', 'resolution', 'bucket')
+        indexes = [
+            models.Index(
+                fields=['resolution', 'bucket'],
+                name='rollup_resolution_bucket_idx',
+            ),
+        ]
+
+
+class AmbulanceMileage(models.Model):
+    """
+    Mileage of an ambulance in a day, cached by ambulance.mileage.
+    """
+
+    # ambulance and day
+    ambulance = models.ForeignKey(Ambulance,
+                                  on_delete=models.CASCADE,
+                                  verbose_name=_('ambulance'))
+    date = models.DateField(_('date'))
+
+    # number and last id of the updates of the day, to tell if the cache is stale
+    count = models.IntegerField(_('count'), default=0)
+    last_id = models.BigIntegerField(_('last id'), default=0)
+
+    # distance in meters and time in seconds, total and while moving, and maximum speed in m/s
+    distance = models.FloatField(_('distance'), default=0.0)
+    time = models.FloatField(_('time'), default=0.0)
+    moving_distance = models.FloatField(_('moving distance'), default=0.0)
+    moving_time = models.FloatField(_('moving time'), default=0.0)
+    max_speed = models.FloatField(_('maximum speed'), default=0.0)
+
+    class Meta:
+        unique_together = ('ambulance', 'date')
+
 
 # Call related models
 
@@ -816,6 +1014,58 @@ class WaypointHistory(UpdatedByModel):
                               choices=make_choices(WaypointStatus))
 
 
+# Heatmap related models
+
+class HeatmapLayer(Enum):
+    p = _('Ambulance positions')
+    i = _('Incidents')
+
+
+class HeatmapDay(models.Model):
+    """
+    Number of points of a heatmap layer in each grid cell in a day, cached by ambulance.heatmap.
+    """
+
+    # layer, grid level and day
+    layer = models.CharField(_('layer'), max_length=1,
+                             choices=make_choices(HeatmapLayer))
+    level = models.PositiveSmallIntegerField(_('level'))
+    date = models.DateField(_('date'))
+
+    # number, last id and last update of the points of the day, to tell if the cache is stale
+    count = models.IntegerField(_('count'), default=0)
+    last_id = models.BigIntegerField(_('last id'), default=0)
+    last_updated = models.DateTimeField(_('last updated'), null=True, blank=True)
+
+    # cells as [x, y, count]
+    cells = models.JSONField(_('cells'), default=list)
+
+    class Meta:
+        unique_together = ('layer', 'level', 'date')
+
+
+# Travel speed related models
+
+class TravelSpeed(models.Model):
+    """
+    Distance and time driven in a grid cell in each hour of the week, computed by ambulance.speeds.
+    """
+
+    # grid level and cell, as in ambulance.heatmap
+    level = models.PositiveSmallIntegerField(_('level'))
+    x = models.IntegerField(_('x'))
+    y = models.IntegerField(_('y'))
+
+    # meters and seconds driven in each hour of the week, local time, from Monday 00:00
+    distance = models.JSONField(_('distance'), default=list)
+    time = models.JSONField(_('time'), default=list)
+
+    updated_on = models.DateTimeField(_('updated_on'), auto_now=True)
+
+    class Meta:
+        unique_together = ('level', 'x', 'y')
+
+
 # THOSE NEED REVIEWING
 
 class Region(models.Model):
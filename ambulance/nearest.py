@@ -0,0 +1,66 @@
+import logging
+
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from emstrack.latlon import calculate_distance, calculate_orientation
+
+from .models import Ambulance, AmbulanceStatus
+from .speeds import estimate_travel_times
+
+logger = logging.getLogger(__name__)
+
+# candidates retrieved by index order for each ambulance returned, to make up for
+# planar distances in degrees differing from distances on the sphere
+CANDIDATE_FACTOR = 4
+CANDIDATE_MINIMUM = 20
+
+# largest number of ambulances returned
+MAXIMUM_K = 100
+
+
+def get_nearest_ambulances(ambulances, longitude, latitude, k=5,
+                           status=(AmbulanceStatus.AV.name,), capability=None, active=True, by_eta=False, eta=False):
+    """
+    The k ambulances in the queryset ambulances closest to longitude and latitude, as a list of
+    (ambulance, distance in meters, bearing in degrees from the ambulance to the point, estimated travel time
+    in seconds), closest first.
+    Candidates are retrieved in the order of the spatial index (KNN) and ranked by haversine distance,
+    or by estimated travel time if by_eta, those without an estimate within the time budget last.
+    Travel times are only estimated if by_eta or eta, and are None otherwise.
+    """
+
+    point = Point(longitude, latitude, srid=4326)
+
+    if status:
+        ambulances = ambulances.filter(status__in=status)
+    if capability:
+        ambulances = ambulances.filter(capability__in=capability)
+    if active is not None:
+        ambulances = ambulances.filter(active=active)
+
+    # the <-> operator in ORDER BY walks the GiST index on location
+    knn = RawSQL('{}.{} <-> ST_SetSRID(ST_MakePoint(%s, %s), 4326)'.format(
+        connection.ops.quote_name(Ambulance._meta.db_table), connection.ops.quote_name('location')),
+        (float(longitude), float(latitude)))
+    candidates = ambulances \
+        .only('id', 'identifier', 'capability', 'status', 'location', 'timestamp') \
+        .order_by(knn)[:max(CANDIDATE_FACTOR * k, CANDIDATE_MINIMUM)]
+
+    nearest = sorted(((ambulance, calculate_distance(ambulance.location, point))
+                      for ambulance in candidates),
+                     key=lambda item: item[1])
+    if by_eta:
+        # estimate all candidates to rank them
+        etas = estimate_travel_times([ambulance.location for (ambulance, distance) in nearest], longitude, latitude)
+        nearest = sorted(((ambulance, distance, eta) for ((ambulance, distance), eta) in zip(nearest, etas)),
+                         key=lambda item: float('inf') if item[2] is None else item[2])[:k]
+    else:
+        nearest = nearest[:k]
+        etas = estimate_travel_times([ambulance.location for (ambulance, distance) in nearest], longitude, latitude) \
+            if eta else [None] * len(nearest)
+        nearest = [(ambulance, distance, eta) for ((ambulance, distance), eta) in zip(nearest, etas)]
+
+    return [(ambulance, distance, calculate_orientation(ambulance.location, point), eta)
+            for (ambulance, distance, eta) in nearest]
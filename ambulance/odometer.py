@@ -0,0 +1,285 @@
+import logging
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Exists, F, Q
+
+from emstrack.latlon import calculate_distance
+from emstrack.util import is_on_commit_pending
+
+logger = logging.getLogger(__name__)
+
+# Cumulative distance and moving time are stored on every update, so that the distance driven
+# between any two times is the difference between the odometers of two updates.
+
+# speeds at or below this are not counted as movement, m/s
+MOVING_SPEED_THRESHOLD = 5 / 3.6
+
+# faster speeds are outliers and not counted, m/s
+MAXIMUM_SPEED = 180 / 3.6
+
+# updates are rewritten in batches of this size
+BATCH_SIZE = 2000
+
+# ranges of late updates whose odometers are to be repaired, by ambulance id, on the current thread
+_pending = threading.local()
+
+
+def advance(location, timestamp, odometer, moving_time, next_location, next_timestamp):
+    """
+    Odometer in meters and moving time in seconds at next_location and next_timestamp
+    given their values at location and timestamp.
+    """
+
+    if location is None or timestamp is None:
+        return odometer, moving_time
+
+    distance = calculate_distance(location, next_location)
+    duration = (next_timestamp - timestamp).total_seconds()
+
+    # without a duration, e.g. updates without timestamps, the distance counts but not the time
+    if duration > 0:
+        speed = distance / duration
+        if speed > MAXIMUM_SPEED:
+            # outlier
+            return odometer, moving_time
+        if speed > MOVING_SPEED_THRESHOLD:
+            moving_time += duration
+
+    return odometer + distance, moving_time
+
+
+def accumulate(updates, previous=None):
+    """
+    Set the odometer and moving time of updates, in ascending order of timestamps,
+    continuing from the update previous, if any.
+    """
+
+    if previous is None:
+        (location, timestamp, odometer, moving_time) = (None, None, 0.0, 0.0)
+    else:
+        (location, timestamp, odometer, moving_time) = (previous.location, previous.timestamp,
+                                                        previous.odometer or 0.0, previous.moving_time or 0.0)
+
+    for update in updates:
+        (odometer, moving_time) = advance(location, timestamp, odometer, moving_time,
+                                          update.location, update.timestamp)
+        update.odometer = odometer
+        update.moving_time = moving_time
+        (location, timestamp) = (update.location, update.timestamp)
+
+    return updates
+
+
+def get_previous_update(ambulance_id, timestamp):
+    """
+    Latest update of ambulance_id at or before timestamp.
+    """
+    from .models import AmbulanceUpdate
+
+    return AmbulanceUpdate.objects \
+        .filter(ambulance_id=ambulance_id, timestamp__lte=timestamp) \
+        .order_by('-timestamp', '-id') \
+        .first()
+
+
+def set_odometers(updates):
+    """
+    Set the odometer and moving time of new updates of a single ambulance from the update before them,
+    with one indexed lookup, and schedule a repair if they are not the latest updates of the ambulance.
+    """
+    from .models import AmbulanceUpdate
+
+    if not updates:
+        return updates
+
+    ambulance_id = updates[0].ambulance_id
+    updates = sorted(updates, key=lambda update: update.timestamp)
+    (first, last) = (updates[0].timestamp, updates[-1].timestamp)
+
+    # the previous update and whether there are later ones, in one query
+    later = AmbulanceUpdate.objects.filter(ambulance_id=ambulance_id, timestamp__gt=first)
+    previous = AmbulanceUpdate.objects \
+        .filter(ambulance_id=ambulance_id, timestamp__lte=first) \
+        .annotate(is_late=Exists(later)) \
+        .order_by('-timestamp', '-id') \
+        .first()
+    is_late = previous.is_late if previous is not None else later.exists()
+
+    accumulate(updates, previous)
+
+    # late updates change the odometers of all updates after them
+    if is_late:
+        schedule_odometers(ambulance_id, first, last)
+
+    return updates
+
+
+@transaction.atomic
+def update_odometers(ambulance_id, start=None, end=None):
+    """
+    Recompute the odometers of the updates of ambulance_id from start, or from the first update,
+    and of the ambulance. Returns the number of updates rewritten.
+
+    If end is given, e.g. after inserting late updates with timestamps in [start, end], only the steps
+    up to the first update after end change: the updates up to it are recomputed and the change
+    in its odometer and moving time is added to the updates after it in one statement.
+    """
+    from .models import Ambulance, AmbulanceUpdate
+
+    previous = get_previous_update(ambulance_id, start) if start is not None else None
+
+    # the previous update may share its timestamp with updates in the range
+    updates = AmbulanceUpdate.objects.filter(ambulance_id=ambulance_id)
+    if previous is not None:
+        updates = updates.filter(timestamp__gte=previous.timestamp).exclude(id=previous.id)
+        if previous.odometer is None:
+            # not computed yet, start over
+            return update_odometers(ambulance_id)
+    updates = updates.order_by('timestamp', 'id').only('id', 'location', 'timestamp', 'odometer', 'moving_time')
+
+    count = 0
+    batch = []
+    shift = None
+    for update in updates.iterator(chunk_size=BATCH_SIZE):
+        (odometer, moving_time) = (update.odometer, update.moving_time)
+        accumulate([update], previous)
+        batch.append(update)
+        previous = update
+        if len(batch) >= BATCH_SIZE:
+            AmbulanceUpdate.objects.bulk_update(batch, ['odometer', 'moving_time'])
+            count += len(batch)
+            batch = []
+
+        # first update after end, computed before
+        if end is not None and update.timestamp > end and odometer is not None and moving_time is not None:
+            shift = (update.odometer - odometer, update.moving_time - moving_time)
+            break
+
+    AmbulanceUpdate.objects.bulk_update(batch, ['odometer', 'moving_time'])
+    count += len(batch)
+
+    if shift is not None:
+
+        # the updates after it are shifted alike
+        count += AmbulanceUpdate.objects \
+            .filter(Q(timestamp__gt=previous.timestamp) | Q(timestamp=previous.timestamp, id__gt=previous.id),
+                    ambulance_id=ambulance_id) \
+            .update(odometer=F('odometer') + shift[0], moving_time=F('moving_time') + shift[1])
+        previous = AmbulanceUpdate.objects \
+            .filter(ambulance_id=ambulance_id) \
+            .order_by('-timestamp', '-id') \
+            .only('odometer', 'moving_time') \
+            .first()
+
+    # the ambulance carries the odometer of its latest update
+    if previous is not None:
+        Ambulance.objects.filter(id=ambulance_id).update(odometer=previous.odometer or 0.0,
+                                                         moving_time=previous.moving_time or 0.0)
+
+    return count
+
+
+def repair_odometers(ranges):
+    """
+    Repair the odometers after late updates, given a dictionary of (start, end) of the late updates
+    by ambulance id.
+    """
+
+    for (ambulance_id, (start, end)) in ranges.items():
+        try:
+            update_odometers(ambulance_id, start, end)
+        except Exception as e:
+            logger.warning('Could not update odometers of ambulance {}: {}'.format(ambulance_id, e))
+
+
+def flush_odometers():
+
+    # retrieve and reset pending ranges
+    pending = getattr(_pending, 'ranges', None)
+    _pending.ranges = None
+    if not pending:
+        # already flushed
+        return
+
+    repair_odometers(pending)
+
+
+def add_range(ranges, ambulance_id, start, end):
+    if ambulance_id in ranges:
+        (current_start, current_end) = ranges[ambulance_id]
+        ranges[ambulance_id] = (min(start, current_start), max(end, current_end))
+    else:
+        ranges[ambulance_id] = (start, end)
+
+
+def schedule_odometers(ambulance_id, start, end=None):
+    """
+    Schedule the odometers of ambulance_id after late updates in [start, end] to be repaired once,
+    when the current transaction commits, or when the outermost defer_odometers block exits.
+    """
+
+    if end is None:
+        end = start
+
+    # deferred
+    deferred = getattr(_pending, 'deferred', None)
+    if deferred is not None:
+        add_range(deferred, ambulance_id, start, end)
+        return
+
+    # collect ranges
+    pending = getattr(_pending, 'ranges', None)
+    if pending is None or not is_on_commit_pending(_pending.flush):
+        # nothing pending, or left over from a transaction that rolled back
+        pending = _pending.ranges = {}
+        _pending.flush = partial(flush_odometers)
+    add_range(pending, ambulance_id, start, end)
+
+    # only the first callback to run finds pending ranges to flush
+    transaction.on_commit(_pending.flush)
+
+
+@contextmanager
+def defer_odometers():
+    """
+    Collect the odometer repairs scheduled in the block, across transactions, and run them once on exit,
+    e.g. for an upload stored in many transactions.
+    """
+
+    if getattr(_pending, 'deferred', None) is not None:
+        # nested
+        yield
+        return
+
+    _pending.deferred = {}
+    try:
+        yield
+    finally:
+        deferred = _pending.deferred
+        _pending.deferred = None
+        repair_odometers(deferred)
+
+
+def get_odometer(ambulance_id, timestamp):
+    """
+    Odometer and moving time of ambulance_id at timestamp, from its latest update at or before timestamp.
+    """
+
+    previous = get_previous_update(ambulance_id, timestamp)
+    if previous is None:
+        return 0.0, 0.0
+    return previous.odometer or 0.0, previous.moving_time or 0.0
+
+
+def get_odometer_distance(ambulance_id, start, end):
+    """
+    Distance in meters and moving time in seconds driven by ambulance_id between start and end,
+    with two indexed lookups.
+    """
+
+    (start_odometer, start_moving_time) = get_odometer(ambulance_id, start)
+    (end_odometer, end_moving_time) = get_odometer(ambulance_id, end)
+    return end_odometer - start_odometer, end_moving_time - start_moving_time
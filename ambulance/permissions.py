@@ -1,4 +1,6 @@
-from ambulance.models import Call
+from django.db.models import Exists, OuterRef
+
+from ambulance.models import Call, AmbulanceCall
 from emstrack.mixins import BasePermissionMixin
 
 
@@ -11,5 +13,7 @@ class CallPermissionMixin(BasePermissionMixin):
     queryset = Call.objects.all()
     dispatcher_override = True
 
-    def get_queryset(self):
-        return super().get_queryset().distinct()
+    def filter_permitted(self, queryset, can_do):
+        # semi-join on ambulancecall so that calls are not duplicated and need no distinct
+        ambulancecalls = AmbulanceCall.objects.filter(call=OuterRef('pk'), ambulance_id__in=can_do)
+        return queryset.annotate(is_permitted=Exists(ambulancecalls)).filter(is_permitted=True)
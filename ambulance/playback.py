@@ -0,0 +1,108 @@
+import heapq
+import json
+import logging
+
+from django.db.models import F, FloatField, Func, Q
+
+from .models import AmbulanceUpdate
+
+from environs import Env
+
+env = Env()
+logger = logging.getLogger(__name__)
+
+# updates read from each ambulance at a time during playback
+PLAYBACK_CHUNK_SIZE = env.int('DJANGO_PLAYBACK_CHUNK_SIZE', default=500)
+
+# fields of the updates played back, in order
+FIELDS = ['ambulance_id', 'status', 'capability', 'orientation', 'longitude', 'latitude', 'timestamp', 'id']
+
+
+def get_snapshot(ambulance_ids, timestamp, since=None):
+    """
+    Latest update at or before timestamp of each of the ambulances, and after since if given,
+    in one DISTINCT ON scan of the (ambulance, timestamp, id) index.
+    """
+
+    updates = AmbulanceUpdate.objects.filter(ambulance_id__in=ambulance_ids, timestamp__lte=timestamp)
+    if since is not None:
+        updates = updates.filter(timestamp__gt=since)
+
+    return updates \
+        .select_related('ambulance', 'updated_by') \
+        .order_by('ambulance_id', '-timestamp', '-id') \
+        .distinct('ambulance_id')
+
+
+def get_track(ambulance_id, start, end, chunk_size=None):
+    """
+    Iterate over the updates of ambulance_id in [start, end) as dictionaries of FIELDS,
+    in order of timestamp, reading chunk_size updates at a time after the last one read.
+    """
+
+    chunk_size = chunk_size or PLAYBACK_CHUNK_SIZE
+    updates = AmbulanceUpdate.objects \
+        .filter(ambulance_id=ambulance_id, timestamp__lt=end) \
+        .annotate(longitude=Func(F('location'), function='ST_X', output_field=FloatField()),
+                  latitude=Func(F('location'), function='ST_Y', output_field=FloatField())) \
+        .order_by('timestamp', 'id') \
+        .values(*FIELDS)
+
+    chunk = list(updates.filter(timestamp__gte=start)[:chunk_size])
+    while chunk:
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        chunk = list(updates.filter(Q(timestamp__gt=last['timestamp']) | Q(timestamp=last['timestamp'],
+                                                                           id__gt=last['id']),
+                                    timestamp__gte=last['timestamp'])[:chunk_size])
+
+
+def sample(updates, interval):
+    """
+    The updates at least interval apart, starting with the first one.
+    """
+
+    last = None
+    for update in updates:
+        if last is None or update['timestamp'] - last >= interval:
+            last = update['timestamp']
+            yield update
+
+
+def playback(ambulance_ids, start, end, interval=None, chunk_size=None):
+    """
+    Iterate over the updates of the ambulances in [start, end), in order of timestamp,
+    no closer than interval for each ambulance, preceded by the state of each ambulance at start.
+    Memory use depends on the number of ambulances and chunk_size, not on the length of the range.
+    """
+
+    ambulance_ids = list(ambulance_ids)
+
+    # state at start, from the updates before it
+    initial = get_snapshot(ambulance_ids, start) \
+        .filter(timestamp__lt=start) \
+        .annotate(longitude=Func(F('location'), function='ST_X', output_field=FloatField()),
+                  latitude=Func(F('location'), function='ST_Y', output_field=FloatField())) \
+        .values(*FIELDS)
+    yield from sorted(initial, key=lambda update: (update['timestamp'], update['id']))
+
+    # k-way merge of the tracks of each ambulance
+    tracks = []
+    for ambulance_id in ambulance_ids:
+        track = get_track(ambulance_id, start, end, chunk_size)
+        if interval:
+            track = sample(track, interval)
+        tracks.append(track)
+
+    yield from heapq.merge(*tracks, key=lambda update: (update['timestamp'], update['id']))
+
+
+def playback_ndjson(updates):
+    """
+    One JSON object per line.
+    """
+    for update in updates:
+        update['timestamp'] = update['timestamp'].isoformat()
+        yield json.dumps(update) + '\n'
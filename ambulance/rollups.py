@@ -0,0 +1,260 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import partial
+
+from django.db import transaction
+
+from emstrack.latlon import calculate_distance
+from emstrack.util import is_on_commit_pending
+
+from .models import AmbulanceUpdate, AmbulanceUpdateRollup, RollupResolution
+
+from environs import Env
+
+env = Env()
+logger = logging.getLogger(__name__)
+
+# maintain rollups when updates are saved; otherwise the rollupupdates command, scheduled in uwsgi.ini, catches up
+ROLLUP_ON_INGEST = env.bool('DJANGO_ROLLUP_ON_INGEST', default=False)
+
+# longer intervals between updates are not counted towards status durations
+ROLLUP_MAX_GAP = timedelta(hours=env.float('DJANGO_ROLLUP_MAX_GAP', default=24))
+
+# bucket length of each resolution, finest first
+RESOLUTIONS = OrderedDict([
+    (RollupResolution.m.name, timedelta(minutes=1)),
+    (RollupResolution.h.name, timedelta(hours=1)),
+])
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# ranges of updates pending on the current thread, by ambulance id
+_pending = threading.local()
+
+
+def floor_bucket(timestamp, resolution):
+    """
+    Start of the bucket of the given resolution containing timestamp.
+    """
+    return timestamp - (timestamp - EPOCH) % RESOLUTIONS[resolution]
+
+
+def iterate_buckets(start, end, resolution):
+    """
+    Iterate over the starts of the buckets of the given resolution intersecting [start, end).
+    """
+    length = RESOLUTIONS[resolution]
+    bucket = floor_bucket(start, resolution)
+    while bucket < end:
+        yield bucket
+        bucket += length
+
+
+def new_rollup(ambulance_id, resolution, bucket):
+    return AmbulanceUpdateRollup(ambulance_id=ambulance_id, resolution=resolution, bucket=bucket,
+                                 distance=0.0, status_duration={}, count=0)
+
+
+def add_status_duration(rollups, ambulance_id, resolution, status, start, end, sparse=False):
+    """
+    Split the interval [start, end) by buckets and add its duration to status.
+    If sparse, only buckets already in rollups are counted.
+    """
+    if start >= end:
+        return
+
+    length = RESOLUTIONS[resolution]
+    if sparse:
+        first = floor_bucket(start, resolution)
+        buckets = sorted(bucket for bucket in rollups if first <= bucket < end)
+    else:
+        buckets = iterate_buckets(start, end, resolution)
+    for bucket in buckets:
+        rollup = rollups.get(bucket)
+        if rollup is None:
+            rollup = rollups[bucket] = new_rollup(ambulance_id, resolution, bucket)
+        duration = (min(end, bucket + length) - max(start, bucket)).total_seconds()
+        rollup.status_duration[status] = rollup.status_duration.get(status, 0.0) + duration
+
+
+def get_points(ambulance_id, start, end):
+    """
+    Timestamp, status, location and id of the updates of ambulance_id in [start, end),
+    with the updates right before and after the range.
+    """
+
+    updates = AmbulanceUpdate.objects.filter(ambulance_id=ambulance_id)
+    fields = ('timestamp', 'status', 'location', 'id')
+
+    previous = updates.filter(timestamp__lt=start).order_by('-timestamp').values_list(*fields).first()
+    following = updates.filter(timestamp__gte=end).order_by('timestamp').values_list(*fields).first()
+    points = list(updates.filter(timestamp__gte=start, timestamp__lt=end)
+                  .order_by('timestamp').values_list(*fields).iterator())
+    if previous is not None:
+        points.insert(0, previous)
+    if following is not None:
+        points.append(following)
+
+    return points
+
+
+def compute_rollups(ambulance_id, resolution, points, start, end):
+    """
+    Compute the rollups of the given resolution of the buckets in [start, end), both bucket boundaries,
+    from points as returned by get_points.
+    The time between consecutive updates counts towards the status of the earlier update,
+    unless longer than ROLLUP_MAX_GAP; the distance between them counts towards the bucket of the later update.
+    Minute rollups are only created for minutes with updates and count the time in status in those
+    minutes only, so that idle periods do not write empty rows; coarser rollups count all of it.
+    """
+
+    sparse = resolution == RollupResolution.m.name
+
+    rollups = {}
+    for (k, (timestamp, status, location, update_id)) in enumerate(points):
+
+        if not start <= timestamp < end:
+            continue
+
+        bucket = floor_bucket(timestamp, resolution)
+        rollup = rollups.get(bucket)
+        if rollup is None:
+            rollup = rollups[bucket] = new_rollup(ambulance_id, resolution, bucket)
+
+        # distance from the previous update
+        if k > 0:
+            rollup.distance += calculate_distance(points[k - 1][2], location)
+
+        # first and last positions
+        if rollup.first_timestamp is None:
+            rollup.first_timestamp = timestamp
+            rollup.first_location = location
+        rollup.last_timestamp = timestamp
+        rollup.last_location = location
+        rollup.count += 1
+        rollup.newest_id = max(rollup.newest_id or 0, update_id)
+
+    # time in status, once the buckets with updates are known
+    for ((last_timestamp, last_status, _, _), (timestamp, _, _, _)) in zip(points[:-1], points[1:]):
+        if timestamp - last_timestamp <= ROLLUP_MAX_GAP:
+            add_status_duration(rollups, ambulance_id, resolution, last_status,
+                                max(last_timestamp, start), min(timestamp, end), sparse)
+
+    return rollups
+
+
+def replace_rollups(ambulance_id, resolution, start, end, rollups):
+    AmbulanceUpdateRollup.objects.filter(ambulance_id=ambulance_id, resolution=resolution,
+                                         bucket__gte=start, bucket__lt=end).delete()
+    AmbulanceUpdateRollup.objects.bulk_create(rollups.values())
+
+
+@transaction.atomic
+def update_rollups(ambulance_id, start, end=None):
+    """
+    Recompute the rollups of ambulance_id affected by updates with timestamps in [start, end].
+    Returns the number of minute buckets computed.
+    """
+
+    if end is None:
+        end = start
+
+    # the intervals from the update before and to the update after the range change too
+    updates = AmbulanceUpdate.objects.filter(ambulance_id=ambulance_id)
+    previous = updates.filter(timestamp__lt=start).order_by('-timestamp').values_list('timestamp', flat=True).first()
+    following = updates.filter(timestamp__gt=end).order_by('timestamp').values_list('timestamp', flat=True).first()
+
+    if previous is not None and start - previous <= ROLLUP_MAX_GAP:
+        start = previous
+    if following is not None and following - end <= ROLLUP_MAX_GAP:
+        end = following
+
+    # buckets of every resolution containing the range, computed from the same updates
+    coarsest = list(RESOLUTIONS)[-1]
+    start = floor_bucket(start, coarsest)
+    end = floor_bucket(end, coarsest) + RESOLUTIONS[coarsest]
+    points = get_points(ambulance_id, start, end)
+
+    count = 0
+    for resolution in RESOLUTIONS:
+        rollups = compute_rollups(ambulance_id, resolution, points, start, end)
+        replace_rollups(ambulance_id, resolution, start, end, rollups)
+        if resolution == RollupResolution.m.name:
+            count = len(rollups)
+
+    return count
+
+
+def flush_rollups():
+
+    # retrieve and reset pending ranges
+    pending = getattr(_pending, 'ranges', None)
+    _pending.ranges = None
+    if not pending:
+        # already flushed
+        return
+
+    for (ambulance_id, (start, end)) in pending.items():
+        try:
+            update_rollups(ambulance_id, start, end)
+        except Exception as e:
+            logger.warning('Could not update rollups of ambulance {}: {}'.format(ambulance_id, e))
+
+
+def schedule_rollups(ambulance_id, start, end=None):
+    """
+    Schedule the rollups of ambulance_id affected by updates in [start, end] to be updated
+    once, when the current transaction commits.
+    """
+
+    if not ROLLUP_ON_INGEST:
+        return
+
+    if end is None:
+        end = start
+
+    # collect ranges
+    pending = getattr(_pending, 'ranges', None)
+    if pending is None or not is_on_commit_pending(_pending.flush):
+        # nothing pending, or left over from a transaction that rolled back
+        pending = _pending.ranges = {}
+        _pending.flush = partial(flush_rollups)
+    if ambulance_id in pending:
+        (current_start, current_end) = pending[ambulance_id]
+        pending[ambulance_id] = (min(start, current_start), max(end, current_end))
+    else:
+        pending[ambulance_id] = (start, end)
+
+    # only the first callback to run finds pending ranges to flush
+    transaction.on_commit(_pending.flush)
+
+
+def get_rollup_resolution(start, end, precision):
+    """
+    Coarsest resolution whose buckets are neither longer than precision nor than the range [start, end),
+    or None if raw updates are needed.
+    """
+
+    resolution = None
+    for (name, length) in RESOLUTIONS.items():
+        if length <= precision and length <= end - start:
+            resolution = name
+    return resolution
+
+
+def get_rollups(ambulance_ids, start, end, precision):
+    """
+    Rollups of the ambulances in [start, end) at the coarsest resolution satisfying precision,
+    a timedelta, ordered by ambulance and bucket. Returns None if no resolution is fine enough.
+    """
+
+    resolution = get_rollup_resolution(start, end, precision)
+    if resolution is None:
+        return None
+
+    return AmbulanceUpdateRollup.objects \
+        .filter(ambulance_id__in=ambulance_ids, resolution=resolution,
+                bucket__gte=floor_bucket(start, resolution), bucket__lt=end) \
+        .order_by('ambulance_id', 'bucket')
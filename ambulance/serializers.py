@@ -9,10 +9,12 @@ from rest_framework.exceptions import PermissionDenied
 from drf_extra_fields.geo_fields import PointField
 
 from login.permissions import get_permissions
-from emstrack.latlon import calculate_orientation
+from emstrack.latlon_batch import calculate_orientations, point_coordinates
 
-from .models import Ambulance, AmbulanceUpdate, Call, Location, AmbulanceCall, Patient, CallStatus, Waypoint, \
+from .models import Ambulance, AmbulanceUpdate, AmbulanceUpdateRollup, Call, Location, AmbulanceCall, Patient, CallStatus, Waypoint, \
     LocationType, CallPriorityClassification, CallPriorityCode, CallRadioCode, CallNote
+from .locations import get_or_create_location
+from .odometer import advance
 
 logger = logging.getLogger(__name__)
 
@@ -74,16 +76,20 @@ class AmbulanceSerializer(serializers.ModelSerializer):
 
 class AmbulanceUpdateListSerializer(serializers.ListSerializer):
 
-    def create(self, validated_data):
+    def create(self, validated_data, update_ambulance=True):
+        """
+        Store updates; the last one is saved to the ambulance unless update_ambulance is False,
+        e.g. for a backlog older than the current ambulance state.
+        """
 
         def process_update(update, current):
 
-            # calculate orientation?
-            if ('orientation' not in update and
-                    'location' in update and
-                    update['location'] != current['location']):
-
-                    current['orientation'] = calculate_orientation(current['location'], update['location'])
+            # calculate orientation? postponed to calculate all at once
+            calculate = ('orientation' not in update and
+                         'location' in update and
+                         update['location'] != current['location'])
+            if calculate:
+                orientations.append((current, current['location'], update['location']))
 
             # clear timestamp
             # if update has no timestamp, save should create one
@@ -92,7 +98,7 @@ class AmbulanceUpdateListSerializer(serializers.ListSerializer):
             # update data
             current.update(**update)
 
-            return current
+            return calculate
 
         # process updates inside a transaction
         try:
@@ -100,7 +106,6 @@ class AmbulanceUpdateListSerializer(serializers.ListSerializer):
             with transaction.atomic():
 
                 # loop through updates
-                instances = []
                 n = len(validated_data)
 
                 # short return
@@ -113,27 +118,50 @@ class AmbulanceUpdateListSerializer(serializers.ListSerializer):
                 data = {k: getattr(ambulance, k) for k in ('capability', 'status',
                                                            'orientation', 'location', 'comment')}
 
-                # loop through
-                for k in range(0, n-1):
+                # loop through, keeping a copy of the data of every update
+                updates = []
+                orientations = []
+                inherited = []
+                for k in range(0, n):
 
                     # process update
-                    data = process_update(validated_data[k], data)
-
-                    # create update object
-                    obj = AmbulanceUpdate(**data)
-                    obj.save()
-
-                    # append to objects list
-                    instances.append(obj)
+                    data = dict(data)
+                    calculated = process_update(validated_data[k], data)
+                    updates.append(data)
+                    inherited.append(not calculated and 'orientation' not in validated_data[k])
+
+                # calculate orientations at once
+                if orientations:
+                    (longitude1, latitude1) = point_coordinates(o[1] for o in orientations)
+                    (longitude2, latitude2) = point_coordinates(o[2] for o in orientations)
+                    values = calculate_orientations(longitude1, latitude1, longitude2, latitude2)
+                    for ((current, _, _), orientation) in zip(orientations, values):
+                        current['orientation'] = float(orientation)
+
+                    # carry calculated orientations over to the following updates
+                    for k in range(1, n):
+                        if inherited[k]:
+                            updates[k]['orientation'] = updates[k - 1]['orientation']
+
+                # create history only
+                if not update_ambulance:
+                    return AmbulanceUpdate.bulk_insert([AmbulanceUpdate(**data) for data in updates])
+
+                # create update objects, without the last one, in one statement
+                instances = [AmbulanceUpdate(**data) for data in updates[:-1]]
+                AmbulanceUpdate.bulk_insert(instances)
 
                 # on last update, update ambulance instead
-
-                # process last update
-                data = process_update(validated_data[-1], data)
-
                 # save to ambulance will automatically create update
-                for attr, value in data.items():
+                for attr, value in updates[-1].items():
                     setattr(ambulance, attr, value)
+
+                # continue the odometer from the updates just inserted
+                if instances:
+                    previous = max(instances, key=lambda update: update.timestamp)
+                    (ambulance.odometer, ambulance.moving_time) = advance(previous.location, previous.timestamp,
+                                                                          previous.odometer, previous.moving_time,
+                                                                          ambulance.location, ambulance.timestamp)
                 ambulance.save()
 
                 # append to objects list
@@ -179,6 +207,19 @@ class AmbulanceUpdateCompactSerializer(serializers.ModelSerializer):
         read_only_fields = ['updated_by_username', 'updated_on']
 
 
+class AmbulanceUpdateRollupSerializer(serializers.ModelSerializer):
+
+    first_location = PointField(required=False)
+    last_location = PointField(required=False)
+
+    class Meta:
+        model = AmbulanceUpdateRollup
+        fields = ['ambulance_id', 'resolution', 'bucket',
+                  'first_location', 'first_timestamp', 'last_location', 'last_timestamp',
+                  'distance', 'status_duration', 'count']
+        read_only_fields = fields
+
+
 # Location serializers
 
 class LocationSerializer(serializers.ModelSerializer):
@@ -265,7 +306,7 @@ class WaypointSerializer(serializers.ModelSerializer):
 
                 # create location
                 if location['type'] in (LocationType.i.name, LocationType.w.name):
-                    location = Location.objects.create(**location, updated_by=user)
+                    location = get_or_create_location(location, user)
 
                 else:
                     raise serializers.ValidationError("Cannot create location of type '{}'".format(location['type']))
@@ -330,10 +371,15 @@ class WaypointSerializer(serializers.ModelSerializer):
                                                           "'{}' to type '{}'".format(instance.location.type,
                                                                                      location['type']))
 
+                    # locations may be shared by waypoints, copy before updating
+                    if Waypoint.objects.filter(location=instance.location).exclude(id=instance.id).exists():
+                        instance.location.pk = instance.location.id = None
+
                     # update location
                     for field in location:
                         setattr(instance.location, field, location[field])
                     instance.location.save()
+                    instance.location_id = instance.location.id
 
                 else:
                     raise serializers.ValidationError("Cannot update location of type '{}'".format(location['type']))
@@ -498,8 +544,8 @@ class CallSerializer(serializers.ModelSerializer):
                         elif location['type'] == LocationType.h.name:
                             raise serializers.ValidationError('Hospitals must be created before using as waypoints')
                         elif location['type'] == LocationType.i.name or location['type'] == LocationType.w.name:
-                            # TODO: check to see if a close by waypoint already exists to contain proliferation
-                            location = Location.objects.create(**location, updated_by=user)
+                            # reuse a close by location to contain proliferation
+                            location = get_or_create_location(location, user)
                         else:
                             raise serializers.ValidationError("Invalid waypoint '{}'".format(location))
                     # add waypoint
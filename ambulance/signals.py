@@ -1,6 +1,6 @@
 import logging
 
-from django.db.models.signals import post_save, m2m_changed
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -8,7 +8,10 @@ from django.utils.translation import ugettext_lazy as _
 
 from emstrack.sms import client
 
-from .models import Call
+from hospital.models import Hospital
+
+from .geofence import geofence_changed, get_fence_state
+from .models import Call, AmbulanceCall, Location, Waypoint
 
 logger = logging.getLogger(__name__)
 
@@ -42,3 +45,28 @@ def user_groups_changed_handler(sender, instance, action,
         # notify users
         for user in users:
             client.notify_user(user, message)
+
+
+# Add signal to reload the geofence index of mqttclient when the locations it watches change
+@receiver(post_init, sender=Location)
+@receiver(post_init, sender=Hospital)
+@receiver(post_init, sender=Waypoint)
+@receiver(post_init, sender=AmbulanceCall)
+def geofence_loaded_handler(sender, instance, **kwargs):
+    instance._fence_state = get_fence_state(instance)
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_save, sender=Hospital)
+@receiver(post_save, sender=Waypoint)
+@receiver(post_save, sender=AmbulanceCall)
+def geofence_saved_handler(sender, instance, created, **kwargs):
+    geofence_changed(instance, created=created)
+
+
+@receiver(post_delete, sender=Location)
+@receiver(post_delete, sender=Hospital)
+@receiver(post_delete, sender=Waypoint)
+@receiver(post_delete, sender=AmbulanceCall)
+def geofence_deleted_handler(sender, instance, **kwargs):
+    geofence_changed(instance, deleted=True)
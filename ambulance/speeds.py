@@ -0,0 +1,297 @@
+import logging
+import math
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F, FloatField, Func
+from django.utils import timezone
+
+from emstrack import latlon_batch
+from emstrack.latlon import earth_radius
+
+from .heatmap import cell_size
+from .mileage import MAXIMUM_SPEED, MOVING_SPEED_THRESHOLD, TIME_INTERVAL
+from .models import AmbulanceUpdate, TravelSpeed
+
+from environs import Env
+
+env = Env()
+logger = logging.getLogger(__name__)
+
+# Travel speeds are learned offline from consecutive ambulance updates: the distance and time of each
+# pair of points close enough in time and moving are added to the grid cell of their midpoint and the
+# hour of the week of the first point. Travel times are estimated by sampling the straight line between
+# two points and adding the time to cross each piece at the speed of its cell, or of the hour of the
+# week where the cell has too little data, or at a default speed.
+
+# grid level of the cells, as in ambulance.heatmap; 14 is about 2.4km
+SPEED_LEVEL = env.int('DJANGO_SPEED_LEVEL', default=14)
+
+# default speed, km/h
+SPEED_DEFAULT = env.float('DJANGO_SPEED_DEFAULT', default=40)
+
+# ratio of distance driven to straight-line distance
+SPEED_DETOUR = env.float('DJANGO_SPEED_DETOUR', default=1.3)
+
+# seconds allotted to estimating travel times in a request
+SPEED_BUDGET = env.float('DJANGO_SPEED_BUDGET', default=0.05)
+
+# seconds before checking for a newer model
+SPEED_RELOAD = env.int('DJANGO_SPEED_RELOAD', default=300)
+
+# seconds driven in a cell and hour for its speed to be used
+MINIMUM_TIME = 60
+
+# pieces a line is split into, at most
+MAXIMUM_SAMPLES = 64
+
+# travel times estimated at a time between checks of the budget
+BATCH_SIZE = 16
+
+HOURS_PER_WEEK = 7 * 24
+
+# the epoch was a Thursday
+EPOCH_HOUR_OF_WEEK = 3 * 24
+
+METERS_PER_DEGREE = math.radians(earth_radius)
+
+
+def hours_of_week(timestamps, offset=0):
+    """
+    Hour of the week from Monday 00:00 of timestamps in seconds since the epoch, offset by offset seconds.
+    """
+    hours = np.floor_divide(np.asarray(timestamps, dtype=float) + offset, 3600).astype(np.int64)
+    return (hours + EPOCH_HOUR_OF_WEEK) % HOURS_PER_WEEK
+
+
+def hour_of_week(when):
+    """
+    Hour of the week from Monday 00:00 of when, in local time.
+    """
+    when = timezone.localtime(when)
+    return when.weekday() * 24 + when.hour
+
+
+def cell_keys(x, y):
+    # x and y fit in 21 bits for all levels up to heatmap.MAXIMUM_LEVEL
+    return (np.asarray(x, dtype=np.int64) << 21) | np.asarray(y, dtype=np.int64)
+
+
+def track_speeds(longitude, latitude, timestamps, level=SPEED_LEVEL, offset=0):
+    """
+    Cells, hours of the week, distances and times of the moving pairs of consecutive points of a track
+    in ascending order of timestamps, in seconds.
+    """
+
+    longitude = np.asarray(longitude, dtype=float)
+    latitude = np.asarray(latitude, dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+
+    distance = latlon_batch.track_distances(longitude, latitude)
+    interval = np.diff(timestamps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = distance / interval
+    moving = (interval > 0) & (interval <= TIME_INTERVAL[0]) & \
+             (speed > MOVING_SPEED_THRESHOLD) & (speed <= MAXIMUM_SPEED)
+
+    size = cell_size(level)
+    x = np.floor(((longitude[:-1] + longitude[1:]) / 2 + 180.0) / size).astype(np.int64)
+    y = np.floor(((latitude[:-1] + latitude[1:]) / 2 + 90.0) / size).astype(np.int64)
+    hours = hours_of_week(timestamps[:-1], offset)
+
+    return x[moving], y[moving], hours[moving], distance[moving], interval[moving]
+
+
+class SpeedTotals:
+    """
+    Distance and time driven by cell and hour of the week.
+    """
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.distance = np.empty((0, HOURS_PER_WEEK))
+        self.time = np.empty((0, HOURS_PER_WEEK))
+
+    def __len__(self):
+        return self.keys.size
+
+    def add(self, x, y, hours, distance, seconds):
+        """
+        Accumulate the pieces of track returned by track_speeds.
+        """
+
+        if len(distance) == 0:
+            return
+
+        (keys, inverse) = np.unique(np.concatenate((self.keys, cell_keys(x, y))), return_inverse=True)
+        distances = np.zeros((keys.size, HOURS_PER_WEEK))
+        times = np.zeros((keys.size, HOURS_PER_WEEK))
+
+        # existing totals, then the new pieces
+        previous = inverse[:self.keys.size]
+        distances[previous] = self.distance
+        times[previous] = self.time
+        new = inverse[self.keys.size:]
+        np.add.at(distances, (new, hours), distance)
+        np.add.at(times, (new, hours), seconds)
+
+        (self.keys, self.distance, self.time) = (keys, distances, times)
+
+    def cells(self):
+        """
+        Cells (x, y) and their distances and times by hour of the week.
+        """
+        for (key, distance, seconds) in zip(self.keys.tolist(), self.distance, self.time):
+            yield (key >> 21, key & ((1 << 21) - 1)), distance, seconds
+
+
+def compute_speeds(ambulance_ids, start, end, level=SPEED_LEVEL):
+    """
+    Totals of the updates of the ambulances in [start, end), read by ambulance and day.
+    """
+
+    totals = SpeedTotals()
+    for ambulance_id in ambulance_ids:
+        day = start
+        while day < end:
+
+            # hours are counted in local time, whose offset may change from day to day
+            offset = timezone.localtime(day).utcoffset().total_seconds()
+            rows = AmbulanceUpdate.objects \
+                .filter(ambulance_id=ambulance_id,
+                        timestamp__gte=day, timestamp__lt=min(day + timedelta(days=1), end)) \
+                .annotate(longitude=Func(F('location'), function='ST_X', output_field=FloatField()),
+                          latitude=Func(F('location'), function='ST_Y', output_field=FloatField())) \
+                .order_by('timestamp', 'id') \
+                .values_list('longitude', 'latitude', 'timestamp')
+
+            rows = list(rows)
+            if len(rows) > 1:
+                (longitude, latitude, timestamps) = zip(*rows)
+                totals.add(*track_speeds(longitude, latitude, [t.timestamp() for t in timestamps], level, offset))
+
+            day += timedelta(days=1)
+
+    return totals
+
+
+@transaction.atomic
+def save_speeds(totals, level=SPEED_LEVEL):
+    """
+    Replace the speeds of level with totals.
+    """
+
+    TravelSpeed.objects.filter(level=level).delete()
+    TravelSpeed.objects.bulk_create([
+        TravelSpeed(level=level, x=x, y=y,
+                    distance=np.round(distance, 1).tolist(), time=np.round(seconds, 1).tolist())
+        for ((x, y), distance, seconds) in totals.cells()
+    ], batch_size=1000)
+
+    return len(totals)
+
+
+class SpeedModel:
+    """
+    Speeds in m/s by cell and hour of the week, with the speed of each hour of the week over all cells
+    where a cell has too little data, and a default speed where no hour has.
+    """
+
+    def __init__(self, level=SPEED_LEVEL, keys=(), distance=(), seconds=(), default=SPEED_DEFAULT / 3.6):
+
+        self.level = level
+        self.size = cell_size(level)
+        self.keys = np.asarray(keys, dtype=np.int64)
+        distance = np.asarray(distance, dtype=float).reshape(-1, HOURS_PER_WEEK)
+        seconds = np.asarray(seconds, dtype=float).reshape(-1, HOURS_PER_WEEK)
+
+        # ordered for lookups by binary search
+        order = np.argsort(self.keys)
+        (self.keys, distance, seconds) = (self.keys[order], distance[order], seconds[order])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total = seconds.sum(axis=0)
+            hourly = np.where(total >= MINIMUM_TIME, distance.sum(axis=0) / total, default)
+            self.speeds = np.where(seconds >= MINIMUM_TIME, distance / seconds, hourly[np.newaxis, :])
+        self.hourly = hourly
+
+    @classmethod
+    def load(cls, level=SPEED_LEVEL):
+        rows = TravelSpeed.objects.filter(level=level).values_list('x', 'y', 'distance', 'time')
+        (x, y, distance, seconds) = zip(*rows) if rows else ((), (), (), ())
+        return cls(level, cell_keys(x, y), distance, seconds)
+
+    def lookup(self, longitude, latitude, hour):
+        """
+        Speeds at points in the given hour of the week.
+        """
+
+        keys = cell_keys(np.floor((np.asarray(longitude) + 180.0) / self.size),
+                         np.floor((np.asarray(latitude) + 90.0) / self.size))
+        if self.keys.size == 0:
+            return np.full(keys.shape, self.hourly[hour])
+
+        index = np.clip(np.searchsorted(self.keys, keys), 0, self.keys.size - 1)
+        return np.where(self.keys[index] == keys, self.speeds[index, hour], self.hourly[hour])
+
+    def travel_times(self, longitude, latitude, longitude0, latitude0, hour):
+        """
+        Seconds from each point to the point at longitude0 and latitude0 in the given hour of the week.
+        """
+
+        longitude = np.asarray(longitude, dtype=float)
+        latitude = np.asarray(latitude, dtype=float)
+        distance = latlon_batch.distances_to(longitude, latitude, longitude0, latitude0)
+        if distance.size == 0:
+            return distance
+
+        # midpoints of pieces about as long as a cell, the same number for every line
+        pieces = int(np.clip(np.ceil(distance.max() / (self.size * METERS_PER_DEGREE)), 1, MAXIMUM_SAMPLES))
+        fraction = (np.arange(pieces) + 0.5) / pieces
+        samples = self.lookup(longitude[:, np.newaxis] + fraction * (longitude0 - longitude[:, np.newaxis]),
+                              latitude[:, np.newaxis] + fraction * (latitude0 - latitude[:, np.newaxis]),
+                              hour)
+
+        return SPEED_DETOUR * (distance / pieces) * np.sum(1 / samples, axis=1)
+
+
+_model = None
+_model_loaded = 0.0
+_model_lock = threading.Lock()
+
+
+def get_speed_model():
+    """
+    The speed model, reloaded from the database every SPEED_RELOAD seconds.
+    """
+    global _model, _model_loaded
+    with _model_lock:
+        if _model is None or time.monotonic() - _model_loaded > SPEED_RELOAD:
+            _model = SpeedModel.load()
+            _model_loaded = time.monotonic()
+        return _model
+
+
+def estimate_travel_times(points, longitude, latitude, when=None, budget=SPEED_BUDGET):
+    """
+    Seconds to drive from each point to longitude and latitude starting at when, by default now.
+    Points are estimated in batches in order until budget seconds have elapsed; the rest are None.
+    """
+
+    deadline = time.monotonic() + budget
+    model = get_speed_model()
+    hour = hour_of_week(when or timezone.now())
+    (longitudes, latitudes) = latlon_batch.point_coordinates(points)
+
+    times = []
+    for start in range(0, len(longitudes), BATCH_SIZE):
+        if times and time.monotonic() > deadline:
+            logger.debug('estimate_travel_times: budget exceeded after {} points'.format(len(times)))
+            break
+        times.extend(model.travel_times(longitudes[start:start + BATCH_SIZE], latitudes[start:start + BATCH_SIZE],
+                                        longitude, latitude, hour).tolist())
+
+    return times + [None] * (len(longitudes) - len(times))
@@ -1,5 +1,7 @@
+import gzip
 import logging
 import math
+from datetime import timedelta
 
 from django.core.exceptions import PermissionDenied
 from django.db import IntegrityError, transaction
@@ -963,6 +965,53 @@ class TestAmbulanceUpdates(TestSetup):
         client.logout()
 
 
+class TestAmbulanceUpdatesSimplify(TestSetup):
+
+    def test(self):
+
+        # straight track of a1 with one status change, one update per second
+        timestamp = (timezone.now() - timedelta(hours=1)).replace(second=0, microsecond=0)
+        for k in range(20):
+            AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                           status=AmbulanceStatus.PB.name if k < 10 else AmbulanceStatus.AP.name,
+                                           location=dict2point({'latitude': 32.0, 'longitude': -117.0 + k * 1e-4}),
+                                           timestamp=timestamp + timedelta(seconds=k),
+                                           updated_by=self.u1)
+        filter_range = '{},{}'.format(date2iso(timestamp), date2iso(timestamp + timedelta(seconds=19)))
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # first, last and status change are kept
+        response = client.get('/en/api/ambulance/{}/updates/'.format(self.a1.id),
+                              {'filter': filter_range, 'simplify': 5},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual([u['status'] for u in result],
+                         [AmbulanceStatus.AP.name, AmbulanceStatus.AP.name, AmbulanceStatus.PB.name])
+
+        # one update every 5 seconds, plus status change and last
+        response = client.get('/en/api/ambulance/{}/updates/'.format(self.a1.id),
+                              {'filter': filter_range, 'bucket': 5},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual(len(result), 5)
+
+        # invalid parameters
+        response = client.get('/en/api/ambulance/{}/updates/'.format(self.a1.id),
+                              {'bucket': 'x'},
+                              follow=True)
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+
 class TestAmbulanceBulkUpdates(TestSetup):
 
     def test(self):
@@ -1158,3 +1207,195 @@ class TestAmbulanceBulkUpdates(TestSetup):
         # logout
         client.logout()
 
+
+class TestAmbulanceBulkInsert(TestSetup):
+
+    def test(self):
+
+        timestamp = timezone.now()
+        copy_threshold = AmbulanceUpdate.copy_threshold
+        try:
+            for threshold in (1000, 1):
+
+                # insert with bulk_create, then with COPY
+                AmbulanceUpdate.copy_threshold = threshold
+                updates = [AmbulanceUpdate(ambulance=self.a1, capability=self.a1.capability,
+                                           status=AmbulanceStatus.PB.name,
+                                           orientation=10.0 * k,
+                                           location=dict2point({'latitude': 32.0 + k * 1e-4, 'longitude': -117.0}),
+                                           timestamp=timestamp + timedelta(seconds=k),
+                                           comment='comment, "quoted"' if k % 2 else '',
+                                           updated_by=self.u1)
+                           for k in range(10)]
+                AmbulanceUpdate.bulk_insert(updates)
+
+                # ids are set and rows are identical
+                for update in updates:
+                    self.assertIsNotNone(update.id)
+                    stored = AmbulanceUpdate.objects.get(id=update.id)
+                    for field in ('ambulance_id', 'capability', 'status', 'orientation',
+                                  'timestamp', 'comment', 'updated_by_id', 'updated_on'):
+                        self.assertEqual(getattr(stored, field), getattr(update, field))
+                    self.assertEqual(stored.location, update.location)
+
+        finally:
+            AmbulanceUpdate.copy_threshold = copy_threshold
+
+
+class TestAmbulanceUpload(TestSetup):
+
+    def test(self):
+
+        # 20 updates of a1, one per second
+        timestamp = timezone.now() + timedelta(minutes=1)
+        body = ''.join(json.dumps({'status': AmbulanceStatus.PB.name,
+                                   'location': {'latitude': 32.0 + k * 1e-4, 'longitude': -117.0},
+                                   'timestamp': date2iso(timestamp + timedelta(seconds=k))}) + '\n'
+                       for k in range(20))
+        compressed = gzip.compress(body.encode('utf-8'))
+        url = '/en/api/ambulance/{}/upload/'.format(self.a1.id)
+
+        def count():
+            return AmbulanceUpdate.objects.filter(ambulance=self.a1, timestamp__gte=timestamp).count()
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        from ambulance.viewsets import AmbulanceViewSet
+        chunk_size = AmbulanceViewSet.upload_chunk_size
+        try:
+            AmbulanceViewSet.upload_chunk_size = 5
+
+            # interrupted upload
+            response = client.post(url, data=compressed[:len(compressed) // 2],
+                                   content_type='application/x-ndjson', HTTP_CONTENT_ENCODING='gzip')
+            self.assertEqual(response.status_code, 400)
+            result = response.json()
+            self.assertFalse(result['complete'])
+            self.assertEqual(count(), result['created'])
+
+            # resume
+            response = client.post(url, data=compressed,
+                                   content_type='application/x-ndjson', HTTP_CONTENT_ENCODING='gzip')
+            self.assertEqual(response.status_code, 200)
+            result = response.json()
+            self.assertTrue(result['complete'])
+            self.assertEqual(result['chunks'], 4)
+            self.assertEqual(result['created'] + result['skipped'], 20)
+            self.assertEqual(count(), 20)
+
+            # current state is the last update
+            a = Ambulance.objects.get(id=self.a1.id)
+            self.assertEqual(a.timestamp, timestamp + timedelta(seconds=19))
+
+            # uploading again stores nothing
+            response = client.post(url, data=body, content_type='application/x-ndjson')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['skipped'], 20)
+            self.assertEqual(count(), 20)
+
+            # updates without timestamps are rejected
+            response = client.post(url, data='{"status": "AV"}\n', content_type='application/x-ndjson')
+            self.assertEqual(response.status_code, 400)
+
+        finally:
+            AmbulanceViewSet.upload_chunk_size = chunk_size
+
+        # logout
+        client.logout()
+
+    def test_plain(self):
+
+        # 10 updates of a2, uncompressed; the last two share their timestamps with others
+        timestamp = timezone.now() + timedelta(minutes=1)
+        updates = [{'status': AmbulanceStatus.PB.name,
+                    'location': {'latitude': 32.0 + k * 1e-4, 'longitude': -117.0},
+                    'timestamp': date2iso(timestamp + timedelta(seconds=k))} for k in range(8)]
+        updates += [dict(updates[k], location={'latitude': 33.0, 'longitude': -117.0}) for k in range(2)]
+        body = ''.join(json.dumps(update) + '\n' for update in updates)
+        url = '/en/api/ambulance/{}/upload/'.format(self.a2.id)
+
+        def count():
+            return AmbulanceUpdate.objects.filter(ambulance=self.a2, timestamp__gte=timestamp).count()
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # updates at the same time but elsewhere are not duplicates
+        response = client.post(url, data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertTrue(result['complete'])
+        self.assertEqual(result['lines'], 10)
+        self.assertEqual(result['created'], 10)
+        self.assertEqual(count(), 10)
+
+        # uploading again stores nothing
+        response = client.post(url, data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['skipped'], 10)
+        self.assertEqual(count(), 10)
+
+        # logout
+        client.logout()
+
+
+class TestAmbulanceUpdatesKeyset(TestSetup):
+
+    def test(self):
+
+        # 10 updates of a1, two with the same timestamp
+        timestamp = (timezone.now() - timedelta(hours=1)).replace(microsecond=0)
+        for k in range(10):
+            AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                           status=AmbulanceStatus.PB.name,
+                                           location=dict2point({'latitude': 32.0, 'longitude': -117.0 + k * 1e-4}),
+                                           timestamp=timestamp + timedelta(seconds=min(k, 8)),
+                                           updated_by=self.u1)
+
+        # two active intervals, combined in a single query
+        filter_range = '{},{},{},{}'.format(date2iso(timestamp), date2iso(timestamp + timedelta(seconds=2)),
+                                            date2iso(timestamp + timedelta(seconds=5)),
+                                            date2iso(timestamp + timedelta(seconds=8)))
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        url = '/en/api/ambulance/{}/updates/'.format(self.a1.id)
+        response = client.get(url, {'filter': filter_range}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        answer = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual(len(answer), 8)
+        self.assertEqual([u['timestamp'] for u in answer],
+                         sorted([u['timestamp'] for u in answer], reverse=True))
+
+        # follow the cursor
+        result = []
+        response = client.get(url, {'filter': filter_range, 'cursor': '', 'page_size': 3}, follow=True)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertNotIn('count', page)
+            result += page['results']
+            if not page['has_more']:
+                self.assertIsNone(page['next'])
+                break
+            self.assertEqual(len(page['results']), 3)
+            response = client.get(page['next'], follow=True)
+        self.assertEqual(result, answer)
+
+        # invalid cursor
+        response = client.get(url, {'cursor': 'x'}, follow=True)
+        self.assertEqual(response.status_code, 404)
+
+        # logout
+        client.logout()
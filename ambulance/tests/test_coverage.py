@@ -0,0 +1,126 @@
+import numpy as np
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.test import Client, SimpleTestCase
+
+from ambulance import coverage
+from ambulance.coverage import CoverageEngine, CoverageGrid, get_coverage
+from ambulance.models import Ambulance, AmbulanceStatus
+
+from emstrack.latlon_batch import distance_matrix
+
+from login.tests.setup_data import TestSetup
+
+
+class TestCoverageEngine(SimpleTestCase):
+
+    def test_incremental(self):
+
+        grid = CoverageGrid((-117.3, 32.5, -116.9, 32.9), 1000)
+        self.assertEqual(grid.size, grid.rows * grid.columns)
+
+        # random moves, arrivals and departures match distances computed from scratch
+        engine = CoverageEngine(grid)
+        rng = np.random.RandomState(0)
+        positions = {}
+        for step in range(200):
+            id = rng.randint(20)
+            if rng.rand() < 0.2:
+                positions.pop(id, None)
+            else:
+                positions[id] = (-117.3 + 0.4 * rng.rand(), 32.5 + 0.4 * rng.rand())
+            engine.update(dict(positions))
+
+            if step % 20 == 0:
+                ids = sorted(positions)
+                distances = distance_matrix(grid.longitude, grid.latitude,
+                                            [positions[id][0] for id in ids], [positions[id][1] for id in ids])
+                self.assertEqual(sorted(engine.ids), ids)
+                np.testing.assert_allclose(engine.nearest_distances(), distances.min(axis=1), rtol=1e-5)
+                np.testing.assert_allclose(engine.nearest_distances(ids[:2]), distances[:, 2:].min(axis=1),
+                                           rtol=1e-5)
+
+        # unchanged positions are not recomputed
+        self.assertEqual(engine.update(dict(positions)), 0)
+
+        # no ambulances
+        engine.update({})
+        self.assertFalse(engine.covered(10000).any())
+
+    def test_grid(self):
+
+        with self.assertRaises(ValueError):
+            CoverageGrid((-117, 33, -118, 32), 500)
+        with self.assertRaises(ValueError):
+            CoverageGrid((-120, 30, -110, 40), 100)
+
+
+class TestCoverage(TestSetup):
+
+    def setUp(self):
+
+        coverage._engines.clear()
+        self.bbox = (-117.2, 32.6, -117.0, 32.8)
+        for (ambulance, longitude) in ((self.a1, -117.15), (self.a2, -117.05)):
+            Ambulance.objects.filter(id=ambulance.id).update(location=Point(longitude, 32.7, srid=4326),
+                                                             status=AmbulanceStatus.AV.name, active=True)
+        Ambulance.objects.filter(id=self.a3.id).update(status=AmbulanceStatus.PB.name)
+
+    def test_get_coverage(self):
+
+        result = get_coverage(self.bbox, 5000, 500)
+        self.assertEqual(result['ambulances'], sorted([self.a1.id, self.a2.id]))
+        self.assertGreater(result['coverage'], 0.5)
+        self.assertLess(result['coverage'], 1.0)
+        self.assertEqual(result['coverage'], result['baseline'])
+        self.assertEqual(len(result['uncovered']['longitude']),
+                         round(result['cells'] * (1 - result['coverage'])))
+
+        # what if a1 is out of service
+        without = get_coverage(self.bbox, 5000, 500, exclude=[self.a1.id])
+        self.assertEqual(without['baseline'], result['coverage'])
+        self.assertLess(without['coverage'], result['coverage'])
+        self.assertEqual(without['ambulances'], [self.a2.id])
+
+        # a1 is busy
+        Ambulance.objects.filter(id=self.a1.id).update(status=AmbulanceStatus.PB.name)
+        self.assertEqual(get_coverage(self.bbox, 5000, 500)['coverage'], without['coverage'])
+
+        # only a2 is readable
+        Ambulance.objects.filter(id=self.a1.id).update(status=AmbulanceStatus.AV.name)
+        self.assertEqual(get_coverage(self.bbox, 5000, 500, ambulance_ids={self.a2.id})['coverage'],
+                         without['coverage'])
+
+    def test_api(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/en/api/ambulance/coverage/',
+                              {'bbox': ','.join(str(value) for value in self.bbox),
+                               'minutes': 10, 'cell': 1000, 'exclude': self.a2.id})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertAlmostEqual(result['radius'], 10 * coverage.COVERAGE_SPEED * 1000 / 60)
+        self.assertEqual(result['ambulances'], [self.a1.id])
+        self.assertLessEqual(result['coverage'], result['baseline'])
+
+        response = client.get('/en/api/ambulance/coverage/', {'bbox': '-180,-90,180,90', 'cell': 10})
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/en/api/ambulance/coverage/', {'radius': -1})
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+        # login as testuser1, who is not a dispatcher
+        client.login(username='testuser1', password='top_secret')
+
+        response = client.get('/en/api/ambulance/coverage/')
+        self.assertEqual(response.status_code, 403)
+
+        # logout
+        client.logout()
@@ -0,0 +1,123 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.test import Client
+
+from ambulance.models import AmbulanceStatus, AmbulanceUpdate
+from ambulance.export import FIELDS
+
+from login.tests.setup_data import TestSetup
+
+
+class TestExport(TestSetup):
+
+    def setUp(self):
+
+        # three updates of a1 and two of a3
+        self.t0 = datetime(2019, 6, 1, 10, tzinfo=dt_timezone.utc)
+        for (ambulance, count) in ((self.a1, 3), (self.a3, 2)):
+            for k in range(count):
+                AmbulanceUpdate.objects.create(ambulance=ambulance, capability=ambulance.capability,
+                                               status=AmbulanceStatus.PB.name,
+                                               location=Point(-117.0 + k * 1e-3, 32.0),
+                                               timestamp=self.t0 + timedelta(seconds=k),
+                                               updated_by=self.u1)
+
+    def export(self, client, output, **params):
+        response = client.get('/en/api/ambulance/export/',
+                              {'output': output, 'start': self.t0.isoformat(),
+                               'end': (self.t0 + timedelta(minutes=1)).isoformat(), **params})
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_api(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # ndjson
+        rows = [json.loads(line) for line in self.export(client, 'ndjson').splitlines()]
+        self.assertEqual([row['ambulance_id'] for row in rows], [self.a1.id] * 3 + [self.a3.id] * 2)
+        self.assertAlmostEqual(rows[1]['longitude'], -116.999)
+        self.assertEqual(rows[1]['timestamp'], (self.t0 + timedelta(seconds=1)).isoformat())
+        self.assertEqual(rows[0]['updated_by_username'], self.u1.username)
+
+        # selected ambulances
+        rows = self.export(client, 'ndjson', ambulance='{}'.format(self.a3.id)).splitlines()
+        self.assertEqual(len(rows), 2)
+
+        # csv
+        rows = list(csv.DictReader(io.StringIO(self.export(client, 'csv'))))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(list(rows[0].keys()), FIELDS)
+        self.assertEqual(rows[4]['ambulance_identifier'], self.a3.identifier)
+
+        # geojson
+        collection = json.loads(self.export(client, 'geojson'))
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        self.assertEqual([feature['properties']['count'] for feature in collection['features']], [3, 2])
+        coordinates = collection['features'][1]['geometry']['coordinates']
+        self.assertEqual(len(coordinates), 2)
+        self.assertAlmostEqual(coordinates[1][0], -116.999)
+
+        # invalid format
+        response = client.get('/en/api/ambulance/export/', {'output': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+        # login as testuser2, who can only read a3
+        client.login(username='testuser2', password='very_secret')
+
+        rows = [json.loads(line) for line in self.export(client, 'ndjson').splitlines()]
+        self.assertEqual({row['ambulance_id'] for row in rows}, {self.a3.id})
+
+        # logout
+        client.logout()
+
+    def test_geojson_point(self):
+
+        # a2 has a single update in the range
+        AmbulanceUpdate.objects.create(ambulance=self.a2, capability=self.a2.capability,
+                                       status=AmbulanceStatus.AV.name, location=Point(-116.5, 32.5),
+                                       timestamp=self.t0, updated_by=self.u1)
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        collection = json.loads(self.export(client, 'geojson'))
+        geometries = {feature['properties']['ambulance_id']: feature['geometry']
+                      for feature in collection['features']}
+        self.assertEqual(geometries[self.a2.id], {'type': 'Point', 'coordinates': [-116.5, 32.5]})
+        self.assertEqual(geometries[self.a1.id]['type'], 'LineString')
+        self.assertEqual(geometries[self.a3.id]['type'], 'LineString')
+
+        # alone
+        collection = json.loads(self.export(client, 'geojson', ambulance='{}'.format(self.a2.id)))
+        self.assertEqual([feature['geometry']['type'] for feature in collection['features']], ['Point'])
+
+        # logout
+        client.logout()
+
+    def test_command(self):
+
+        out = io.StringIO()
+        call_command('exportupdates', '--start', self.t0.isoformat(),
+                     '--end', (self.t0 + timedelta(minutes=1)).isoformat(),
+                     '--ambulance', str(self.a1.id), '--format', 'csv', '--chunk', '2',
+                     stdout=out)
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual([row['ambulance_id'] for row in rows], [str(self.a1.id)] * 3)
@@ -0,0 +1,166 @@
+from django.contrib.gis.geos import Point
+
+from ambulance import geofence
+from ambulance.geofence import ARRIVAL, DEPARTURE, Fence, GeofenceIndex, apply_geofence_event, get_fences
+from ambulance.models import Ambulance, AmbulanceCall, AmbulanceCallStatus, AmbulanceStatus, Call, Location, \
+    LocationType, Waypoint, WaypointStatus
+
+from login.tests.setup_data import TestSetup
+
+
+class TestGeofenceIndex(TestSetup):
+
+    def setUp(self):
+        self.hospital = Fence(1, LocationType.h.name, -117.0, 32.0, 100, None, None)
+        self.base = Fence(2, LocationType.b.name, -117.01, 32.0, 100, None, None)
+        self.waypoint = Fence(3, LocationType.i.name, -117.0, 32.01, 100, self.a1.id, 10)
+        self.index = GeofenceIndex([self.hospital, self.base, self.waypoint])
+
+    def test_locate(self):
+
+        # far away
+        self.assertEqual(self.index.locate(self.a1.id, -116.9, 32.0), [])
+
+        # 50m east of the hospital
+        self.assertEqual(self.index.locate(self.a1.id, -116.99947, 32.0), [(ARRIVAL, self.hospital)])
+
+        # still inside
+        self.assertEqual(self.index.locate(self.a1.id, -117.0, 32.0), [])
+
+        # 120m east, inside the hysteresis band
+        self.assertEqual(self.index.locate(self.a1.id, -116.99873, 32.0), [])
+
+        # 200m east
+        self.assertEqual(self.index.locate(self.a1.id, -116.99788, 32.0), [(DEPARTURE, self.hospital)])
+
+        # 120m east again, outside until within the radius
+        self.assertEqual(self.index.locate(self.a1.id, -116.99873, 32.0), [])
+
+        # from the hospital to the base
+        self.assertEqual(self.index.locate(self.a1.id, -117.0, 32.0), [(ARRIVAL, self.hospital)])
+        self.assertEqual(self.index.locate(self.a1.id, -117.01, 32.0),
+                         [(ARRIVAL, self.base), (DEPARTURE, self.hospital)])
+
+    def test_waypoints(self):
+
+        # waypoints only apply to the ambulance of their call
+        self.assertEqual(self.index.locate(self.a2.id, -117.0, 32.01), [])
+        self.assertEqual(self.index.locate(self.a1.id, -117.0, 32.01), [(ARRIVAL, self.waypoint)])
+
+    def test_replace(self):
+
+        self.index.locate(self.a1.id, -117.0, 32.0)
+        self.index.locate(self.a2.id, -117.01, 32.0)
+
+        # unchanged fences keep their ambulances, removed fences are forgotten without departures
+        self.index.replace([self.hospital, self.waypoint])
+        self.assertEqual(self.index.locate(self.a1.id, -117.0, 32.0), [])
+        self.assertEqual(self.index.locate(self.a2.id, -117.01, 32.0), [])
+        self.assertEqual(self.index.inside, {self.a1.id: {self.hospital}})
+
+    def test_get_fences(self):
+
+        Location.objects.filter(id=self.l2.id).update(location=Point(-117.01, 32.0, srid=4326))
+        self.h3.active = False
+        self.h3.save()
+
+        fences = get_fences(radius=50)
+
+        # bases and active hospitals, no AEDs
+        self.assertEqual(sorted(fence.location_id for fence in fences),
+                         sorted([self.l2.id, self.h1.id, self.h2.id]))
+        fence = [fence for fence in fences if fence.location_id == self.l2.id][0]
+        self.assertEqual((fence.type, fence.longitude, fence.latitude, fence.radius),
+                         (LocationType.b.name, -117.01, 32.0, 50))
+        self.assertIsNone(fence.ambulance_id)
+
+
+class TestGeofenceEvents(TestSetup):
+
+    def setUp(self):
+        self.status = geofence.GEOFENCE_STATUS
+        geofence.GEOFENCE_STATUS = True
+
+    def tearDown(self):
+        geofence.GEOFENCE_STATUS = self.status
+
+    def test_status(self):
+
+        hospital = Fence(self.h1.id, LocationType.h.name, -117.0, 32.0, 100, None, None)
+        base = Fence(self.l2.id, LocationType.b.name, -117.01, 32.0, 100, None, None)
+
+        # hospital bound ambulance arrives at the hospital
+        Ambulance.objects.filter(id=self.a1.id).update(status=AmbulanceStatus.HB.name)
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        apply_geofence_event(ARRIVAL, hospital, ambulance, self.u1)
+        self.assertEqual(Ambulance.objects.get(id=self.a1.id).status, AmbulanceStatus.AH.name)
+
+        # but not at a base, nor when leaving
+        apply_geofence_event(ARRIVAL, base, ambulance, self.u1)
+        apply_geofence_event(DEPARTURE, hospital, ambulance, self.u1)
+        self.assertEqual(Ambulance.objects.get(id=self.a1.id).status, AmbulanceStatus.AH.name)
+
+        # available ambulances are left alone
+        Ambulance.objects.filter(id=self.a2.id).update(status=AmbulanceStatus.AV.name)
+        ambulance = Ambulance.objects.get(id=self.a2.id)
+        apply_geofence_event(ARRIVAL, hospital, ambulance, self.u1)
+        self.assertEqual(Ambulance.objects.get(id=self.a2.id).status, AmbulanceStatus.AV.name)
+
+
+class TestGeofenceReload(TestSetup):
+
+    def setUp(self):
+        geofence._pending.reload = False
+
+    def assertReload(self, reload=True):
+        self.assertEqual(geofence._pending.reload, reload)
+        geofence._pending.reload = False
+
+    def test(self):
+
+        # locations without fences of their own
+        aed = Location.objects.get(id=self.l1.id)
+        aed.location = Point(-117.0, 32.0, srid=4326)
+        aed.save()
+        self.assertReload(False)
+
+        # bases
+        base = Location.objects.get(id=self.l2.id)
+        base.comment = 'renamed'
+        base.save()
+        self.assertReload(False)
+        base.location = Point(-117.01, 32.0, srid=4326)
+        base.save()
+        self.assertReload()
+
+        # waypoints of calls that have not been accepted
+        call = Call.objects.create(updated_by=self.u1)
+        ambulance_call = AmbulanceCall.objects.create(call=call, ambulance=self.a1, updated_by=self.u1)
+        location = Location.objects.create(type=LocationType.i.name, location=Point(-117.0, 32.01, srid=4326),
+                                           updated_by=self.u1)
+        waypoint = Waypoint.objects.create(ambulance_call=ambulance_call, order=0, status=WaypointStatus.C.name,
+                                           location=location, updated_by=self.u1)
+        self.assertReload(False)
+
+        # accepting the call
+        ambulance_call.status = AmbulanceCallStatus.A.name
+        ambulance_call.save()
+        self.assertReload()
+
+        # moving an active waypoint
+        location.location = Point(-117.0, 32.02, srid=4326)
+        location.save()
+        self.assertReload()
+
+        # visiting keeps its fence, leaving removes it
+        waypoint.status = WaypointStatus.V.name
+        waypoint.save()
+        self.assertReload(False)
+        waypoint.status = WaypointStatus.D.name
+        waypoint.save()
+        self.assertReload()
+
+        # saving again changes nothing
+        waypoint.save()
+        ambulance_call.save()
+        self.assertReload(False)
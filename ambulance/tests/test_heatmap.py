@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.test import Client
+
+from ambulance.heatmap import cell_size, compute_cells, get_heatmap
+from ambulance.models import AmbulanceCall, AmbulanceStatus, AmbulanceUpdate, Call, HeatmapDay, HeatmapLayer, \
+    Location, LocationType, Waypoint
+
+from login.tests.setup_data import TestSetup
+
+
+class TestHeatmap(TestSetup):
+
+    def setUp(self):
+
+        # level 10 cells are 0.3515625 degrees wide
+        self.level = 10
+        self.size = cell_size(self.level)
+
+        # three positions in one cell and one in another, on each of two days
+        self.t0 = datetime(2019, 6, 1, tzinfo=dt_timezone.utc)
+        for day in range(2):
+            for (ambulance, longitude, latitude) in ((self.a1, -117.0, 32.0),
+                                                     (self.a1, -117.01, 32.01),
+                                                     (self.a2, -117.02, 32.0),
+                                                     (self.a2, -116.0, 33.0)):
+                AmbulanceUpdate.objects.create(ambulance=ambulance, capability=ambulance.capability,
+                                               status=AmbulanceStatus.AV.name,
+                                               location=Point(longitude, latitude, srid=4326),
+                                               timestamp=self.t0 + timedelta(days=day, hours=12),
+                                               updated_by=self.u1)
+
+        self.cell = (int((-117.0 + 180) // self.size), int((32.0 + 90) // self.size))
+        self.other = (int((-116.0 + 180) // self.size), int((33.0 + 90) // self.size))
+
+    def test_compute_cells(self):
+
+        cells = compute_cells(HeatmapLayer.p.name, self.t0, self.t0 + timedelta(days=1), self.level)
+        self.assertEqual(cells, {self.cell: 3, self.other: 1})
+
+    def test_incidents(self):
+
+        # one call with two ambulances at the same incident, counted once
+        location = Location.objects.create(type=LocationType.i.name, location=Point(-117.0, 32.0, srid=4326),
+                                           updated_by=self.u1)
+        call = Call.objects.create(updated_by=self.u1)
+        for ambulance in (self.a1, self.a2):
+            ambulance_call = AmbulanceCall.objects.create(call=call, ambulance=ambulance, updated_by=self.u1)
+            Waypoint.objects.create(ambulance_call=ambulance_call, order=0, location=location, updated_by=self.u1)
+
+        now = call.created_at
+        cells = get_heatmap(HeatmapLayer.i.name, now - timedelta(hours=1), now + timedelta(hours=1), self.level)
+        self.assertEqual(cells, {self.cell: 1})
+
+    def test_get_heatmap(self):
+
+        # two whole days and part of the next
+        end = self.t0 + timedelta(days=2, hours=6)
+        cells = get_heatmap(HeatmapLayer.p.name, self.t0, end, self.level)
+        self.assertEqual(cells, {self.cell: 6, self.other: 2})
+        self.assertEqual(HeatmapDay.objects.filter(layer=HeatmapLayer.p.name, level=self.level).count(), 2)
+
+        # cached
+        HeatmapDay.objects.filter(layer=HeatmapLayer.p.name, level=self.level).update(cells=[[0, 0, 1]])
+        cells = get_heatmap(HeatmapLayer.p.name, self.t0, end, self.level)
+        self.assertEqual(cells, {(0, 0): 2})
+
+        # stale
+        AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                       status=AmbulanceStatus.AV.name, location=Point(-116.0, 33.0, srid=4326),
+                                       timestamp=self.t0 + timedelta(hours=13), updated_by=self.u1)
+        cells = get_heatmap(HeatmapLayer.p.name, self.t0, end, self.level)
+        self.assertEqual(cells, {(0, 0): 1, self.cell: 3, self.other: 2})
+
+        # partial days are not cached
+        cells = get_heatmap(HeatmapLayer.p.name, self.t0 + timedelta(hours=6), self.t0 + timedelta(hours=18),
+                            self.level + 1)
+        self.assertEqual(sum(cells.values()), 5)
+        self.assertFalse(HeatmapDay.objects.filter(level=self.level + 1).exists())
+
+    def test_api(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/en/api/ambulance/heatmap/',
+                              {'level': self.level,
+                               'start': self.t0.isoformat(),
+                               'end': (self.t0 + timedelta(days=1)).isoformat(),
+                               'bbox': '-117.5,31.5,-116.5,32.5'})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result['size'], self.size)
+        self.assertEqual(result['count'], [3])
+        self.assertAlmostEqual(result['longitude'][0], (self.cell[0] + 0.5) * self.size - 180)
+        self.assertAlmostEqual(result['latitude'][0], (self.cell[1] + 0.5) * self.size - 90)
+
+        response = client.get('/en/api/ambulance/heatmap/', {'level': 30})
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/en/api/ambulance/heatmap/', {'layer': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+        # login as testuser1, who is not a dispatcher
+        client.login(username='testuser1', password='top_secret')
+
+        response = client.get('/en/api/ambulance/heatmap/')
+        self.assertEqual(response.status_code, 403)
+
+        # logout
+        client.logout()
+
+        # login as testuser2, a dispatcher who can read a3 but not a1 or a2
+        client.login(username='testuser2', password='very_secret')
+
+        AmbulanceUpdate.objects.create(ambulance=self.a3, capability=self.a3.capability,
+                                       status=AmbulanceStatus.AV.name, location=Point(-116.0, 33.0, srid=4326),
+                                       timestamp=self.t0 + timedelta(hours=12), updated_by=self.u1)
+        response = client.get('/en/api/ambulance/heatmap/',
+                              {'level': self.level,
+                               'start': self.t0.isoformat(),
+                               'end': (self.t0 + timedelta(days=1)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result['count'], [1])
+        self.assertAlmostEqual(result['longitude'][0], (self.other[0] + 0.5) * self.size - 180)
+
+        # logout
+        client.logout()
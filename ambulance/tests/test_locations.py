@@ -1,12 +1,14 @@
 from django.test import Client
 
 from django.conf import settings
+from django.contrib.gis.geos import Point
 
 from rest_framework.parsers import JSONParser
 from io import BytesIO
 
-from ambulance.models import Location, LocationType
-from ambulance.serializers import LocationSerializer
+from ambulance.locations import find_duplicates, get_or_create_location, merge_locations
+from ambulance.models import Location, LocationType, Call, AmbulanceCall, Waypoint
+from ambulance.serializers import LocationSerializer, WaypointSerializer
 
 from emstrack.tests.util import date2iso, point2str, dict2point
 
@@ -252,3 +254,191 @@ class TestLocationGetList(TestSetup):
 
         # logout
         client.logout()
+
+
+class TestLocationMerge(TestSetup):
+
+    def test_get_or_create_location(self):
+
+        data = {'type': LocationType.i.name, 'street': 'some street',
+                'location': Point(-117.0, 32.0, srid=4326)}
+        l1 = get_or_create_location(dict(data), self.u1, radius=10)
+
+        # 5m east, reused
+        l2 = get_or_create_location(dict(data, location=Point(-117.000053, 32.0, srid=4326)), self.u1, radius=10)
+        self.assertEqual(l2.id, l1.id)
+
+        # 20m east, created
+        l3 = get_or_create_location(dict(data, location=Point(-117.000212, 32.0, srid=4326)), self.u1, radius=10)
+        self.assertNotEqual(l3.id, l1.id)
+
+        # different address or type, created
+        l4 = get_or_create_location(dict(data, street='another street'), self.u1, radius=10)
+        self.assertNotEqual(l4.id, l1.id)
+        l5 = get_or_create_location(dict(data, type=LocationType.w.name), self.u1, radius=10)
+        self.assertNotEqual(l5.id, l1.id)
+
+        # without coordinates, created
+        data = {'type': LocationType.i.name, 'street': 'some street'}
+        l6 = get_or_create_location(dict(data), self.u1, radius=10)
+        l7 = get_or_create_location(dict(data), self.u1, radius=10)
+        self.assertNotEqual(l6.id, l7.id)
+
+        # disabled
+        l8 = get_or_create_location({'type': LocationType.w.name, 'location': Point(-117.0, 32.0, srid=4326)},
+                                    self.u1, radius=0)
+        self.assertNotEqual(l8.id, l5.id)
+
+    def test_merge_locations(self):
+
+        def create(longitude, **kwargs):
+            return Location.objects.create(type=LocationType.i.name, location=Point(longitude, 32.0, srid=4326),
+                                           updated_by=self.u1, **kwargs)
+
+        l1 = create(-117.0)
+        l2 = create(-117.000053)
+        l3 = create(-117.000106)
+        l4 = create(-117.0, street='another street')
+        l5 = create(-117.1)
+
+        # l3 is 5m from l2 but 10m from l1
+        self.assertEqual(find_duplicates(radius=8), {l2.id: l1.id})
+
+        call = Call.objects.create(updated_by=self.u1)
+        ambulance_call = AmbulanceCall.objects.create(call=call, ambulance=self.a1, updated_by=self.u1)
+        waypoints = [Waypoint.objects.create(ambulance_call=ambulance_call, order=order, location=location,
+                                             updated_by=self.u1)
+                     for (order, location) in enumerate([l1, l2, l3, l4, l5])]
+
+        self.assertEqual(merge_locations(radius=12), (2, 2))
+        self.assertEqual([Waypoint.objects.get(id=waypoint.id).location_id for waypoint in waypoints],
+                         [l1.id, l1.id, l1.id, l4.id, l5.id])
+        self.assertFalse(Location.objects.filter(id__in=[l2.id, l3.id]).exists())
+
+        # nothing left to merge
+        self.assertEqual(merge_locations(radius=12), (0, 0))
+
+    def test_update_shared_location(self):
+
+        location = Location.objects.create(type=LocationType.w.name, location=Point(-117.0, 32.0, srid=4326),
+                                           updated_by=self.u1)
+        call = Call.objects.create(updated_by=self.u1)
+        ambulance_call = AmbulanceCall.objects.create(call=call, ambulance=self.a1, updated_by=self.u1)
+        wp1 = Waypoint.objects.create(ambulance_call=ambulance_call, order=0, location=location, updated_by=self.u1)
+        wp2 = Waypoint.objects.create(ambulance_call=ambulance_call, order=1, location=location, updated_by=self.u1)
+
+        # updating the location of one waypoint leaves the other alone
+        serializer = WaypointSerializer(wp2, data={'location': {'type': LocationType.w.name,
+                                                                'street': 'some street'}}, partial=True)
+        self.assertTrue(serializer.is_valid())
+        serializer.save(updated_by=self.u1)
+
+        self.assertEqual(Waypoint.objects.get(id=wp1.id).location.street, '')
+        wp2 = Waypoint.objects.get(id=wp2.id)
+        self.assertNotEqual(wp2.location_id, location.id)
+        self.assertEqual(wp2.location.street, 'some street')
+
+
+class TestLocationListFilters(TestSetup):
+
+    def setUp(self):
+        for (location, longitude, latitude) in ((self.l1, -117.0, 32.0),
+                                                (self.l2, -117.01, 32.0),
+                                                (self.l3, -116.0, 33.0)):
+            location.location = Point(longitude, latitude, srid=4326)
+            location.save()
+
+    def test_filters(self):
+
+        # instantiate client
+        client = Client()
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # bounding box
+        response = client.get('/en/api/location/?bbox=-117.005,31.9,-116.5,32.1')
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual([location['id'] for location in result], [self.l1.id])
+
+        # within 2km, then 500m
+        response = client.get('/en/api/location/?near=-117.0,32.0&radius=2000')
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual([location['id'] for location in result], [self.l1.id, self.l2.id])
+
+        response = client.get('/en/api/location/?near=-117.0,32.0&radius=500')
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual([location['id'] for location in result], [self.l1.id])
+
+        # by type
+        response = client.get('/en/api/location/a/?near=-117.0,32.0&radius=2000')
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual([location['id'] for location in result], [self.l1.id])
+
+        # invalid
+        response = client.get('/en/api/location/?bbox=-117.005,31.9,-116.5')
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/en/api/location/?near=-117.0,north')
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+    def test_cursor(self):
+
+        # instantiate client
+        client = Client()
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        ids = []
+        url = '/en/api/location/?cursor=&page_size=2'
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            result = JSONParser().parse(BytesIO(response.content))
+            self.assertEqual(result['has_more'], result['next'] is not None)
+            ids += [location['id'] for location in result['results']]
+            url = result['next']
+        self.assertEqual(ids, sorted([self.l1.id, self.l2.id, self.l3.id]))
+
+        response = client.get('/en/api/location/?cursor=invalid')
+        self.assertEqual(response.status_code, 404)
+
+        # logout
+        client.logout()
+
+    def test_conditional(self):
+
+        # instantiate client
+        client = Client()
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/en/api/location/a/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        # not modified
+        response = client.get('/en/api/location/a/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # other filters have other tags
+        response = client.get('/en/api/location/a/?bbox=-117.005,31.9,-116.5,32.1', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # modified
+        self.l3.comment = 'moved'
+        self.l3.save()
+        response = client.get('/en/api/location/a/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # deleted
+        etag = response['ETag']
+        self.l3.delete()
+        response = client.get('/en/api/location/a/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual([location['id'] for location in result], [self.l1.id])
+
+        # logout
+        client.logout()
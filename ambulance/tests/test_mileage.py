@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.test import Client, SimpleTestCase
+
+from ambulance.mileage import calculate_mileage, segment_starts, get_mileage
+from ambulance.models import AmbulanceStatus, AmbulanceUpdate, AmbulanceMileage
+
+from login.tests.setup_data import TestSetup
+
+# degrees of longitude of 10m at latitude 32
+STEP = 10 / (6371e3 * np.cos(np.radians(32)) * np.pi / 180)
+
+
+class TestCalculateMileage(SimpleTestCase):
+
+    def test_segment_starts(self):
+
+        # breaks on long intervals and long jumps
+        longitude = -117 + STEP * np.array([0, 1, 2, 3, 500, 501])
+        timestamps = [0, 1, 2, 3 + 2 * 3600, 4 + 2 * 3600, 5 + 2 * 3600]
+        self.assertEqual(list(segment_starts(longitude, np.full(6, 32.0), timestamps)), [0, 3, 4])
+
+    def test_calculate_mileage(self):
+
+        # 10m/s for 100s
+        statistics = calculate_mileage(-117 + STEP * np.arange(101), np.full(101, 32.0), np.arange(101))
+        self.assertEqual(statistics['count'], 101)
+        self.assertAlmostEqual(statistics['distance'], 1000, delta=1)
+        self.assertAlmostEqual(statistics['time'], 100)
+        self.assertAlmostEqual(statistics['moving_distance'], 1000, delta=1)
+        self.assertAlmostEqual(statistics['max_speed'], 10, delta=0.1)
+
+        # standing still
+        statistics = calculate_mileage(np.full(10, -117.0), np.full(10, 32.0), np.arange(10))
+        self.assertEqual(statistics['distance'], 0)
+        self.assertEqual(statistics['max_speed'], 0)
+
+        # nothing
+        self.assertEqual(calculate_mileage([], [], [])['count'], 0)
+
+
+class TestMileage(TestSetup):
+
+    def setUp(self):
+
+        # a1 drives at 10m/s for 60s around noon on three consecutive days
+        self.t0 = datetime(2019, 6, 1, 12, tzinfo=dt_timezone.utc)
+        for day in range(3):
+            for k in range(61):
+                AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                               status=AmbulanceStatus.PB.name,
+                                               location=Point(-117 + STEP * k, 32.0),
+                                               timestamp=self.t0 + timedelta(days=day, seconds=k),
+                                               updated_by=self.u1)
+
+    def test_get_mileage(self):
+
+        # one whole day and two partial days
+        start = self.t0 - timedelta(hours=1)
+        end = self.t0 + timedelta(days=2, hours=1)
+        statistics = get_mileage([self.a1.id, self.a2.id], start, end)
+        self.assertEqual(list(statistics.keys()), [self.a1.id])
+        self.assertEqual(statistics[self.a1.id]['count'], 3 * 61)
+        self.assertAlmostEqual(statistics[self.a1.id]['distance'], 3 * 600, delta=3)
+        self.assertAlmostEqual(statistics[self.a1.id]['moving_time'], 3 * 60)
+
+        # only the whole day is cached
+        self.assertEqual(AmbulanceMileage.objects.filter(ambulance=self.a1).count(), 1)
+        mileage = AmbulanceMileage.objects.get(ambulance=self.a1)
+        self.assertEqual(mileage.date, (self.t0 + timedelta(days=1)).date())
+        self.assertEqual(mileage.count, 61)
+
+        # cached results are reused
+        AmbulanceMileage.objects.filter(id=mileage.id).update(distance=1)
+        statistics = get_mileage([self.a1.id], start, end)
+        self.assertAlmostEqual(statistics[self.a1.id]['distance'], 2 * 600 + 1, delta=2)
+
+        # and recomputed when updates change
+        AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                       status=AmbulanceStatus.PB.name,
+                                       location=Point(-117 + STEP * 70, 32.0),
+                                       timestamp=self.t0 + timedelta(days=1, seconds=70),
+                                       updated_by=self.u1)
+        statistics = get_mileage([self.a1.id], start, end)
+        self.assertAlmostEqual(statistics[self.a1.id]['distance'], 3 * 600 + 90, delta=3)
+        self.assertEqual(AmbulanceMileage.objects.get(ambulance=self.a1).count, 62)
+
+    def test_api(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/en/api/ambulance/mileage/',
+                              {'start': self.t0.isoformat(),
+                               'end': (self.t0 + timedelta(days=3)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual([row['id'] for row in result], [self.a1.id])
+        self.assertEqual(result[0]['identifier'], self.a1.identifier)
+        self.assertAlmostEqual(result[0]['distance'], 3 * 600, delta=3)
+        self.assertAlmostEqual(result[0]['avg_moving_speed'], 10, delta=0.1)
+
+        # timestamps without an offset are in the current time zone
+        response = client.get('/en/api/ambulance/mileage/',
+                              {'start': self.t0.replace(tzinfo=None).isoformat(),
+                               'end': (self.t0 + timedelta(days=3)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), result)
+
+        # logout
+        client.logout()
+
+        # login as testuser2, who cannot read a1
+        client.login(username='testuser2', password='very_secret')
+
+        response = client.get('/en/api/ambulance/mileage/',
+                              {'start': self.t0.isoformat(),
+                               'end': (self.t0 + timedelta(days=3)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+        # logout
+        client.logout()
@@ -0,0 +1,88 @@
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.test import Client
+
+from ambulance.models import Ambulance, AmbulanceStatus, AmbulanceCapability
+from ambulance.nearest import get_nearest_ambulances
+from emstrack.latlon import calculate_distance
+
+from login.tests.setup_data import TestSetup
+
+
+class TestNearest(TestSetup):
+
+    def setUp(self):
+
+        # a1 and a2 are available, 1km and 2km east of the incident; a3 is at the incident but busy
+        self.incident = Point(-117.0, 32.0, srid=4326)
+        for (ambulance, longitude, status) in ((self.a1, -116.9894, AmbulanceStatus.AV.name),
+                                               (self.a2, -116.9788, AmbulanceStatus.AV.name),
+                                               (self.a3, -117.0, AmbulanceStatus.PB.name)):
+            Ambulance.objects.filter(id=ambulance.id).update(location=Point(longitude, 32.0, srid=4326),
+                                                             status=status, active=True)
+
+    def test_get_nearest_ambulances(self):
+
+        nearest = get_nearest_ambulances(Ambulance.objects.all(), -117.0, 32.0, k=2)
+        self.assertEqual([ambulance.id for (ambulance, distance, bearing, eta) in nearest], [self.a1.id, self.a2.id])
+        (ambulance, distance, bearing, eta) = nearest[0]
+        self.assertAlmostEqual(distance, calculate_distance(ambulance.location, self.incident))
+        self.assertAlmostEqual(distance, 1000, delta=10)
+        # heading west to the incident
+        self.assertAlmostEqual(bearing, 270, delta=1)
+
+        # travel times are only estimated on request
+        self.assertIsNone(eta)
+        nearest = get_nearest_ambulances(Ambulance.objects.all(), -117.0, 32.0, k=2, eta=True)
+        self.assertTrue(all(eta > 0 for (ambulance, distance, bearing, eta) in nearest))
+
+        # any status
+        nearest = get_nearest_ambulances(Ambulance.objects.all(), -117.0, 32.0, k=1, status=None)
+        self.assertEqual(nearest[0][0].id, self.a3.id)
+
+        # capability
+        nearest = get_nearest_ambulances(Ambulance.objects.all(), -117.0, 32.0, k=2,
+                                         capability=[AmbulanceCapability.A.name])
+        self.assertEqual([ambulance.id for (ambulance, distance, bearing, eta) in nearest], [self.a2.id])
+
+        # inactive ambulances are left out
+        Ambulance.objects.filter(id=self.a1.id).update(active=False)
+        nearest = get_nearest_ambulances(Ambulance.objects.all(), -117.0, 32.0, k=1)
+        self.assertEqual(nearest[0][0].id, self.a2.id)
+
+    def test_api(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/en/api/ambulance/nearest/', {'latitude': 32.0, 'longitude': -117.0, 'k': 3})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual([row['id'] for row in result], [self.a1.id, self.a2.id])
+        self.assertAlmostEqual(result[0]['distance'], 1000, delta=10)
+
+        response = client.get('/en/api/ambulance/nearest/', {'latitude': 32.0, 'longitude': -117.0,
+                                                             'status': 'AV,PB', 'k': 1})
+        self.assertEqual([row['id'] for row in response.json()], [self.a3.id])
+
+        # invalid parameters
+        response = client.get('/en/api/ambulance/nearest/', {'latitude': 32.0})
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/en/api/ambulance/nearest/', {'latitude': 32.0, 'longitude': -117.0, 'k': 0})
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+        # login as testuser2, who cannot read a1
+        client.login(username='testuser2', password='very_secret')
+
+        response = client.get('/en/api/ambulance/nearest/', {'latitude': 32.0, 'longitude': -117.0})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(self.a1.id, [row['id'] for row in response.json()])
+
+        # logout
+        client.logout()
@@ -0,0 +1,143 @@
+import io
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.test import Client
+from django.utils import timezone
+
+from ambulance.models import Ambulance, AmbulanceStatus, AmbulanceUpdate
+from ambulance.odometer import defer_odometers, flush_odometers, get_odometer_distance, update_odometers
+from ambulance.serializers import AmbulanceSerializer
+from emstrack.latlon import calculate_distance
+
+from login.tests.setup_data import TestSetup
+
+
+class TestOdometer(TestSetup):
+
+    def setUp(self):
+
+        self.t0 = datetime(2019, 6, 1, 10, tzinfo=dt_timezone.utc)
+        self.points = [Point(-117.0 + k * 1e-3, 32.0) for k in range(4)]
+        self.step = calculate_distance(self.points[0], self.points[1])
+
+    def create(self, k, seconds):
+        return AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                              status=AmbulanceStatus.PB.name, location=self.points[k],
+                                              timestamp=self.t0 + timedelta(seconds=seconds),
+                                              updated_by=self.u1)
+
+    def test_updates(self):
+
+        # in order, about 94m every 10s
+        u0 = self.create(0, 0)
+        u1 = self.create(1, 10)
+        u3 = self.create(3, 30)
+        self.assertEqual(u0.odometer, 0)
+        self.assertAlmostEqual(u1.odometer, self.step)
+        self.assertAlmostEqual(u1.moving_time, 10)
+        self.assertAlmostEqual(u3.odometer, 3 * self.step, delta=1e-3)
+
+        # late update
+        u2 = self.create(2, 20)
+        self.assertAlmostEqual(u2.odometer, 2 * self.step, delta=1e-3)
+        flush_odometers()
+        u3.refresh_from_db()
+        self.assertAlmostEqual(u3.odometer, 3 * self.step, delta=1e-3)
+        self.assertAlmostEqual(u3.moving_time, 30)
+
+        # distance between any two times
+        (distance, moving_time) = get_odometer_distance(self.a1.id, self.t0 + timedelta(seconds=10),
+                                                        self.t0 + timedelta(seconds=25))
+        self.assertAlmostEqual(distance, self.step, delta=1e-3)
+        self.assertAlmostEqual(moving_time, 10)
+
+        # backfill
+        AmbulanceUpdate.objects.filter(ambulance=self.a1).update(odometer=None, moving_time=None)
+        self.assertEqual(update_odometers(self.a1.id), AmbulanceUpdate.objects.filter(ambulance=self.a1).count())
+        u3.refresh_from_db()
+        self.assertAlmostEqual(u3.odometer - u0.odometer, 3 * self.step, delta=1e-3)
+
+        out = io.StringIO()
+        call_command('odometerupdates', '--ambulance', str(self.a1.id), stdout=out)
+        self.assertIn(self.a1.identifier, out.getvalue())
+
+    def test_late_update(self):
+
+        u0 = self.create(0, 0)
+        u2 = self.create(2, 20)
+        u3 = self.create(3, 30)
+
+        # a late update off the line only changes the steps around it; the updates after it are shifted
+        late = AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                              status=AmbulanceStatus.PB.name, location=Point(-117.001, 32.001),
+                                              timestamp=self.t0 + timedelta(seconds=10), updated_by=self.u1)
+        flush_odometers()
+        (u2_odometer, u3_odometer) = (u2.odometer, u3.odometer)
+        for update in (u0, u2, u3):
+            update.refresh_from_db()
+        detour = calculate_distance(self.points[0], late.location) + \
+            calculate_distance(late.location, self.points[2]) - 2 * self.step
+        self.assertAlmostEqual(u2.odometer - u2_odometer, detour, delta=1e-3)
+        self.assertAlmostEqual(u3.odometer - u3_odometer, detour, delta=1e-3)
+
+        # the ambulance carries the odometer of its latest update
+        latest = AmbulanceUpdate.objects.filter(ambulance=self.a1).order_by('-timestamp', '-id').first()
+        self.assertAlmostEqual(Ambulance.objects.get(id=self.a1.id).odometer, latest.odometer)
+
+        # repairs are deferred to the end of the block
+        u3_odometer = u3.odometer
+        with defer_odometers():
+            self.create(1, 5)
+            self.create(1, 15)
+            self.assertEqual(AmbulanceUpdate.objects.get(id=u3.id).odometer, u3_odometer)
+        u3.refresh_from_db()
+        self.assertGreater(u3.odometer, u3_odometer + self.step)
+
+    def test_save_twice(self):
+
+        # an instance saved twice advances its odometer each time, as in mqttclient
+        a = Ambulance.objects.get(id=self.a1.id)
+        t1 = timezone.now() + timedelta(minutes=1)
+        (a.location, a.timestamp) = (self.points[0], t1)
+        a.save()
+        odometer = Ambulance.objects.get(id=self.a1.id).odometer
+        (a.location, a.timestamp) = (self.points[1], t1 + timedelta(seconds=10))
+        a.save()
+        (a.location, a.timestamp) = (self.points[2], t1 + timedelta(seconds=20))
+        a.save()
+        self.assertAlmostEqual(Ambulance.objects.get(id=self.a1.id).odometer - odometer, 2 * self.step, delta=1e-3)
+
+    def test_ambulance(self):
+
+        # the odometer of the ambulance advances from its previous location
+        t1 = timezone.now() + timedelta(minutes=1)
+        a = Ambulance.objects.get(id=self.a1.id)
+        serializer = AmbulanceSerializer(a, data={'location': {'latitude': 32.0, 'longitude': -117.0},
+                                                  'timestamp': t1}, partial=True)
+        serializer.is_valid()
+        serializer.save(updated_by=self.u1)
+        odometer = Ambulance.objects.get(id=self.a1.id).odometer
+
+        a = Ambulance.objects.get(id=self.a1.id)
+        serializer = AmbulanceSerializer(a, data={'location': {'latitude': 32.0, 'longitude': -116.999},
+                                                  'timestamp': t1 + timedelta(seconds=10)}, partial=True)
+        serializer.is_valid()
+        serializer.save(updated_by=self.u1)
+
+        a = Ambulance.objects.get(id=self.a1.id)
+        self.assertAlmostEqual(a.odometer - odometer, self.step, delta=1e-3)
+        update = AmbulanceUpdate.objects.filter(ambulance=self.a1).order_by('-timestamp').first()
+        self.assertAlmostEqual(update.odometer, a.odometer)
+
+        # api
+        client = Client()
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+        response = client.get('/en/api/ambulance/{}/odometer/'.format(self.a1.id),
+                              {'start': t1.isoformat(),
+                               'end': (t1 + timedelta(seconds=10)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(response.json()['distance'], self.step, delta=1e-3)
+        client.logout()
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
+
+from ambulance.management.commands.partitionupdates import month_start
+from ambulance.models import AmbulanceStatus, AmbulanceUpdate
+
+from login.tests.setup_data import TestSetup
+
+
+class TestPartitions(TestSetup):
+
+    def get_partitions(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                           "WHERE i.inhparent = to_regclass(%s)", [AmbulanceUpdate._meta.db_table])
+            return {row[0] for row in cursor.fetchall()}
+
+    def test_month_start(self):
+
+        date = datetime(2020, 12, 15, 10, tzinfo=dt_timezone.utc)
+        self.assertEqual(month_start(date), datetime(2020, 12, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(month_start(date, 1), datetime(2021, 1, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(month_start(date, -12), datetime(2019, 12, 1, tzinfo=dt_timezone.utc))
+
+    def test_partitions(self):
+
+        table = AmbulanceUpdate._meta.db_table
+        count = AmbulanceUpdate.objects.count()
+
+        # partition table
+        call_command('partitionupdates', '--setup', '--ahead', '1', stdout=StringIO(), verbosity=0)
+        start = month_start(timezone.now(), 1)
+        self.assertSetEqual(self.get_partitions(),
+                            {table + '_legacy', table + '_default', '{}_p{:%Y%m}'.format(table, start)})
+
+        # existing updates are still there
+        self.assertEqual(AmbulanceUpdate.objects.count(), count)
+
+        # new updates go into the partitions
+        now = timezone.now()
+        future = now + timedelta(days=180)
+        for timestamp in (now, future):
+            AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                           status=AmbulanceStatus.AH.name,
+                                           timestamp=timestamp, updated_by=self.u1)
+        self.assertEqual(AmbulanceUpdate.objects.count(), count + 2)
+
+        # creating partitions ahead moves updates out of the default partition
+        call_command('partitionupdates', '--ahead', '7', stdout=StringIO(), verbosity=0)
+        self.assertIn('{}_p{:%Y%m}'.format(table, month_start(future)), self.get_partitions())
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM {}'.format(connection.ops.quote_name(table + '_default')))
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+        # queries work unchanged
+        updates = AmbulanceUpdate.objects.filter(ambulance=self.a1,
+                                                 timestamp__gte=now - timedelta(seconds=1)).order_by('timestamp')
+        self.assertListEqual([u.timestamp for u in updates], [now, future])
@@ -0,0 +1,104 @@
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.test import Client
+
+from ambulance.models import AmbulanceStatus, AmbulanceUpdate
+from ambulance.playback import get_snapshot, playback
+
+from login.tests.setup_data import TestSetup
+
+
+class TestPlayback(TestSetup):
+
+    def setUp(self):
+
+        # a1 reports every minute, a2 every 90 seconds, both from 10 minutes before t0
+        self.t0 = datetime(2019, 6, 1, 14, 30, tzinfo=dt_timezone.utc)
+        for (ambulance, period, longitude) in ((self.a1, 60, -117.0), (self.a2, 90, -116.0)):
+            AmbulanceUpdate.objects.bulk_create([
+                AmbulanceUpdate(ambulance=ambulance, capability=ambulance.capability,
+                                status=AmbulanceStatus.AV.name, location=Point(longitude, 32.0 + k * 0.001),
+                                timestamp=self.t0 + timedelta(seconds=k * period), updated_by=self.u1)
+                for k in range(-10, 20)])
+
+    def test_get_snapshot(self):
+
+        # at 14:32, a1 reported at 14:32 and a2 at 14:31:30
+        timestamp = self.t0 + timedelta(minutes=2)
+        snapshot = {update.ambulance_id: update for update in get_snapshot([self.a1.id, self.a2.id, self.a3.id],
+                                                                           timestamp)}
+        self.assertEqual(set(snapshot.keys()), {self.a1.id, self.a2.id})
+        self.assertEqual(snapshot[self.a1.id].timestamp, timestamp)
+        self.assertEqual(snapshot[self.a2.id].timestamp, self.t0 + timedelta(seconds=90))
+
+        # too old
+        snapshot = get_snapshot([self.a1.id, self.a2.id], timestamp, timestamp - timedelta(seconds=20))
+        self.assertEqual([update.ambulance_id for update in snapshot], [self.a1.id])
+
+    def test_playback(self):
+
+        start = self.t0
+        end = self.t0 + timedelta(minutes=6)
+        updates = list(playback([self.a1.id, self.a2.id], start, end, chunk_size=3))
+
+        # state before start, then every update in the range in order
+        self.assertEqual([(update['ambulance_id'], update['timestamp']) for update in updates[:2]],
+                         [(self.a2.id, self.t0 - timedelta(seconds=90)), (self.a1.id, self.t0 - timedelta(minutes=1))])
+        expected = sorted(AmbulanceUpdate.objects
+                          .filter(ambulance_id__in=[self.a1.id, self.a2.id], timestamp__gte=start, timestamp__lt=end)
+                          .values_list('timestamp', 'id'))
+        self.assertEqual([(update['timestamp'], update['id']) for update in updates[2:]], expected)
+        self.assertEqual(len(expected), 6 + 4)
+
+        # sampled every two minutes
+        updates = list(playback([self.a1.id, self.a2.id], start, end, interval=timedelta(minutes=2), chunk_size=3))
+        a1 = [update['timestamp'] for update in updates[2:] if update['ambulance_id'] == self.a1.id]
+        a2 = [update['timestamp'] for update in updates[2:] if update['ambulance_id'] == self.a2.id]
+        self.assertEqual(a1, [self.t0 + timedelta(minutes=minutes) for minutes in (0, 2, 4)])
+        self.assertEqual(a2, [self.t0 + timedelta(seconds=seconds) for seconds in (0, 180)])
+
+    def test_api(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/en/api/ambulance/snapshot/',
+                              {'ambulance': '{},{}'.format(self.a1.id, self.a2.id),
+                               'timestamp': (self.t0 + timedelta(minutes=2)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        result = {update['ambulance_id']: update for update in response.json()}
+        self.assertEqual(set(result.keys()), {self.a1.id, self.a2.id})
+        self.assertEqual(result[self.a1.id]['ambulance_identifier'], self.a1.identifier)
+
+        response = client.get('/en/api/ambulance/snapshot/', {'timestamp': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+        response = client.get('/en/api/ambulance/playback/',
+                              {'ambulance': self.a1.id,
+                               'start': self.t0.isoformat(),
+                               'end': (self.t0 + timedelta(minutes=5)).isoformat(),
+                               'interval': 120})
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line['timestamp'] for line in lines],
+                         [(self.t0 + timedelta(minutes=minutes)).isoformat() for minutes in (-1, 0, 2, 4)])
+
+        # logout
+        client.logout()
+
+        # login as testuser2, who cannot read a1
+        client.login(username='testuser2', password='very_secret')
+
+        response = client.get('/en/api/ambulance/snapshot/',
+                              {'timestamp': (self.t0 + timedelta(minutes=2)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(self.a1.id, [update['ambulance_id'] for update in response.json()])
+
+        # logout
+        client.logout()
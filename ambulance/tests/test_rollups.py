@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.test import Client
+
+from ambulance.models import AmbulanceStatus, AmbulanceUpdate, AmbulanceUpdateRollup, RollupResolution
+from ambulance.rollups import update_rollups, get_rollup_resolution, floor_bucket
+from emstrack.latlon import calculate_distance
+
+from login.tests.setup_data import TestSetup
+
+
+class TestRollups(TestSetup):
+
+    def setUp(self):
+
+        # updates of a1 around 10:00, far from any other update
+        self.t0 = datetime(2019, 6, 1, 9, 59, 30, tzinfo=dt_timezone.utc)
+        self.points = [
+            (self.t0, AmbulanceStatus.AV.name, Point(-117.0, 32.0)),
+            (self.t0 + timedelta(seconds=45), AmbulanceStatus.PB.name, Point(-117.001, 32.0)),
+            (self.t0 + timedelta(seconds=80), AmbulanceStatus.PB.name, Point(-117.002, 32.001)),
+        ]
+        for (timestamp, status, location) in self.points:
+            AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                           status=status, location=location,
+                                           timestamp=timestamp, updated_by=self.u1)
+
+    def test_floor_bucket(self):
+
+        self.assertEqual(floor_bucket(self.t0, RollupResolution.m.name),
+                         datetime(2019, 6, 1, 9, 59, tzinfo=dt_timezone.utc))
+        self.assertEqual(floor_bucket(self.t0, RollupResolution.h.name),
+                         datetime(2019, 6, 1, 9, tzinfo=dt_timezone.utc))
+
+    def test_update_rollups(self):
+
+        self.assertEqual(update_rollups(self.a1.id, self.t0, self.points[-1][0]), 2)
+
+        # minute buckets
+        minutes = AmbulanceUpdateRollup.objects.filter(ambulance=self.a1, resolution=RollupResolution.m.name) \
+            .order_by('bucket')
+        self.assertEqual([r.count for r in minutes], [1, 2])
+        self.assertEqual([r.bucket.minute for r in minutes], [59, 0])
+
+        # 30s of AV before 10:00, 15s of AV and 35s of PB after
+        self.assertDictEqual(minutes[0].status_duration, {'AV': 30.0})
+        self.assertDictEqual(minutes[1].status_duration, {'AV': 15.0, 'PB': 35.0})
+        self.assertEqual(minutes[1].first_timestamp, self.points[1][0])
+        self.assertEqual(minutes[1].last_timestamp, self.points[2][0])
+        self.assertAlmostEqual(minutes[1].distance,
+                               calculate_distance(self.points[0][2], self.points[1][2]) +
+                               calculate_distance(self.points[1][2], self.points[2][2]))
+
+        # hour buckets
+        hours = AmbulanceUpdateRollup.objects.filter(ambulance=self.a1, resolution=RollupResolution.h.name) \
+            .order_by('bucket')
+        self.assertEqual([r.count for r in hours], [1, 2])
+        self.assertDictEqual(hours[1].status_duration, {'AV': 15.0, 'PB': 35.0})
+
+        # recomputing gives the same rollups
+        update_rollups(self.a1.id, self.points[1][0])
+        self.assertEqual(AmbulanceUpdateRollup.objects.filter(ambulance=self.a1).count(), 4)
+
+    def test_idle_gap(self):
+
+        # the next update comes three hours later
+        t1 = self.points[-1][0] + timedelta(hours=3)
+        AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                       status=AmbulanceStatus.AV.name, location=Point(-117.002, 32.001),
+                                       timestamp=t1, updated_by=self.u1)
+        self.assertEqual(update_rollups(self.a1.id, self.t0, t1), 3)
+
+        # no empty minutes; the minutes with updates count the time in them only
+        minutes = AmbulanceUpdateRollup.objects.filter(ambulance=self.a1, resolution=RollupResolution.m.name) \
+            .order_by('bucket')
+        self.assertEqual([r.count for r in minutes], [1, 2, 1])
+        self.assertDictEqual(minutes[1].status_duration, {'AV': 15.0, 'PB': 45.0})
+        self.assertDictEqual(minutes[2].status_duration, {'PB': 50.0})
+
+        # hours count the whole gap
+        hours = AmbulanceUpdateRollup.objects.filter(ambulance=self.a1, resolution=RollupResolution.h.name) \
+            .order_by('bucket')
+        self.assertEqual([r.bucket.hour for r in hours], [9, 10, 11, 12, 13])
+        self.assertEqual(sum(r.status_duration.get('PB', 0.0) for r in hours),
+                         (t1 - self.points[-1][0]).total_seconds() + 35.0)
+
+    def test_command(self):
+
+        call_command('rollupupdates', '--ambulance', str(self.a1.id), verbosity=0)
+        minutes = AmbulanceUpdateRollup.objects.filter(ambulance=self.a1, resolution=RollupResolution.m.name) \
+            .order_by('bucket')
+        self.assertEqual([r.count for r in minutes], [1, 2])
+
+        # a late update, before the newest rolled up one, is rolled up on the next run
+        AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                       status=AmbulanceStatus.AV.name, location=Point(-117.0, 32.0),
+                                       timestamp=self.t0 + timedelta(seconds=10), updated_by=self.u1)
+        call_command('rollupupdates', '--ambulance', str(self.a1.id), verbosity=0)
+        self.assertEqual([r.count for r in minutes.all()], [2, 2])
+
+    def test_get_rollup_resolution(self):
+
+        start = self.t0
+        self.assertIsNone(get_rollup_resolution(start, start + timedelta(days=1), timedelta(seconds=10)))
+        self.assertEqual(get_rollup_resolution(start, start + timedelta(days=1), timedelta(minutes=10)),
+                         RollupResolution.m.name)
+        self.assertEqual(get_rollup_resolution(start, start + timedelta(days=1), timedelta(hours=2)),
+                         RollupResolution.h.name)
+        self.assertEqual(get_rollup_resolution(start, start + timedelta(minutes=30), timedelta(hours=2)),
+                         RollupResolution.m.name)
+
+    def test_rollups_viewset(self):
+
+        update_rollups(self.a1.id, self.t0, self.points[-1][0])
+
+        client = Client()
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/en/api/ambulance/{}/rollups/'.format(self.a1.id),
+                              {'start': '2019-06-01T09:00:00+00:00', 'end': '2019-06-01T11:00:00+00:00',
+                               'precision': 3600},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual([r['resolution'] for r in result], ['h', 'h'])
+        self.assertEqual([r['count'] for r in result], [1, 2])
+
+        # hours by default
+        response = client.get('/en/api/ambulance/{}/rollups/'.format(self.a1.id),
+                              {'start': '2019-06-01T09:00:00+00:00', 'end': '2019-06-01T11:00:00+00:00'},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['resolution'] for r in response.json()], ['h', 'h'])
+
+        response = client.get('/en/api/ambulance/{}/rollups/'.format(self.a1.id),
+                              {'precision': 1},
+                              follow=True)
+        self.assertEqual(response.status_code, 400)
+
+        client.logout()
@@ -0,0 +1,131 @@
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.test import Client, SimpleTestCase
+
+from ambulance import speeds
+from ambulance.models import Ambulance, AmbulanceStatus, AmbulanceUpdate, TravelSpeed
+from ambulance.speeds import SpeedModel, SpeedTotals, compute_speeds, hours_of_week, save_speeds, track_speeds
+
+from emstrack.latlon import earth_radius
+
+from login.tests.setup_data import TestSetup
+
+
+def eastward_track(start, speed, count, interval=10, longitude=-117.0, latitude=32.0):
+    """
+    Points every interval seconds of a track heading east at speed m/s.
+    """
+    step = speed * interval / (math.radians(earth_radius) * math.cos(math.radians(latitude)))
+    return (longitude + step * np.arange(count), np.full(count, latitude),
+            start.timestamp() + interval * np.arange(count))
+
+
+class TestSpeedModel(SimpleTestCase):
+
+    def setUp(self):
+        # a Monday
+        self.monday = datetime(2024, 1, 1, 5, 30, tzinfo=dt_timezone.utc)
+
+    def test_hours_of_week(self):
+
+        self.assertEqual(hours_of_week([self.monday.timestamp()]).tolist(), [5])
+        self.assertEqual(hours_of_week([self.monday.timestamp()], -8 * 3600).tolist(), [6 * 24 + 21])
+
+    def test_track_speeds(self):
+
+        (longitude, latitude, timestamps) = eastward_track(self.monday, 20, 30)
+
+        # a stop and a gap are not counted
+        timestamps[20:] += 600
+        longitude = np.concatenate((longitude[:10], [longitude[9]], longitude[10:]))
+        latitude = np.append(latitude, latitude[0])
+        timestamps = np.concatenate((timestamps[:10], [timestamps[9] + 10], timestamps[10:] + 10))
+
+        (x, y, hours, distance, seconds) = track_speeds(longitude, latitude, timestamps)
+        self.assertEqual(len(distance), 31 - 1 - 2)
+        np.testing.assert_allclose(distance / seconds, 20, rtol=1e-4)
+        self.assertEqual(set(hours.tolist()), {5})
+
+    def test_travel_times(self):
+
+        totals = SpeedTotals()
+        (longitude, latitude, timestamps) = eastward_track(self.monday, 20, 100)
+        totals.add(*track_speeds(longitude, latitude, timestamps))
+        totals.add(*track_speeds(longitude, latitude, timestamps))
+        self.assertAlmostEqual(totals.time.sum(), 2 * 99 * 10)
+
+        model = SpeedModel(speeds.SPEED_LEVEL, totals.keys, totals.distance, totals.time)
+
+        # cells driven through at that hour, other cells at that hour, and other hours
+        np.testing.assert_allclose(model.lookup([longitude[50], -100.0], [32.0, 32.0], 5), [20, 20], rtol=1e-4)
+        np.testing.assert_allclose(model.lookup([longitude[50]], [32.0], 6), [speeds.SPEED_DEFAULT / 3.6])
+
+        times = model.travel_times([longitude[0], longitude[-1]], [32.0, 32.0], longitude[0], 32.0, 5)
+        np.testing.assert_allclose(times, [0, speeds.SPEED_DETOUR * 99 * 10], rtol=1e-3)
+
+
+class TestSpeeds(TestSetup):
+
+    def setUp(self):
+
+        speeds._model = None
+
+        # a1 drove east at 20 m/s for ten minutes at this hour of the week a week ago
+        start = (datetime.now(dt_timezone.utc) - timedelta(weeks=1)).replace(minute=0, second=0, microsecond=0)
+        (longitude, latitude, timestamps) = eastward_track(start, 20, 60)
+        AmbulanceUpdate.objects.bulk_create([
+            AmbulanceUpdate(ambulance=self.a1, capability=self.a1.capability, status=AmbulanceStatus.AV.name,
+                            location=Point(x, y, srid=4326),
+                            timestamp=datetime.fromtimestamp(t, dt_timezone.utc), updated_by=self.u1)
+            for (x, y, t) in zip(longitude, latitude, timestamps)])
+
+        # a1 and a2 are available, 1km and 2km east of the incident
+        for (ambulance, longitude) in ((self.a1, -116.9894), (self.a2, -116.9788)):
+            Ambulance.objects.filter(id=ambulance.id).update(location=Point(longitude, 32.0, srid=4326),
+                                                             status=AmbulanceStatus.AV.name, active=True)
+
+    def test_compute_speeds(self):
+
+        now = datetime.now(dt_timezone.utc)
+        totals = compute_speeds([self.a1.id, self.a2.id], now - timedelta(weeks=2), now)
+        self.assertAlmostEqual(totals.time.sum(), 59 * 10, places=3)
+
+        count = save_speeds(totals)
+        self.assertEqual(TravelSpeed.objects.filter(level=speeds.SPEED_LEVEL).count(), count)
+
+        # replaced
+        save_speeds(totals)
+        self.assertEqual(TravelSpeed.objects.filter(level=speeds.SPEED_LEVEL).count(), count)
+
+        model = SpeedModel.load()
+        self.assertEqual(model.keys.size, count)
+
+    def test_api(self):
+
+        now = datetime.now(dt_timezone.utc)
+        save_speeds(compute_speeds([self.a1.id], now - timedelta(weeks=2), now))
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/en/api/ambulance/nearest/', {'longitude': -117.0, 'latitude': 32.0, 'k': 2,
+                                                             'order': 'eta'})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual([ambulance['id'] for ambulance in result], [self.a1.id, self.a2.id])
+        self.assertAlmostEqual(result[0]['eta'], speeds.SPEED_DETOUR * result[0]['distance'] / 20, delta=1)
+        self.assertLess(result[0]['eta'], result[1]['eta'])
+
+        response = client.get('/en/api/ambulance/nearest/', {'longitude': -117.0, 'latitude': 32.0,
+                                                             'order': 'time'})
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
@@ -0,0 +1,99 @@
+import math
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.test import Client
+
+from ambulance.models import Ambulance
+from ambulance.tiles import mercator_to_lonlat, tile_bounds
+
+from login.tests.setup_data import TestSetup
+
+
+def lonlat_to_tile(longitude, latitude, z):
+    n = 2 ** z
+    x = int((longitude + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * n)
+    return x, y
+
+
+class TestTiles(TestSetup):
+
+    def setUp(self):
+        cache.clear()
+        for ambulance in (self.a1, self.a3):
+            Ambulance.objects.filter(id=ambulance.id).update(location=Point(-117.0, 32.0, srid=4326), active=True)
+
+    def test_tile_bounds(self):
+
+        # the whole world
+        (xmin, ymin, xmax, ymax) = tile_bounds(0, 0, 0)
+        self.assertAlmostEqual(mercator_to_lonlat(xmin, ymin)[0], -180)
+        self.assertAlmostEqual(mercator_to_lonlat(xmax, ymax)[0], 180)
+        self.assertAlmostEqual(mercator_to_lonlat(xmax, ymax)[1], 85.0511, places=4)
+
+        # the tile contains the point
+        (x, y) = lonlat_to_tile(-117.0, 32.0, 10)
+        (xmin, ymin, xmax, ymax) = tile_bounds(10, x, y)
+        (west, south) = mercator_to_lonlat(xmin, ymin)
+        (east, north) = mercator_to_lonlat(xmax, ymax)
+        self.assertTrue(west <= -117.0 <= east and south <= 32.0 <= north)
+
+    def test_api(self):
+
+        (x, y) = lonlat_to_tile(-117.0, 32.0, 10)
+        url = '/en/api/tiles/ambulances/10/{}/{}.mvt'.format(x, y)
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertIn(self.a1.identifier.encode(), response.content)
+        self.assertIn(self.a3.identifier.encode(), response.content)
+        etag = response['ETag']
+
+        # not modified
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # modified
+        Ambulance.objects.filter(id=self.a1.id).update(location=Point(-116.99, 32.0, srid=4326),
+                                                       updated_on=self.a1.updated_on.replace(year=2100))
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # elsewhere
+        response = client.get('/en/api/tiles/ambulances/10/{}/{}.mvt'.format(x + 10, y))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+
+        # other layers
+        for layer in ('locations', 'hospitals', 'tracks'):
+            response = client.get('/en/api/tiles/{}/10/{}/{}.mvt'.format(layer, x, y))
+            self.assertEqual(response.status_code, 200)
+
+        # invalid
+        response = client.get('/en/api/tiles/roads/10/{}/{}.mvt'.format(x, y))
+        self.assertEqual(response.status_code, 404)
+        response = client.get('/en/api/tiles/ambulances/2/4/0.mvt')
+        self.assertEqual(response.status_code, 404)
+
+        # logout
+        client.logout()
+
+        # login as testuser2, who can read a3 but not a1
+        client.login(username='testuser2', password='very_secret')
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(self.a1.identifier.encode(), response.content)
+        self.assertIn(self.a3.identifier.encode(), response.content)
+
+        # logout
+        client.logout()
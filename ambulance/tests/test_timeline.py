@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.test import Client
+
+from ambulance.models import AmbulanceStatus, AmbulanceUpdate
+from ambulance.timeline import get_timelines
+
+from login.tests.setup_data import TestSetup
+
+
+class TestTimeline(TestSetup):
+
+    def setUp(self):
+
+        # a1 is available before the range, then goes to patient and back, then goes silent
+        self.t0 = datetime(2019, 6, 1, 10, tzinfo=dt_timezone.utc)
+        for (minutes, status) in ((-10, AmbulanceStatus.AV.name),
+                                  (5, AmbulanceStatus.AV.name),
+                                  (10, AmbulanceStatus.PB.name),
+                                  (15, AmbulanceStatus.PB.name),
+                                  (20, AmbulanceStatus.AV.name),
+                                  (200, AmbulanceStatus.AV.name)):
+            AmbulanceUpdate.objects.create(ambulance=self.a1, capability=self.a1.capability,
+                                           status=status, location=Point(-117.0, 32.0),
+                                           timestamp=self.t0 + timedelta(minutes=minutes),
+                                           updated_by=self.u1)
+
+    def test_get_timelines(self):
+
+        timelines = get_timelines([self.a1.id, self.a2.id], self.t0, self.t0 + timedelta(minutes=230),
+                                  max_gap=timedelta(hours=1))
+
+        # no updates
+        self.assertEqual(timelines[self.a2.id].status, [])
+
+        # status is known from the start, and not during the long gap
+        timeline = timelines[self.a1.id]
+        self.assertEqual(timeline.status, [AmbulanceStatus.AV.name, AmbulanceStatus.PB.name,
+                                           AmbulanceStatus.AV.name])
+        self.assertEqual(timeline.start, [self.t0, self.t0 + timedelta(minutes=10),
+                                          self.t0 + timedelta(minutes=200)])
+        self.assertEqual(timeline.end, [self.t0 + timedelta(minutes=10), self.t0 + timedelta(minutes=20),
+                                        self.t0 + timedelta(minutes=230)])
+        self.assertEqual(timeline.totals, {AmbulanceStatus.AV.name: 40 * 60.0, AmbulanceStatus.PB.name: 10 * 60.0})
+
+        # the last status is not extended past a long gap
+        timelines = get_timelines([self.a1.id], self.t0, self.t0 + timedelta(minutes=150),
+                                  max_gap=timedelta(hours=1))
+        self.assertEqual(timelines[self.a1.id].end[-1], self.t0 + timedelta(minutes=20))
+
+    def test_api(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/en/api/ambulance/timeline/',
+                              {'ambulance': '{},{}'.format(self.a1.id, self.a2.id),
+                               'start': self.t0.isoformat(),
+                               'end': (self.t0 + timedelta(minutes=30)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        result = {row['id']: row for row in response.json()}
+        self.assertEqual(set(result.keys()), {self.a1.id, self.a2.id})
+        self.assertEqual(result[self.a1.id]['status'],
+                         [AmbulanceStatus.AV.name, AmbulanceStatus.PB.name, AmbulanceStatus.AV.name])
+        self.assertEqual(result[self.a1.id]['start'][0], self.t0.timestamp())
+        self.assertEqual(result[self.a1.id]['end'][-1], (self.t0 + timedelta(minutes=30)).timestamp())
+        self.assertEqual(result[self.a1.id]['totals'], {AmbulanceStatus.AV.name: 20 * 60.0,
+                                                        AmbulanceStatus.PB.name: 10 * 60.0})
+
+        # logout
+        client.logout()
@@ -0,0 +1,192 @@
+import hashlib
+import logging
+import math
+
+from django.contrib.gis.geos import Polygon
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count, Max
+
+from hospital.models import Hospital
+from login.permissions import get_permitted_ids
+
+from .models import Ambulance, AmbulanceUpdate, Location, LocationType
+
+from environs import Env
+
+env = Env()
+logger = logging.getLogger(__name__)
+
+# Vector tiles in web mercator (EPSG:3857), encoded by PostGIS with ST_AsMVT
+
+# tile extent and buffer, in tile coordinates
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+# largest zoom served
+MAXIMUM_ZOOM = 22
+
+# seconds tiles are kept in the cache; entries are keyed by the last update of their features
+TILE_CACHE_TIMEOUT = env.int('DJANGO_TILE_CACHE_TIMEOUT', default=3600)
+
+# tracks are simplified to about this many tile units
+TRACK_TOLERANCE = 2
+
+# half the circumference of the earth in web mercator, meters
+MERCATOR_LIMIT = 20037508.342789244
+
+LAYERS = ('locations', 'hospitals', 'ambulances', 'tracks')
+
+TILE_SQL = """
+WITH features ({columns}) AS ({features})
+SELECT ST_AsMVT(tile, %s, {extent}, 'geom')
+FROM (
+    SELECT {properties},
+           ST_AsMVTGeom(ST_Transform({geometry}, 3857), ST_MakeEnvelope(%s, %s, %s, %s, 3857),
+                        {extent}, {buffer}, true) AS geom
+    FROM features
+    {group_by}
+) AS tile
+WHERE geom IS NOT NULL
+"""
+
+
+def tile_bounds(z, x, y):
+    """
+    Bounds of tile z/x/y in web mercator.
+    """
+    size = 2 * MERCATOR_LIMIT / 2 ** z
+    return (-MERCATOR_LIMIT + x * size, MERCATOR_LIMIT - (y + 1) * size,
+            -MERCATOR_LIMIT + (x + 1) * size, MERCATOR_LIMIT - y * size)
+
+
+def mercator_to_lonlat(mx, my):
+    return (math.degrees(mx / 6378137.0),
+            math.degrees(2 * math.atan(math.exp(my / 6378137.0)) - math.pi / 2))
+
+
+def tile_polygon(bounds, margin=0.0):
+    """
+    Polygon in EPSG:4326 covering bounds in web mercator, enlarged by margin times its size,
+    to select the features of a tile with the spatial index.
+    """
+    (xmin, ymin, xmax, ymax) = bounds
+    (dx, dy) = (margin * (xmax - xmin), margin * (ymax - ymin))
+    (west, south) = mercator_to_lonlat(max(xmin - dx, -MERCATOR_LIMIT), max(ymin - dy, -MERCATOR_LIMIT))
+    (east, north) = mercator_to_lonlat(min(xmax + dx, MERCATOR_LIMIT), min(ymax + dy, MERCATOR_LIMIT))
+    return Polygon.from_bbox((west, south, east, north))
+
+
+def get_readable_ids(user, profile_field):
+    """
+    Ids of the ambulances or hospitals user can read, or None if user can read all.
+    """
+    if user.is_superuser or user.is_staff:
+        return None
+    return sorted(get_permitted_ids(user, profile_field).values_list('id', flat=True))
+
+
+def get_features(layer, user, polygon, start=None, end=None):
+    """
+    Features of layer that user can read inside polygon, as a values queryset
+    whose last column is the geometry, and the names of its columns.
+    """
+
+    if layer == 'locations':
+        features = Location.objects \
+            .exclude(type__in=[LocationType.h.name, LocationType.w.name]) \
+            .filter(location__intersects=polygon)
+        columns = ['id', 'name', 'type', 'location']
+        features = features.values(*columns)
+
+    elif layer == 'hospitals':
+        features = Hospital.objects.filter(active=True, location__intersects=polygon)
+        ids = get_readable_ids(user, 'hospitals')
+        if ids is not None:
+            features = features.filter(id__in=ids)
+        columns = ['id', 'name', 'location']
+        features = features.values(*columns)
+
+    elif layer == 'ambulances':
+        features = Ambulance.objects.filter(active=True, location__intersects=polygon)
+        ids = get_readable_ids(user, 'ambulances')
+        if ids is not None:
+            features = features.filter(id__in=ids)
+        columns = ['id', 'identifier', 'status', 'capability', 'orientation', 'location']
+        features = features.values(*columns)
+
+    elif layer == 'tracks':
+        features = AmbulanceUpdate.objects.filter(timestamp__gte=start, timestamp__lt=end,
+                                                  location__intersects=polygon)
+        ids = get_readable_ids(user, 'ambulances')
+        if ids is not None:
+            features = features.filter(ambulance_id__in=ids)
+        features = features.values('ambulance_id', 'ambulance__identifier', 'timestamp', 'location')
+        columns = ['ambulance_id', 'identifier', 'timestamp', 'location']
+
+    else:
+        raise ValueError("Unknown tile layer '{}'".format(layer))
+
+    return features, columns
+
+
+def get_fingerprint(features):
+    """
+    Number and last update of features, to tell if a cached tile is stale.
+    """
+    fingerprint = features.values().order_by().aggregate(count=Count('*'), last_updated=Max('updated_on'))
+    return '{}|{}'.format(fingerprint['count'], fingerprint['last_updated'])
+
+
+def render_tile(layer, features, columns, bounds):
+    """
+    Encode features as a vector tile. Tracks are joined into one simplified line per ambulance.
+    """
+
+    (sql, params) = features.query.sql_with_params()
+    geometry = connection.ops.quote_name(columns[-1])
+    names = [connection.ops.quote_name(column) for column in columns]
+
+    if layer == 'tracks':
+        # one line per ambulance, simplified to about TRACK_TOLERANCE tile units
+        tolerance = TRACK_TOLERANCE * (bounds[2] - bounds[0]) / TILE_EXTENT
+        properties = 'ambulance_id, identifier, ' \
+                     'extract(epoch FROM min("timestamp")) AS start, extract(epoch FROM max("timestamp")) AS "end"'
+        geometry = 'ST_Simplify(ST_MakeLine({} ORDER BY "timestamp", ambulance_id), {})'.format(
+            geometry, float(tolerance))
+        group_by = 'GROUP BY ambulance_id, identifier'
+    else:
+        properties = ', '.join(names[:-1])
+        group_by = ''
+
+    query = TILE_SQL.format(columns=', '.join(names), features=sql, properties=properties,
+                            geometry=geometry, group_by=group_by, extent=TILE_EXTENT, buffer=TILE_BUFFER)
+    with connection.cursor() as cursor:
+        cursor.execute(query, (*params, layer, *bounds))
+        (tile, ) = cursor.fetchone()
+
+    return bytes(tile) if tile is not None else b''
+
+
+def get_tile(layer, z, x, y, user, start=None, end=None):
+    """
+    Vector tile z/x/y of layer with the features user can read, and its etag.
+    Tiles are cached until the features in them change.
+    """
+
+    bounds = tile_bounds(z, x, y)
+
+    # lines may cross a tile without points in it
+    margin = 0.5 if layer == 'tracks' else TILE_BUFFER / TILE_EXTENT
+    (features, columns) = get_features(layer, user, tile_polygon(bounds, margin), start, end)
+
+    # the permissions of the user are part of the query
+    key = '{}|{}|{}|{}|{}|{}|{}|{}'.format(layer, z, x, y, start, end, features.query, get_fingerprint(features))
+    etag = hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    tile = cache.get('tile:' + etag)
+    if tile is None:
+        tile = render_tile(layer, features, columns, bounds)
+        cache.set('tile:' + etag, tile, TILE_CACHE_TIMEOUT)
+
+    return tile, etag
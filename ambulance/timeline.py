@@ -0,0 +1,133 @@
+import logging
+
+from django.db import connection
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .models import Ambulance, AmbulanceUpdate
+from .rollups import ROLLUP_MAX_GAP
+
+logger = logging.getLogger(__name__)
+
+# Updates that start a status segment, end one because of a gap longer than max_gap,
+# or are the first or last of an ambulance in the range, in a single ordered scan
+TIMELINE_SQL = """
+SELECT ambulance_id, "timestamp", status, previous_timestamp
+FROM (
+    SELECT id, ambulance_id, "timestamp", status,
+           lag(status) OVER w AS previous_status,
+           lag("timestamp") OVER w AS previous_timestamp,
+           lead("timestamp") OVER w AS next_timestamp
+    FROM {table}
+    WHERE ambulance_id = ANY(%(ambulance_ids)s) AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+    WINDOW w AS (PARTITION BY ambulance_id ORDER BY "timestamp", id)
+) AS updates
+WHERE previous_status IS NULL OR previous_status <> status OR next_timestamp IS NULL
+    OR "timestamp" - previous_timestamp > %(max_gap)s
+ORDER BY ambulance_id, "timestamp", id
+"""
+
+
+class Timeline:
+    """
+    Contiguous status segments of an ambulance, in columns, and the seconds spent in each status.
+    """
+
+    def __init__(self, max_gap):
+        self.max_gap = max_gap
+        self.status = []
+        self.start = []
+        self.end = []
+        self.totals = {}
+
+        # current segment and last update
+        self.current = None
+        self.last = None
+
+    def close(self, timestamp):
+        if self.current is None:
+            return
+        (status, start) = self.current
+        if timestamp > start:
+            self.status.append(status)
+            self.start.append(start)
+            self.end.append(timestamp)
+            self.totals[status] = self.totals.get(status, 0.0) + (timestamp - start).total_seconds()
+        self.current = None
+
+    def add(self, timestamp, status, previous_timestamp=None, start=None):
+        """
+        Add an update. previous_timestamp is the timestamp of the previous update, if known;
+        start replaces timestamp as the start of a new segment, e.g. for updates before the range.
+        """
+
+        if previous_timestamp is None:
+            previous_timestamp = self.last
+
+        # longer gaps end the current segment
+        if previous_timestamp is not None and timestamp - previous_timestamp > self.max_gap:
+            self.close(previous_timestamp)
+
+        if self.current is not None and self.current[0] != status:
+            self.close(timestamp)
+        if self.current is None:
+            self.current = (status, max(timestamp, start) if start is not None else timestamp)
+
+        self.last = timestamp
+
+    def finish(self, end):
+        """
+        Extend the current segment to end, or only to the last update if it is older than max_gap.
+        """
+        if self.current is not None:
+            self.close(end if end - self.last <= self.max_gap else self.last)
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'start': [timestamp.timestamp() for timestamp in self.start],
+            'end': [timestamp.timestamp() for timestamp in self.end],
+            'totals': self.totals,
+        }
+
+
+def get_timelines(ambulance_ids, start, end, max_gap=ROLLUP_MAX_GAP):
+    """
+    Status timelines by ambulance id of the ambulances in [start, end).
+    A status lasts from the update that sets it to the next update with a different status;
+    gaps between updates longer than max_gap are not counted. The range ends now at the latest.
+    """
+
+    ambulance_ids = list(ambulance_ids)
+    end = min(end, timezone.now())
+
+    # status at the start of the range
+    previous = AmbulanceUpdate.objects \
+        .filter(ambulance=OuterRef('pk'), timestamp__lt=start) \
+        .order_by('-timestamp', '-id')
+    initial = Ambulance.objects \
+        .filter(id__in=ambulance_ids) \
+        .annotate(initial_status=Subquery(previous.values('status')[:1]),
+                  initial_timestamp=Subquery(previous.values('timestamp')[:1])) \
+        .values_list('id', 'initial_status', 'initial_timestamp')
+
+    timelines = {}
+    for (ambulance_id, status, timestamp) in initial:
+        timeline = timelines[ambulance_id] = Timeline(max_gap)
+        if status is not None:
+            timeline.add(timestamp, status, start=start)
+
+    if not timelines:
+        return timelines
+
+    # status changes in the range
+    with connection.cursor() as cursor:
+        cursor.execute(TIMELINE_SQL.format(table=connection.ops.quote_name(AmbulanceUpdate._meta.db_table)),
+                       {'ambulance_ids': ambulance_ids, 'start': start, 'end': end, 'max_gap': max_gap})
+        for (ambulance_id, timestamp, status, previous_timestamp) in cursor:
+            timelines[ambulance_id].add(timestamp, status, previous_timestamp)
+
+    for timeline in timelines.values():
+        timeline.finish(end)
+
+    return timelines
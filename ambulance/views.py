@@ -5,7 +5,7 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.http import HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import redirect
 from django.urls import reverse_lazy
 from django.views import View
@@ -13,9 +13,12 @@ from django.views.generic import TemplateView, ListView, \
     DetailView, CreateView, UpdateView, FormView
 from django.views.generic.detail import BaseDetailView
 
+from django.utils.cache import get_conditional_response
 from django.utils.translation import ugettext_lazy as _
 
 from drf_extra_fields.geo_fields import PointField
+from rest_framework import exceptions
+from rest_framework.views import APIView
 
 from ambulance.permissions import CallPermissionMixin
 from ambulance.resources import AmbulanceResource, CallRadioCodeResource, CallPriorityCodeResource, \
@@ -36,6 +39,8 @@ from .models import Ambulance, AmbulanceCapability, AmbulanceStatus, \
     AmbulanceOnline, AmbulanceOnlineOrder, CallRadioCode, CallPriorityCode, WaypointStatus, WaypointStatusOrder, \
     CallPriorityClassification
 
+from .tiles import get_tile, LAYERS as TILE_LAYERS, MAXIMUM_ZOOM
+from .viewsets import AmbulanceViewSet
 from .forms import AmbulanceCreateForm, AmbulanceUpdateForm, LocationAdminCreateForm, LocationAdminUpdateForm
 
 
@@ -624,3 +629,39 @@ class CallPriorityClassificationProcessImportView(SuccessMessageMixin,
     success_url = reverse_lazy('ambulance:priority-classification-list')
 
     import_breadcrumbs = {'ambulancs:priority-classification-list': _("Priority Classifications")}
+
+
+# Vector tiles
+
+class TileView(APIView):
+    """
+    Retrieve a Mapbox vector tile of locations, hospitals, ambulances or ambulance tracks.
+    """
+
+    def get(self, request, layer=None, z=None, x=None, y=None):
+        """
+        Layers are 'locations', 'hospitals', 'ambulances' and 'tracks', with the features the user can read.
+        Use ?start=x&end=y to select the time range of tracks, the last day by default.
+        Tiles carry an ETag that changes with the features in them.
+        """
+
+        # parse parameters
+        (z, x, y) = (int(z), int(x), int(y))
+        if layer not in TILE_LAYERS:
+            raise exceptions.NotFound(_('Invalid layer.'))
+        if z > MAXIMUM_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            raise exceptions.NotFound(_('Invalid tile.'))
+        (start, end) = AmbulanceViewSet.get_time_range(request) if layer == 'tracks' else (None, None)
+
+        (tile, etag) = get_tile(layer, z, x, y, request.user, start, end)
+        etag = '"{}"'.format(etag)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(tile, content_type='application/vnd.mapbox-vector-tile')
+
+        # revalidate on every load
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+
+        return response
@@ -1,7 +1,21 @@
+import base64
+import gzip
+import hashlib
+import io
+import json
 import logging
 import itertools
-
-from django.http import Http404
+import zlib
+from datetime import timedelta
+
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.db.models import Count, F, FloatField, Func, Max, Q
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import ugettext_lazy as _
 
 from rest_framework import viewsets, mixins, exceptions
@@ -11,6 +25,7 @@ from rest_framework.response import Response
 from rest_framework.pagination import PageNumberPagination, LimitOffsetPagination
 from rest_framework.exceptions import APIException, NotFound
 from rest_framework.status import HTTP_400_BAD_REQUEST
+from rest_framework.utils.urls import replace_query_param
 
 from emstrack.mixins import BasePermissionMixin, \
     CreateModelUpdateByMixin, UpdateModelUpdateByMixin
@@ -22,16 +37,30 @@ from equipment.serializers import EquipmentItemSerializer
 from equipment.viewsets import EquipmentItemViewSet
 
 from emstrack.sms import client as sms_client
+from emstrack.trajectory import simplify_trajectory
+from emstrack.util import iterate_lines
 
 from .permissions import CallPermissionMixin
 
-from .models import Location, Ambulance, LocationType, Call, CallNote, AmbulanceUpdate, AmbulanceCall, \
+from .models import Location, Ambulance, AmbulanceStatus, LocationType, Call, CallNote, AmbulanceUpdate, AmbulanceCall, \
     AmbulanceCallHistory, AmbulanceCallStatus, CallStatus, CallPriorityClassification, \
-    CallPriorityCode, CallRadioCode, Waypoint
+    CallPriorityCode, CallRadioCode, Waypoint, HeatmapLayer
 
 from .serializers import LocationSerializer, AmbulanceSerializer, AmbulanceUpdateSerializer, CallSerializer, \
     CallPriorityCodeSerializer, CallPriorityClassificationSerializer, CallRadioCodeSerializer, \
-    CallAmbulanceSummarySerializer, WaypointSerializer, CallNoteSerializer, AmbulanceUpdateCompactSerializer
+    CallAmbulanceSummarySerializer, WaypointSerializer, CallNoteSerializer, AmbulanceUpdateCompactSerializer, \
+    AmbulanceUpdateRollupSerializer
+from .rollups import get_rollups
+from .export import export_updates, FORMATS as EXPORT_FORMATS
+from .mileage import get_mileage
+from .timeline import get_timelines
+from .odometer import defer_odometers, get_odometer_distance
+from .nearest import get_nearest_ambulances, MAXIMUM_K
+from .playback import get_snapshot, playback, playback_ndjson
+from .heatmap import get_heatmap, cell_size, MINIMUM_LEVEL, MAXIMUM_LEVEL
+from .locations import radius_degrees
+from .tiles import get_readable_ids
+from .coverage import get_coverage, get_service_region, minutes_to_radius, COVERAGE_CELL_SIZE, COVERAGE_RADIUS
 
 
 logger = logging.getLogger(__name__)
@@ -79,6 +108,136 @@ class AmbulanceLimitOffsetPagination(LimitOffsetPagination):
     max_limit = 5000
 
 
+def history_ordering(order_by):
+    # order by timestamp, then id to break ties
+    return order_by, '-id' if order_by.startswith('-') else 'id'
+
+
+class AmbulanceUpdatePagination(AmbulancePageNumberPagination):
+    """
+    Page number pagination, or keyset pagination on (timestamp, id) if ?cursor is given.
+    Keyset pages cost the same at any depth and report has_more instead of a count.
+    Use ?cursor= for the first page, then follow next.
+    """
+    cursor_query_param = 'cursor'
+    cursor_page_size = 1000
+
+    keyset = False
+    has_more = False
+    next_cursor = None
+
+    @staticmethod
+    def encode_cursor(update):
+        cursor = '{}|{}'.format(update.timestamp.isoformat(), update.id)
+        return base64.urlsafe_b64encode(cursor.encode('ascii')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            (timestamp, id) = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+            timestamp = parse_datetime(timestamp)
+            id = int(id)
+        except (TypeError, ValueError):
+            timestamp = None
+        if timestamp is None:
+            raise NotFound(_('Invalid cursor.'))
+        return timestamp, id
+
+    def paginate_queryset(self, queryset, request, view=None):
+
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request) or self.cursor_page_size
+
+        # continue after the cursor, in the order of the queryset;
+        # the bound on timestamp alone lets the index and partition pruning do the work
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            (timestamp, id) = self.decode_cursor(cursor)
+            if queryset.query.order_by[0].startswith('-'):
+                queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=id),
+                                           timestamp__lte=timestamp)
+            else:
+                queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=id),
+                                           timestamp__gte=timestamp)
+
+        # fetch one more to tell if there are more
+        page = list(queryset[:page_size + 1])
+        self.has_more = len(page) > page_size
+        page = page[:page_size]
+        self.next_cursor = self.encode_cursor(page[-1]) if self.has_more else None
+
+        return page
+
+    def get_next_link(self):
+        if self.keyset:
+            if self.next_cursor is None:
+                return None
+            return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+        return super().get_next_link()
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'has_more': self.has_more,
+            'results': data
+        })
+
+
+class LocationCursorPagination(AmbulancePageNumberPagination):
+    """
+    No pagination, or keyset pagination on id if ?cursor is given.
+    Use ?cursor= for the first page, then follow next.
+    """
+    cursor_query_param = 'cursor'
+    cursor_page_size = 1000
+
+    has_more = False
+    next_cursor = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+
+        if self.cursor_query_param not in request.query_params:
+            return None
+
+        self.request = request
+        page_size = self.get_page_size(request) or self.cursor_page_size
+
+        # continue after the cursor
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            try:
+                queryset = queryset.filter(id__gt=int(base64.urlsafe_b64decode(cursor.encode('ascii'))))
+            except (TypeError, ValueError):
+                raise NotFound(_('Invalid cursor.'))
+
+        # fetch one more to tell if there are more
+        page = list(queryset.order_by('id')[:page_size + 1])
+        self.has_more = len(page) > page_size
+        page = page[:page_size]
+        self.next_cursor = base64.urlsafe_b64encode(str(page[-1].id).encode('ascii')).decode('ascii') \
+            if self.has_more else None
+
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'has_more': self.has_more,
+            'results': data
+        })
+
+
 # Ambulance viewset
 
 class AmbulanceViewSet(mixins.ListModelMixin,
@@ -120,7 +279,7 @@ class AmbulanceViewSet(mixins.ListModelMixin,
         serializer = CallSerializer(calls, many=True)
         return Response(serializer.data)
 
-    @action(detail=True, methods=['get', 'post'], pagination_class=AmbulancePageNumberPagination)
+    @action(detail=True, methods=['get', 'post'], pagination_class=AmbulanceUpdatePagination)
     def updates(self, request, pk=None, **kwargs):
         """Bulk retrieve/update ambulance updates."""
         if request.method == 'GET':
@@ -131,6 +290,345 @@ class AmbulanceViewSet(mixins.ListModelMixin,
             # put updates
             return self.updates_put(request, pk, updated_by=self.request.user, **kwargs)
 
+    @staticmethod
+    def parse_timestamp(value):
+        """
+        Parse an ISO timestamp, in the current time zone if it has no offset, or return None if invalid.
+        """
+        timestamp = parse_datetime(value)
+        if timestamp is not None and timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        return timestamp
+
+    @staticmethod
+    def get_time_range(request):
+        """
+        Parse ?start=x&end=y, by default the last day.
+        """
+        try:
+            end = request.query_params.get('end', None)
+            end = AmbulanceViewSet.parse_timestamp(end) if end else timezone.now()
+            start = request.query_params.get('start', None)
+            start = AmbulanceViewSet.parse_timestamp(start) if start else end - timedelta(days=1)
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        if start is None or end is None:
+            raise exceptions.ValidationError(_('Invalid start or end.'))
+        return start, end
+
+    def get_readable_ambulances(self, request):
+        """
+        Ambulances the user can read, restricted to ?ambulance=1,2 if given.
+        """
+        ambulances = self.get_queryset()
+        ambulance_ids = request.query_params.get('ambulance', None)
+        if ambulance_ids:
+            try:
+                ambulances = ambulances.filter(id__in=[int(id) for id in ambulance_ids.split(',')])
+            except ValueError as e:
+                raise exceptions.ValidationError(str(e))
+        return ambulances
+
+    @action(detail=True, methods=['get'], pagination_class=AmbulancePageNumberPagination)
+    def rollups(self, request, pk=None, **kwargs):
+        """
+        Retrieve summaries of ambulance updates.
+        Use ?start=x&end=y to select the time range, the last day by default.
+        Use ?precision=s to retrieve the coarsest summaries with buckets of at most s seconds, 3600 by default.
+        Minute summaries exist only for minutes with updates and count the time in status in those minutes only.
+        """
+
+        ambulance = self.get_object()
+
+        # parse parameters
+        (start, end) = self.get_time_range(request)
+        try:
+            precision = timedelta(seconds=float(request.query_params.get('precision', 3600)))
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+
+        rollups = get_rollups([ambulance.id], start, end, precision)
+        if rollups is None:
+            raise exceptions.ValidationError(_('Precision is finer than the available summaries, retrieve updates instead.'))
+
+        # paginate
+        page = self.paginate_queryset(rollups)
+
+        if page is not None:
+            serializer = AmbulanceUpdateRollupSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        # return all if not paginated
+        serializer = AmbulanceUpdateRollupSerializer(rollups, many=True)
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, **kwargs):
+        """
+        Stream the updates of the ambulances the user can read.
+        Use ?ambulance=1,2 to select ambulances, all readable ambulances by default.
+        Use ?start=x&end=y to select the time range, the last day by default.
+        Use ?output=ndjson|csv|geojson to select the format, ndjson by default.
+        """
+
+        # parse parameters
+        output_format = request.query_params.get('output', 'ndjson')
+        if output_format not in EXPORT_FORMATS:
+            raise exceptions.ValidationError(_('Invalid output format.'))
+        (start, end) = self.get_time_range(request)
+        ambulances = self.get_readable_ambulances(request)
+
+        response = StreamingHttpResponse(export_updates(ambulances.values('id'), start, end, output_format),
+                                         content_type=EXPORT_FORMATS[output_format])
+        response['Content-Disposition'] = 'attachment; filename="updates.{}"'.format(output_format)
+        return response
+
+    @action(detail=False, methods=['get'])
+    def snapshot(self, request, **kwargs):
+        """
+        Retrieve the last known state of the ambulances the user can read at an instant.
+        Use ?ambulance=1,2 to select ambulances, all readable ambulances by default.
+        Use ?timestamp=x to select the instant, now by default.
+        Use ?max_age=s to ignore updates older than s seconds before the instant.
+        Ambulances without updates are omitted.
+        """
+
+        # parse parameters
+        try:
+            timestamp = request.query_params.get('timestamp', None)
+            timestamp = self.parse_timestamp(timestamp) if timestamp else timezone.now()
+            max_age = request.query_params.get('max_age', None)
+            max_age = timedelta(seconds=float(max_age)) if max_age else None
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        if timestamp is None:
+            raise exceptions.ValidationError(_('Invalid timestamp.'))
+        ambulances = self.get_readable_ambulances(request)
+
+        updates = get_snapshot(ambulances.values('id'), timestamp,
+                               timestamp - max_age if max_age is not None else None)
+        serializer = AmbulanceUpdateSerializer(updates, many=True)
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def playback(self, request, **kwargs):
+        """
+        Stream the updates of the ambulances the user can read as ndjson, in order of timestamp,
+        preceded by the state of each ambulance at the start of the range.
+        Use ?ambulance=1,2 to select ambulances, all readable ambulances by default.
+        Use ?start=x&end=y to select the time range, the last day by default.
+        Use ?interval=s to play back updates of each ambulance at least s seconds apart.
+        """
+
+        # parse parameters
+        (start, end) = self.get_time_range(request)
+        try:
+            interval = request.query_params.get('interval', None)
+            interval = timedelta(seconds=float(interval)) if interval else None
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        ambulances = self.get_readable_ambulances(request)
+
+        ambulance_ids = list(ambulances.values_list('id', flat=True))
+        return StreamingHttpResponse(playback_ndjson(playback(ambulance_ids, start, end, interval)),
+                                     content_type='application/x-ndjson')
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated, IsAdminOrSuperOrDispatcher])
+    def heatmap(self, request, **kwargs):
+        """
+        Retrieve the number of fleet-wide points in each cell of a grid, as columns of cell centers and counts.
+        Use ?layer=p for ambulance positions, the default, or ?layer=i for incidents.
+        Use ?level=n to select cells of 360 / 2^n degrees, 12 by default.
+        Use ?start=x&end=y to select the time range, the last day by default.
+        Use ?bbox=min_longitude,min_latitude,max_longitude,max_latitude to select the cells in a box.
+        Only the positions and incidents of the ambulances the user can read are counted;
+        the per-day cache covers the whole fleet, so it is used only for users who can read every ambulance.
+        """
+
+        # parse parameters
+        layer = request.query_params.get('layer', HeatmapLayer.p.name)
+        if layer not in HeatmapLayer.__members__:
+            raise exceptions.ValidationError(_('Invalid layer.'))
+        try:
+            level = int(request.query_params.get('level', 12))
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        if not MINIMUM_LEVEL <= level <= MAXIMUM_LEVEL:
+            raise exceptions.ValidationError(_('Level must be between {} and {}.').format(MINIMUM_LEVEL,
+                                                                                          MAXIMUM_LEVEL))
+        (start, end) = self.get_time_range(request)
+        bbox = request.query_params.get('bbox', None)
+        if bbox:
+            bbox = LocationListMixin.parse_coordinates(bbox, 4)
+
+        size = cell_size(level)
+        result = {'layer': layer, 'level': level, 'size': size, 'longitude': [], 'latitude': [], 'count': []}
+        ambulance_ids = get_readable_ids(request.user, 'ambulances')
+        for ((x, y), count) in sorted(get_heatmap(layer, start, end, level, ambulance_ids).items()):
+            (longitude, latitude) = ((x + 0.5) * size - 180.0, (y + 0.5) * size - 90.0)
+            if bbox and not (bbox[0] <= longitude <= bbox[2] and bbox[1] <= latitude <= bbox[3]):
+                continue
+            result['longitude'].append(longitude)
+            result['latitude'].append(latitude)
+            result['count'].append(count)
+
+        return Response(result)
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated, IsAdminOrSuperOrDispatcher])
+    def coverage(self, request, **kwargs):
+        """
+        Retrieve the share of the cells of the service region within reach of an available ambulance,
+        and the centers of the cells out of reach.
+        Use ?radius=m to set the reach in meters, or ?minutes=n to set it in minutes at an average speed.
+        Use ?exclude=1,2 to also compute the coverage without some ambulances.
+        Use ?ambulance=1,2 to select ambulances, all readable ambulances by default.
+        Use ?bbox=min_longitude,min_latitude,max_longitude,max_latitude to set the region
+        and ?cell=m to set the side of the cells in meters.
+        """
+
+        # parse parameters
+        try:
+            if 'minutes' in request.query_params:
+                radius = minutes_to_radius(float(request.query_params['minutes']))
+            else:
+                radius = float(request.query_params.get('radius', COVERAGE_RADIUS))
+            cell = float(request.query_params.get('cell', COVERAGE_CELL_SIZE))
+            exclude = request.query_params.get('exclude', None)
+            exclude = [int(id) for id in exclude.split(',')] if exclude else []
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        if not (radius > 0 and cell > 0):
+            raise exceptions.ValidationError(_('Radius and cell must be positive.'))
+        bbox = request.query_params.get('bbox', None)
+        bbox = LocationListMixin.parse_coordinates(bbox, 4) if bbox else get_service_region(radius)
+        if bbox is None:
+            raise exceptions.ValidationError(_('No service region; use bbox.'))
+
+        ambulance_ids = self.get_readable_ambulances(request).values_list('id', flat=True)
+        try:
+            coverage = get_coverage(bbox, radius, cell, set(ambulance_ids), exclude)
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+
+        return Response(coverage)
+
+    @action(detail=False, methods=['get'])
+    def mileage(self, request, **kwargs):
+        """
+        Retrieve the mileage of the ambulances the user can read.
+        Use ?ambulance=1,2 to select ambulances, all readable ambulances by default.
+        Use ?start=x&end=y to select the time range, the last day by default.
+        Distances are in meters, times in seconds and speeds in m/s.
+        Ambulances without updates in the range are omitted.
+        """
+
+        # parse parameters
+        (start, end) = self.get_time_range(request)
+        ambulances = self.get_readable_ambulances(request)
+
+        identifiers = dict(ambulances.values_list('id', 'identifier'))
+        statistics = get_mileage(identifiers.keys(), start, end)
+
+        result = []
+        for (id, values) in sorted(statistics.items(), key=lambda item: identifiers[item[0]]):
+            result.append({
+                'id': id,
+                'identifier': identifiers[id],
+                **values,
+                'avg_speed': values['distance'] / values['time'] if values['time'] > 0 else 0.0,
+                'avg_moving_speed': values['moving_distance'] / values['moving_time']
+                if values['moving_time'] > 0 else 0.0
+            })
+
+        return Response(result)
+
+    @action(detail=False, methods=['get'])
+    def timeline(self, request, **kwargs):
+        """
+        Retrieve the status segments of the ambulances the user can read,
+        and the seconds spent in each status.
+        Use ?ambulance=1,2 to select ambulances, all readable ambulances by default.
+        Use ?start=x&end=y to select the time range, the last day by default.
+        Segments are returned in columns: status, start and end, in seconds since the epoch.
+        """
+
+        # parse parameters
+        (start, end) = self.get_time_range(request)
+        ambulances = self.get_readable_ambulances(request)
+
+        identifiers = dict(ambulances.values_list('id', 'identifier'))
+        timelines = get_timelines(identifiers.keys(), start, end)
+
+        result = []
+        for (id, timeline) in sorted(timelines.items(), key=lambda item: identifiers[item[0]]):
+            result.append({
+                'id': id,
+                'identifier': identifiers[id],
+                **timeline.to_dict()
+            })
+
+        return Response(result)
+
+    @action(detail=True, methods=['get'])
+    def odometer(self, request, pk=None, **kwargs):
+        """
+        Retrieve the distance in meters and the moving time in seconds of the ambulance between two times.
+        Use ?start=x&end=y to select the time range, the last day by default.
+        """
+
+        ambulance = self.get_object()
+        (start, end) = self.get_time_range(request)
+
+        (distance, moving_time) = get_odometer_distance(ambulance.id, start, end)
+        return Response({'distance': distance, 'moving_time': moving_time})
+
+    @action(detail=False, methods=['get'])
+    def nearest(self, request, **kwargs):
+        """
+        Retrieve the ambulances the user can read closest to a point.
+        Use ?latitude=x&longitude=y to set the point.
+        Use ?k=n to retrieve at most n ambulances, 5 by default.
+        Use ?status=AV,BB and ?capability=B,A to select ambulances, available ambulances by default.
+        Use ?order=eta to rank ambulances by estimated travel time instead of distance.
+        Distances are in meters; bearings are in degrees, from the ambulance to the point;
+        estimated travel times are in seconds, null if not estimated within the time budget.
+        """
+
+        # parse parameters
+        try:
+            latitude = float(request.query_params['latitude'])
+            longitude = float(request.query_params['longitude'])
+            k = int(request.query_params.get('k', 5))
+        except KeyError as e:
+            raise exceptions.ValidationError(_('Missing {}.').format(e))
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise exceptions.ValidationError(_('Invalid latitude or longitude.'))
+        if not 0 < k <= MAXIMUM_K:
+            raise exceptions.ValidationError(_('k must be between 1 and {}.').format(MAXIMUM_K))
+        status = request.query_params.get('status', AmbulanceStatus.AV.name).split(',')
+        capability = request.query_params.get('capability', None)
+        capability = capability.split(',') if capability else None
+        order = request.query_params.get('order', 'distance')
+        if order not in ('distance', 'eta'):
+            raise exceptions.ValidationError(_('Invalid order.'))
+
+        nearest = get_nearest_ambulances(self.get_queryset(), longitude, latitude, k,
+                                         status=status, capability=capability, by_eta=order == 'eta', eta=True)
+
+        return Response([{
+            'id': ambulance.id,
+            'identifier': ambulance.identifier,
+            'capability': ambulance.capability,
+            'status': ambulance.status,
+            'location': {'latitude': ambulance.location.y, 'longitude': ambulance.location.x},
+            'timestamp': ambulance.timestamp,
+            'distance': distance,
+            'bearing': bearing,
+            'eta': eta
+        } for (ambulance, distance, bearing, eta) in nearest])
+
     # Filter out the working time of ambulance and extract the unavailable time range for ambulance
     @staticmethod
     def extract_unavailable_zone(ambulance_history):
@@ -192,41 +690,78 @@ class AmbulanceViewSet(mixins.ListModelMixin,
             if len(filter_range) % 2 == 1:
                 filter_range.append(None)
             logger.debug(filter_range)
-            if filter_range:
-                ranges = []
-                for (t1, t2) in zip(*[iter(filter_range)] * 2):
-                    logger.debug((t1, t2))
-                    if t2 is None:
-                        ranges.append(history.filter(timestamp__gte=t1))
-                    else:
-                        ranges.append(history.filter(timestamp__range=(t1, t2)))
-
-                # calculate union of the active intervals
-                if len(ranges) == 1:
-                    history = ranges[0]
-                elif len(ranges) > 1:
-                    history = ranges[0].union(*ranges[1:])
 
-            else:
-                # no active time yet, return nothing!
-                history = history.none()
+            # combine the active intervals in a single query
+            active = Q()
+            for (t1, t2) in zip(*[iter(filter_range)] * 2):
+                logger.debug((t1, t2))
+                if t2 is None:
+                    active |= Q(timestamp__gte=t1)
+                else:
+                    active |= Q(timestamp__range=(t1, t2))
+            history = history.filter(active)
 
-        # order records in descending order
-        history = history.order_by(order_by)
+        # order records
+        history = history.order_by(*history_ordering(order_by))
         logger.debug(history)
 
         return history
 
+    @staticmethod
+    def simplify_history(history, order_by, tolerance=None, bucket=None):
+        """
+        Simplify history, keeping at most one update per bucket of seconds
+        and dropping updates closer than tolerance meters to the simplified trajectory.
+        Status changes are always kept.
+        """
+
+        # retrieve coordinates only, in chronological order
+        rows = sorted(history.values_list('id', 'timestamp', 'status', 'longitude', 'latitude'),
+                      key=lambda row: row[1])
+        if not rows:
+            return history
+
+        (ids, timestamps, status, longitude, latitude) = zip(*rows)
+        indices = simplify_trajectory(longitude, latitude,
+                                      [t.timestamp() for t in timestamps], status,
+                                      tolerance=tolerance, bucket=bucket)
+
+        # the timestamp range restricts the lookup to the relevant partitions
+        return AmbulanceUpdate.objects \
+            .filter(id__in=[ids[k] for k in indices], timestamp__range=(timestamps[0], timestamps[-1])) \
+            .select_related('updated_by') \
+            .order_by(*history_ordering(order_by))
+
     def updates_get(self, request, pk=None, **kwargs):
         """
         Retrieve and paginate ambulance updates.
-        Use ?page=10&page_size=100 to control pagination.
+        Use ?page=10&page_size=100 to control pagination,
+        or ?cursor=&page_size=100 and follow next for keyset pagination.
         Use ?call_id=x to retrieve updates to call x.
+        Use ?simplify=m to drop updates closer than m meters to the simplified trajectory.
+        Use ?bucket=s to retrieve at most one update every s seconds.
+        Status changes are kept when simplifying.
         """
 
+        # parse simplification parameters
+        try:
+            tolerance = request.query_params.get('simplify', None)
+            tolerance = float(tolerance) if tolerance else None
+            bucket = request.query_params.get('bucket', None)
+            bucket = float(bucket) if bucket else None
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        if (tolerance is not None and tolerance < 0) or (bucket is not None and bucket <= 0):
+            raise exceptions.ValidationError(_('Invalid simplify or bucket.'))
+
         # retrieve updates
         ambulance = self.get_object()
         ambulance_updates = ambulance.ambulanceupdate_set.all()
+        if tolerance is not None or bucket is not None:
+            # coordinates for simplification
+            ambulance_updates = ambulance_updates.annotate(
+                longitude=Func(F('location'), function='ST_X', output_field=FloatField()),
+                latitude=Func(F('location'), function='ST_Y', output_field=FloatField()))
         # logger.debug(ambulance_updates)
 
         # retrieve only call updates
@@ -260,7 +795,7 @@ class AmbulanceViewSet(mixins.ListModelMixin,
 
                 if not filter_range:
                     # no active time yet, return nothing!
-                    ambulance_updates = AmbulanceUpdate.objects.none()
+                    ambulance_updates = ambulance_updates.none()
 
             else:
 
@@ -278,7 +813,7 @@ class AmbulanceViewSet(mixins.ListModelMixin,
 
                 # call hasn't started yet, return none
                 else:
-                    ambulance_updates = AmbulanceUpdate.objects.none()
+                    ambulance_updates = ambulance_updates.none()
                     filter_range = ()
 
             # order records in ascending order
@@ -299,6 +834,10 @@ class AmbulanceViewSet(mixins.ListModelMixin,
         # filter history
         ambulance_updates = self.filter_history(ambulance_updates, filter_range, order_by)
 
+        # simplify history
+        if tolerance is not None or bucket is not None:
+            ambulance_updates = self.simplify_history(ambulance_updates, order_by, tolerance, bucket)
+
         # for entry in ambulance_updates:
         #     logger.debug(entry.timestamp)
 
@@ -313,6 +852,104 @@ class AmbulanceViewSet(mixins.ListModelMixin,
         serializer = AmbulanceUpdateCompactSerializer(ambulance_updates, many=True)
         return Response(serializer.data)
 
+    # number of updates validated and stored at a time by upload
+    upload_chunk_size = 1000
+
+    @action(detail=True, methods=['post'])
+    def upload(self, request, pk=None, **kwargs):
+        """
+        Stream ambulance updates as newline-delimited JSON, gzip compressed if Content-Encoding is gzip.
+        Every update must have a timestamp. Updates are stored in chunks as they arrive,
+        and updates already stored with the same timestamp and location are skipped,
+        so an interrupted upload can be resumed by posting it again.
+        Odometers after late updates are repaired once, when the upload ends.
+        Responds with the progress made, even if the upload fails halfway.
+        """
+
+        # retrieve ambulance
+        ambulance = self.get_object()
+
+        # read the body as a stream
+        stream = request.stream
+        if stream is None:
+            stream = io.BytesIO()
+        if request.META.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+        lines = iterate_lines(stream)
+
+        progress = {'lines': 0, 'created': 0, 'skipped': 0, 'chunks': 0,
+                    'last_timestamp': None, 'complete': False}
+
+        try:
+            with defer_odometers():
+                chunk = []
+                for line in lines:
+                    progress['lines'] += 1
+                    line = line.strip()
+                    if not line:
+                        continue
+                    chunk.append(json.loads(line))
+                    if len(chunk) >= self.upload_chunk_size:
+                        self.upload_chunk(ambulance, chunk, progress)
+                        chunk = []
+                self.upload_chunk(ambulance, chunk, progress)
+            progress['complete'] = True
+
+        except (ValueError, EOFError, OSError, zlib.error) as e:
+            # malformed or truncated body: report progress so far
+            logger.info('Ambulance {} upload interrupted: {}'.format(ambulance.id, e))
+            progress['error'] = str(e)
+            return Response(progress, status=HTTP_400_BAD_REQUEST)
+
+        except exceptions.ValidationError as e:
+            progress['error'] = e.detail
+            return Response(progress, status=HTTP_400_BAD_REQUEST)
+
+        return Response(progress)
+
+    def upload_chunk(self, ambulance, chunk, progress):
+
+        if not chunk:
+            return
+
+        # validate
+        serializer = AmbulanceUpdateSerializer(data=chunk, many=True)
+        serializer.is_valid(raise_exception=True)
+        validated_data = serializer.validated_data
+        if any('timestamp' not in data for data in validated_data):
+            raise exceptions.ValidationError(_('Uploaded updates must have a timestamp.'))
+
+        # current ambulance state, as left by the previous chunk
+        ambulance = Ambulance.objects.get(id=ambulance.id)
+
+        # skip updates already stored at the same time and place, e.g. by an interrupted upload
+        def get_key(timestamp, location):
+            return timestamp, location.coords if location is not None else None
+
+        timestamps = [data['timestamp'] for data in validated_data]
+        existing = set(get_key(*values) for values in AmbulanceUpdate.objects
+                       .filter(ambulance=ambulance, timestamp__range=(min(timestamps), max(timestamps)))
+                       .values_list('timestamp', 'location'))
+        updates = []
+        for data in sorted(validated_data, key=lambda d: d['timestamp']):
+            key = get_key(data['timestamp'], data.get('location'))
+            if key in existing:
+                continue
+            existing.add(key)
+            data['ambulance'] = ambulance
+            data['updated_by'] = self.request.user
+            updates.append(data)
+
+        # store through the bulk insert path;
+        # a backlog older than the current ambulance state is stored as history only
+        if updates:
+            serializer.create(updates, update_ambulance=updates[-1]['timestamp'] > ambulance.timestamp)
+
+        progress['chunks'] += 1
+        progress['created'] += len(updates)
+        progress['skipped'] += len(validated_data) - len(updates)
+        progress['last_timestamp'] = max(timestamps)
+
     def updates_put(self, request, pk=None, **kwargs):
         """
         Bulk ambulance updates.
@@ -336,7 +973,71 @@ class AmbulanceViewSet(mixins.ListModelMixin,
 
 # Location viewset
 
-class LocationViewSet(mixins.ListModelMixin,
+class LocationListMixin:
+    """
+    Spatial filters, cursor pagination and conditional requests for location lists.
+    Use ?bbox=min_longitude,min_latitude,max_longitude,max_latitude to select the locations in a box,
+    ?near=longitude,latitude&radius=meters to select the locations within radius, 1000 meters by default.
+    Lists carry an ETag and a Last-Modified header from the latest update of the selected locations.
+    """
+    pagination_class = LocationCursorPagination
+
+    @staticmethod
+    def parse_coordinates(value, count):
+        try:
+            coordinates = [float(coordinate) for coordinate in value.split(',')]
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        if len(coordinates) != count:
+            raise exceptions.ValidationError(_('Expected {} coordinates.').format(count))
+        return coordinates
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+
+        bbox = self.request.query_params.get('bbox', None)
+        if bbox:
+            queryset = queryset.filter(location__intersects=Polygon.from_bbox(self.parse_coordinates(bbox, 4)))
+
+        near = self.request.query_params.get('near', None)
+        if near:
+            (longitude, latitude) = self.parse_coordinates(near, 2)
+            try:
+                radius = float(self.request.query_params.get('radius', 1000))
+            except ValueError as e:
+                raise exceptions.ValidationError(str(e))
+            point = Point(longitude, latitude, srid=4326)
+
+            # the box around the circle walks the spatial index, the distance is exact
+            queryset = queryset.filter(location__dwithin=(point, radius_degrees(radius, latitude)),
+                                       location__distance_lte=(point, D(m=radius)))
+
+        return queryset.order_by('id')
+
+    def list(self, request, *args, **kwargs):
+
+        # latest update and number of the selected locations, to catch deletions
+        latest = self.filter_queryset(self.get_queryset()) \
+            .aggregate(last_modified=Max('updated_on'), count=Count('id'))
+        last_modified = int(latest['last_modified'].timestamp()) if latest['last_modified'] is not None else None
+        etag = '"{}"'.format(hashlib.md5('{}|{}|{}'.format(request.get_full_path(), latest['last_modified'],
+                                                            latest['count']).encode('utf-8')).hexdigest())
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+
+        # revalidate on every load
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = 'private, no-cache'
+
+        return response
+
+
+class LocationViewSet(LocationListMixin,
+                      mixins.ListModelMixin,
                       viewsets.GenericViewSet):
     """
     API endpoint for manipulating locations.
@@ -348,7 +1049,8 @@ class LocationViewSet(mixins.ListModelMixin,
     serializer_class = LocationSerializer
 
 
-class LocationTypeViewSet(mixins.ListModelMixin,
+class LocationTypeViewSet(LocationListMixin,
+                          mixins.ListModelMixin,
                           viewsets.GenericViewSet):
     """
     API endpoint for manipulating locations.
@@ -49,6 +49,9 @@ psql -f init/init.psql -d postgres://postgres:$DB_PASSWORD@$DB_HOST
 python manage.py makemigrations ambulance login hospital equipment
 python manage.py migrate
 
+# Partition ambulance update history by month
+python manage.py partitionupdates --setup
+
 # Has backup?
 if [ -e "/etc/emstrack/fixtures/backup.json" ] ;
 then
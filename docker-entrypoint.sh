@@ -33,6 +33,9 @@ then
 
     fi
 
+    echo "> Creating ambulance update partitions"
+    python manage.py partitionupdates || echo "> Could not create partitions"
+
     echo "> Starting uWSGI"
     # nohup bash -c "uwsgi --touch-reload=/home/worker/app/reload --http 0.0.0.0:8000 --module emstrack.wsgi > /etc/emstrack/log/uwsgi.log 2>&1 &"
     # python manage.py runserver 0.0.0.0:8000
@@ -0,0 +1,103 @@
+import logging
+
+import numpy as np
+
+from .latlon import earth_radius
+
+logger = logging.getLogger(__name__)
+
+# Vectorised versions of emstrack.latlon for arrays of coordinates in degrees
+# https://www.movable-type.co.uk/scripts/latlong.html
+#
+# Coordinates are passed as longitude and latitude arrays, in the order of Point(x, y),
+# and follow numpy broadcasting rules.
+
+
+def calculate_orientations(longitude1, latitude1, longitude2, latitude2):
+
+    # convert latitude and longitude to radians first
+    lat1 = np.radians(latitude1)
+    lat2 = np.radians(latitude2)
+    d_lambda = np.radians(np.subtract(longitude2, longitude1))
+
+    # calculate orientation and convert to degrees
+    orientation = np.degrees(np.arctan2(np.sin(d_lambda) * np.cos(lat2),
+                                        np.cos(lat1) * np.sin(lat2) -
+                                        np.sin(lat1) * np.cos(lat2) * np.cos(d_lambda)))
+
+    return np.where(orientation < 0, orientation + 360, orientation)
+
+
+def calculate_distances_haversine(longitude1, latitude1, longitude2, latitude2):
+
+    # convert latitude and longitude to radians first
+    lat1 = np.radians(latitude1)
+    lat2 = np.radians(latitude2)
+    d_phi = lat2 - lat1
+    d_lambda = np.radians(np.subtract(longitude2, longitude1))
+
+    a = np.sin(d_phi / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lambda / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    return earth_radius * c
+
+
+def calculate_distances_rectangular(longitude1, latitude1, longitude2, latitude2):
+
+    # convert latitude and longitude to radians first
+    lat1 = np.radians(latitude1)
+    lat2 = np.radians(latitude2)
+    d_lambda = np.radians(np.subtract(longitude2, longitude1))
+
+    x = d_lambda * np.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+
+    return earth_radius * np.sqrt(x * x + y * y)
+
+
+# default calculate_distances
+calculate_distances = calculate_distances_haversine
+
+
+def track_distances(longitude, latitude, method=calculate_distances):
+    """
+    Distances between consecutive points of a track; one less than the number of points.
+    """
+    longitude = np.asarray(longitude, dtype=float)
+    latitude = np.asarray(latitude, dtype=float)
+    return method(longitude[:-1], latitude[:-1], longitude[1:], latitude[1:])
+
+
+def track_orientations(longitude, latitude):
+    """
+    Orientations between consecutive points of a track; one less than the number of points.
+    """
+    longitude = np.asarray(longitude, dtype=float)
+    latitude = np.asarray(latitude, dtype=float)
+    return calculate_orientations(longitude[:-1], latitude[:-1], longitude[1:], latitude[1:])
+
+
+def distances_to(longitude, latitude, longitude0, latitude0, method=calculate_distances):
+    """
+    Distances from each point to the point at longitude0 and latitude0.
+    """
+    return method(np.asarray(longitude, dtype=float), np.asarray(latitude, dtype=float),
+                  longitude0, latitude0)
+
+
+def distance_matrix(longitude1, latitude1, longitude2, latitude2, method=calculate_distances):
+    """
+    Matrix of the distances from each of the first points (rows) to each of the second points (columns).
+    """
+    return method(np.asarray(longitude1, dtype=float)[:, np.newaxis],
+                  np.asarray(latitude1, dtype=float)[:, np.newaxis],
+                  np.asarray(longitude2, dtype=float)[np.newaxis, :],
+                  np.asarray(latitude2, dtype=float)[np.newaxis, :])
+
+
+def point_coordinates(points):
+    """
+    Longitude and latitude arrays of an iterable of GEOS points.
+    """
+    coordinates = np.array([point.coords for point in points], dtype=float).reshape(-1, 2)
+    return coordinates[:, 0], coordinates[:, 1]
@@ -0,0 +1,86 @@
+import time
+
+import numpy as np
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand
+
+from emstrack import latlon, latlon_batch
+
+
+class Command(BaseCommand):
+    help = 'Compare scalar and vectorised distance and orientation calculations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 10000, 100000])
+        parser.add_argument('--matrix', type=int, default=500,
+                            help='number of points on each side of the distance matrix')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    @staticmethod
+    def measure(function, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = function()
+        return (time.perf_counter() - start) / repeat, result
+
+    def compare(self, name, size, scalar, vectorised, repeat):
+
+        (scalar_time, expected) = self.measure(scalar, repeat)
+        (vectorised_time, result) = self.measure(vectorised, repeat)
+        error = np.max(np.abs(np.asarray(expected) - np.ravel(result))) if size else 0.0
+
+        self.stdout.write('{:<24} {:>8} {:>12.3f} {:>12.3f} {:>9.1f}x {:>10.2e}'.format(
+            name, size, 1000 * scalar_time, 1000 * vectorised_time,
+            scalar_time / vectorised_time if vectorised_time else float('inf'), error))
+
+    def handle(self, *args, **options):
+
+        repeat = options['repeat']
+        rng = np.random.RandomState(0)
+
+        self.stdout.write('{:<24} {:>8} {:>12} {:>12} {:>10} {:>10}'.format('function', 'points',
+                                                                           'scalar (ms)', 'batch (ms)',
+                                                                           'speedup', 'max error'))
+
+        for size in options['sizes']:
+
+            # random track around San Diego
+            longitude = -117.1 + np.cumsum(rng.normal(0, 1e-4, size))
+            latitude = 32.7 + np.cumsum(rng.normal(0, 1e-4, size))
+            points = [Point(x, y, srid=4326) for (x, y) in zip(longitude, latitude)]
+
+            self.compare('track haversine', size,
+                         lambda: [latlon.calculate_distance_haversine(p1, p2)
+                                  for (p1, p2) in zip(points[:-1], points[1:])],
+                         lambda: latlon_batch.track_distances(longitude, latitude,
+                                                              latlon_batch.calculate_distances_haversine),
+                         repeat)
+            self.compare('track rectangular', size,
+                         lambda: [latlon.calculate_distance_rectangular(p1, p2)
+                                  for (p1, p2) in zip(points[:-1], points[1:])],
+                         lambda: latlon_batch.track_distances(longitude, latitude,
+                                                              latlon_batch.calculate_distances_rectangular),
+                         repeat)
+            self.compare('track orientation', size,
+                         lambda: [latlon.calculate_orientation(p1, p2)
+                                  for (p1, p2) in zip(points[:-1], points[1:])],
+                         lambda: latlon_batch.track_orientations(longitude, latitude),
+                         repeat)
+            self.compare('one to many', size,
+                         lambda: [latlon.calculate_distance(points[0], p) for p in points],
+                         lambda: latlon_batch.distances_to(longitude, latitude, longitude[0], latitude[0]),
+                         repeat)
+            self.compare('points to coordinates', size,
+                         lambda: [c for p in points for c in p.coords],
+                         lambda: np.column_stack(latlon_batch.point_coordinates(points)),
+                         repeat)
+
+        # many to many
+        size = options['matrix']
+        longitude = -117.1 + rng.normal(0, 0.1, size)
+        latitude = 32.7 + rng.normal(0, 0.1, size)
+        points = [Point(x, y, srid=4326) for (x, y) in zip(longitude, latitude)]
+        self.compare('distance matrix', size * size,
+                     lambda: [latlon.calculate_distance(p1, p2) for p1 in points for p2 in points],
+                     lambda: latlon_batch.distance_matrix(longitude, latitude, longitude, latitude),
+                     repeat)
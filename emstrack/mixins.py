@@ -4,6 +4,7 @@ import tempfile
 
 from django.contrib import messages
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.db import transaction
 from django.http import HttpResponseRedirect, HttpResponse
 from django.template.response import TemplateResponse
 from django.utils.encoding import force_text
@@ -69,33 +70,32 @@ class BasePermissionMixin:
         if user.is_anonymous:
             raise PermissionDenied()
 
-        # get permissions
-        from login.permissions import get_permissions
-        permissions = get_permissions(user)
+        # get permissions subquery
+        from login.permissions import get_permitted_ids
 
         # otherwise only return objects that the user can read or write to
         # if dispatcher_override is True substitute read permissions for write permissions
         if self.request.method == 'GET' or (self.dispatcher_override and user.userprofile.is_dispatcher):
             # objects that the user can read
-            can_do = permissions.get_can_read(self.profile_field)
+            can_do = get_permitted_ids(user, self.profile_field)
 
         elif (self.request.method == 'PUT' or
               self.request.method == 'PATCH' or
               self.request.method == 'DELETE'):
             # objects that the user can write to
-            can_do = permissions.get_can_write(self.profile_field)
+            can_do = get_permitted_ids(user, self.profile_field, can_write=True)
 
         else:
             raise PermissionDenied()
 
-        # add filter
-        filter_params = {self.filter_field + '__in': can_do}
-
-        logger.debug('can_do = {}'.format(can_do))
-        logger.debug('filter_params = {}'.format(filter_params))
-
         # retrieve query
-        return super().get_queryset().filter(**filter_params)
+        return self.filter_permitted(super().get_queryset(), can_do)
+
+    def filter_permitted(self, queryset, can_do):
+        """
+        Restrict queryset to objects whose filter_field is in the can_do subquery.
+        """
+        return queryset.filter(**{self.filter_field + '__in': can_do})
 
 
 class SuccessMessageWithInlinesMixin:
@@ -112,6 +112,16 @@ class SuccessMessageWithInlinesMixin:
         return super().forms_valid(form, inlines)
 
 
+class AtomicWithInlinesMixin:
+
+    def forms_valid(self, form, inlines):
+
+        # save form and inlines in a single transaction so that
+        # side effects such as cache invalidation happen only once on commit
+        with transaction.atomic():
+            return super().forms_valid(form, inlines)
+
+
 class UpdatedByWithInlinesMixin:
 
     def forms_valid(self, form, inlines):
@@ -0,0 +1,63 @@
+import numpy as np
+from django.contrib.gis.geos import Point
+from django.test import SimpleTestCase
+
+from emstrack import latlon, latlon_batch
+
+
+class TestLatLonBatch(SimpleTestCase):
+
+    def setUp(self):
+
+        # random points around San Diego, including the antimeridian and poles as edge cases
+        rng = np.random.RandomState(0)
+        self.longitude = np.concatenate([-117.1 + rng.normal(0, 0.1, 50), [179.9, -179.9, 0, 0]])
+        self.latitude = np.concatenate([32.7 + rng.normal(0, 0.1, 50), [0, 0, 90, -90]])
+        self.points = [Point(x, y, srid=4326) for (x, y) in zip(self.longitude, self.latitude)]
+
+    def test_track(self):
+
+        pairs = list(zip(self.points[:-1], self.points[1:]))
+
+        expected = [latlon.calculate_distance_haversine(p1, p2) for (p1, p2) in pairs]
+        np.testing.assert_allclose(latlon_batch.track_distances(self.longitude, self.latitude),
+                                   expected, rtol=1e-9, atol=1e-6)
+
+        expected = [latlon.calculate_distance_rectangular(p1, p2) for (p1, p2) in pairs]
+        np.testing.assert_allclose(latlon_batch.track_distances(self.longitude, self.latitude,
+                                                                latlon_batch.calculate_distances_rectangular),
+                                   expected, rtol=1e-9, atol=1e-6)
+
+        expected = [latlon.calculate_orientation(p1, p2) for (p1, p2) in pairs]
+        np.testing.assert_allclose(latlon_batch.track_orientations(self.longitude, self.latitude),
+                                   expected, rtol=1e-9, atol=1e-9)
+
+    def test_one_to_many(self):
+
+        origin = self.points[0]
+        expected = [latlon.calculate_distance(origin, p) for p in self.points]
+        np.testing.assert_allclose(latlon_batch.distances_to(self.longitude, self.latitude, origin.x, origin.y),
+                                   expected, rtol=1e-9, atol=1e-6)
+
+    def test_distance_matrix(self):
+
+        matrix = latlon_batch.distance_matrix(self.longitude[:10], self.latitude[:10],
+                                              self.longitude, self.latitude)
+        self.assertEqual(matrix.shape, (10, len(self.points)))
+        for i in range(10):
+            for j in range(len(self.points)):
+                self.assertAlmostEqual(matrix[i, j],
+                                       latlon.calculate_distance(self.points[i], self.points[j]),
+                                       delta=1e-6)
+
+        # zero diagonal
+        np.testing.assert_allclose(np.diag(matrix[:, :10]), 0, atol=1e-6)
+
+    def test_point_coordinates(self):
+
+        (longitude, latitude) = latlon_batch.point_coordinates(self.points)
+        np.testing.assert_array_equal(longitude, self.longitude)
+        np.testing.assert_array_equal(latitude, self.latitude)
+
+        (longitude, latitude) = latlon_batch.point_coordinates([])
+        self.assertEqual(len(longitude), 0)
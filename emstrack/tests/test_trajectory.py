@@ -0,0 +1,117 @@
+import logging
+import time
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from emstrack.trajectory import to_meters, douglas_peucker, bucket_mask, change_mask, simplify_trajectory
+
+logger = logging.getLogger(__name__)
+
+
+def segment_distance(px, py, x1, y1, x2, y2):
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    t = 0 if length2 == 0 else min(1, max(0, ((px - x1) * dx + (py - y1) * dy) / length2))
+    return np.hypot(px - x1 - t * dx, py - y1 - t * dy)
+
+
+def random_track(n, seed=0):
+    # vehicle driving around San Diego at 10m/s with a slowly wandering heading, one update per second
+    rng = np.random.RandomState(seed)
+    heading = np.cumsum(rng.normal(0, 0.05, n))
+    latitude = 32.7 + np.cumsum(10 * np.sin(heading)) / 111195
+    longitude = -117.1 + np.cumsum(10 * np.cos(heading)) / (111195 * np.cos(np.radians(32.7)))
+    timestamps = 1.5e9 + np.arange(n, dtype=float)
+    status = np.where((np.arange(n) // (n // 10 + 1)) % 2, 'PB', 'AV')
+    return longitude, latitude, timestamps, status
+
+
+class TestTrajectory(SimpleTestCase):
+
+    def test_to_meters(self):
+
+        # one degree of latitude is about 111km
+        (x, y) = to_meters([0, 0], [0, 1])
+        self.assertAlmostEqual(y[1] - y[0], 111195, delta=1)
+        self.assertAlmostEqual(x[1] - x[0], 0)
+
+    def test_douglas_peucker(self):
+
+        # straight line collapses to its endpoints
+        x = np.arange(10, dtype=float)
+        y = np.zeros(10)
+        self.assertListEqual(list(np.flatnonzero(douglas_peucker(x, y, 0.1))), [0, 9])
+
+        # zigzag above the tolerance is kept, below is dropped
+        y = np.array([0, 1] * 5, dtype=float)
+        self.assertEqual(douglas_peucker(x, y, 0.5).sum(), 10)
+        self.assertEqual(douglas_peucker(x, y, 2).sum(), 2)
+
+        # forced points are kept
+        keep = np.zeros(10, dtype=bool)
+        keep[4] = True
+        self.assertListEqual(list(np.flatnonzero(douglas_peucker(x, y, 2, keep))), [0, 4, 9])
+
+        # empty and single point
+        self.assertEqual(douglas_peucker(np.array([]), np.array([]), 1).sum(), 0)
+        self.assertEqual(douglas_peucker(np.array([1.]), np.array([1.]), 1).sum(), 1)
+
+    def test_tolerance(self):
+
+        # every dropped point is within tolerance of the simplified polyline
+        (longitude, latitude, timestamps, status) = random_track(2000)
+        (x, y) = to_meters(longitude, latitude)
+        tolerance = 25
+        kept = np.flatnonzero(douglas_peucker(x, y, tolerance))
+        for (i, j) in zip(kept[:-1], kept[1:]):
+            for k in range(i + 1, j):
+                self.assertLessEqual(segment_distance(x[k], y[k], x[i], y[i], x[j], y[j]), tolerance + 1e-6)
+
+    def test_bucket_and_change_mask(self):
+
+        self.assertListEqual(list(bucket_mask([0, 1, 9, 10, 11, 25], 10)),
+                             [True, False, False, True, False, True])
+        self.assertListEqual(list(change_mask(['AV', 'AV', 'PB', 'PB', 'AV'])),
+                             [True, False, True, False, True])
+
+    def test_simplify_trajectory(self):
+
+        (longitude, latitude, timestamps, status) = random_track(1000)
+
+        # status changes, first and last points are kept
+        indices = simplify_trajectory(longitude, latitude, timestamps, status, tolerance=50)
+        changes = np.flatnonzero(change_mask(status))
+        self.assertTrue(set(changes).issubset(indices))
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], 999)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+
+        # at most one point per minute besides status changes and the last point
+        indices = simplify_trajectory(longitude, latitude, timestamps, status, bucket=60)
+        self.assertLessEqual(len(indices), 1000 // 60 + 1 + len(changes) + 1)
+
+        # nothing to do
+        self.assertListEqual(list(simplify_trajectory(longitude, latitude, timestamps, status)),
+                             list(range(1000)))
+
+    def test_timing(self):
+
+        # 100k-point track
+        n = 100000
+        (longitude, latitude, timestamps, status) = random_track(n)
+
+        start = time.perf_counter()
+        indices = simplify_trajectory(longitude, latitude, timestamps, status, tolerance=50)
+        elapsed = time.perf_counter() - start
+        logger.info('simplify_trajectory: {} points to {} in {:.3f}s'.format(n, len(indices), elapsed))
+
+        start = time.perf_counter()
+        bucketed = simplify_trajectory(longitude, latitude, timestamps, status, tolerance=50, bucket=30)
+        elapsed_bucket = time.perf_counter() - start
+        logger.info('simplify_trajectory: {} points to {} in {:.3f}s with buckets'.format(n, len(bucketed),
+                                                                                           elapsed_bucket))
+
+        self.assertLess(len(indices), n // 10)
+        self.assertLessEqual(len(bucketed), len(indices))
+        self.assertLess(elapsed, 10)
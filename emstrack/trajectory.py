@@ -0,0 +1,130 @@
+import logging
+
+import numpy as np
+
+from .latlon import earth_radius
+
+logger = logging.getLogger(__name__)
+
+# Simplify trajectories for display
+# https://en.wikipedia.org/wiki/Ramer%E2%80%93Douglas%E2%80%93Peucker_algorithm
+
+
+def to_meters(longitude, latitude):
+    """
+    Project longitudes and latitudes in degrees to planar coordinates in meters,
+    equirectangular around the mean latitude; accurate enough for tracks within a city.
+    """
+
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+
+    lat0 = np.radians(latitude.mean()) if latitude.size else 0.0
+    x = earth_radius * np.radians(longitude) * np.cos(lat0)
+    y = earth_radius * np.radians(latitude)
+
+    return x, y
+
+
+def douglas_peucker(x, y, tolerance, keep=None):
+    """
+    Return a mask of the points to keep so that no point is farther than tolerance
+    from the simplified polyline. Points in keep are never dropped and split the polyline.
+    """
+
+    n = len(x)
+    mask = np.zeros(n, dtype=bool)
+    if n == 0:
+        return mask
+
+    # endpoints and forced points are always kept
+    mask[0] = mask[-1] = True
+    if keep is not None:
+        mask |= keep
+
+    # simplify between consecutive kept points
+    anchors = np.flatnonzero(mask)
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while stack:
+
+        (i, j) = stack.pop()
+        if j - i < 2:
+            continue
+
+        # distances of the points between i and j to the segment from i to j
+        dx = x[j] - x[i]
+        dy = y[j] - y[i]
+        px = x[i + 1:j] - x[i]
+        py = y[i + 1:j] - y[i]
+        length2 = dx * dx + dy * dy
+        if length2 > 0:
+            t = np.clip((px * dx + py * dy) / length2, 0, 1)
+            distance = np.hypot(px - t * dx, py - t * dy)
+        else:
+            distance = np.hypot(px, py)
+
+        # split at the farthest point, if too far
+        k = int(np.argmax(distance))
+        if distance[k] > tolerance:
+            m = i + 1 + k
+            mask[m] = True
+            stack.append((i, m))
+            stack.append((m, j))
+
+    return mask
+
+
+def bucket_mask(timestamps, seconds):
+    """
+    Return a mask of the first point in each time bucket of the given length in seconds.
+    Timestamps are in seconds, in ascending order.
+    """
+
+    buckets = np.floor_divide(np.asarray(timestamps, dtype=float), seconds)
+    mask = np.ones(len(buckets), dtype=bool)
+    mask[1:] = buckets[1:] != buckets[:-1]
+    return mask
+
+
+def change_mask(values):
+    """
+    Return a mask of the points whose value differs from the previous point.
+    """
+
+    values = np.asarray(values)
+    mask = np.ones(len(values), dtype=bool)
+    mask[1:] = values[1:] != values[:-1]
+    return mask
+
+
+def simplify_trajectory(longitude, latitude, timestamps, status, tolerance=None, bucket=None):
+    """
+    Return the indices of the points of a trajectory, in ascending order of timestamps, to keep:
+    at most one point per bucket of seconds, then only points farther than tolerance meters
+    from the simplified polyline. First and last points and status changes are always kept.
+    """
+
+    n = len(timestamps)
+    indices = np.arange(n)
+    if n < 3:
+        return indices
+
+    # first, last and status change points
+    forced = change_mask(status)
+    forced[-1] = True
+
+    # downsample in time
+    if bucket:
+        selected = bucket_mask(timestamps, bucket) | forced
+        indices = indices[selected]
+        forced = forced[selected]
+
+    # simplify in space
+    if tolerance is not None:
+        (x, y) = to_meters(np.asarray(longitude, dtype=float)[indices],
+                           np.asarray(latitude, dtype=float)[indices])
+        indices = indices[douglas_peucker(x, y, tolerance, forced)]
+
+    logger.debug('simplify_trajectory: kept {} out of {} points'.format(len(indices), n))
+
+    return indices
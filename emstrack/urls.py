@@ -11,6 +11,7 @@ from drf_yasg import openapi
 from login.viewsets import ProfileViewSet, ClientViewSet
 from login.views import PasswordView, SettingsView, VersionView
 
+from ambulance.views import TileView
 from ambulance.viewsets import AmbulanceEquipmentItemViewSet, AmbulanceViewSet, \
     LocationViewSet, LocationTypeViewSet, CallViewSet, CallPriorityViewSet, \
     CallRadioViewSet, AmbulanceCallWaypointViewSet, CallNoteViewSet
@@ -115,6 +116,11 @@ urlpatterns = i18n_patterns(*[
         VersionView.as_view(),
         name='version'),
 
+    # Add vector tiles to api
+    url(r'^api/tiles/(?P<layer>[a-z]+)/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)\.mvt$',
+        TileView.as_view(),
+        name='tiles'),
+
 ])
 
 urlpatterns += i18n_patterns(*[
@@ -1,3 +1,4 @@
+from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -15,3 +16,29 @@ def make_choices_and_translate(choices):
     """
     return [(m.name, _(m.value)) for m in choices]
 
+
+def is_on_commit_pending(func, using=None):
+    """
+    Returns True if func is waiting to run when the current transaction commits.
+    Callbacks are discarded when their transaction or savepoint rolls back.
+    """
+    connection = transaction.get_connection(using)
+    return any(callback[1] is func for callback in connection.run_on_commit)
+
+
+def iterate_lines(stream, size=65536):
+    """
+    Iterate over the lines of a binary stream, read size bytes at a time, decoded as utf-8.
+    Works with any object with a read method, such as a request.
+    """
+    remainder = b''
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        lines = (remainder + data).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if remainder:
+        yield remainder.decode('utf-8')
@@ -14,3 +14,18 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "emstrack.settings")
 
 application = get_wsgi_application()
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    # not running under uwsgi
+    postfork = None
+
+if postfork is not None:
+
+    @postfork
+    def warm_up_permissions():
+        from login.permissions import PERMISSION_WARMUP, warm_up
+        if PERMISSION_WARMUP:
+            # precompute permissions of the recently active users in each worker
+            warm_up()
@@ -0,0 +1,79 @@
+import time
+
+from django.contrib.auth.models import User, Group
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ambulance.models import Ambulance, AmbulanceCapability
+from equipment.models import EquipmentHolder
+from login.models import GroupAmbulancePermission
+from login.permissions import Permissions, get_permitted_ids
+
+
+class Command(BaseCommand):
+    help = 'Compare query time and SQL size of id list versus subquery permission filtering'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000, 5000])
+        parser.add_argument('--repeat', type=int, default=10)
+
+    @staticmethod
+    def measure(queryset, repeat):
+
+        # time evaluation of the queryset
+        start = time.perf_counter()
+        for _ in range(repeat):
+            list(queryset.values_list('id', flat=True))
+        elapsed = (time.perf_counter() - start) / repeat
+
+        # size of the generated sql
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            size = len(cursor.mogrify(sql, params))
+
+        return elapsed, size
+
+    def handle(self, *args, **options):
+
+        repeat = options['repeat']
+
+        self.stdout.write('{:>8} {:>14} {:>12} {:>14} {:>12}'.format('ids',
+                                                                    'list (ms)', 'list (B)',
+                                                                    'subquery (ms)', 'subquery (B)'))
+
+        for size in options['sizes']:
+
+            # all data is created in a transaction that is rolled back at the end
+            with transaction.atomic():
+
+                admin = User.objects.filter(is_superuser=True).first()
+                user = User.objects.create_user(username='permissionsbenchmark')
+                group = Group.objects.create(name='permissionsbenchmark')
+                user.groups.add(group)
+
+                # bulk create ambulances without side effects
+                holders = EquipmentHolder.objects.bulk_create([EquipmentHolder() for _ in range(size)])
+                ambulances = Ambulance.objects.bulk_create([
+                    Ambulance(identifier='permissionsbenchmark-{}'.format(k),
+                              capability=AmbulanceCapability.B.name,
+                              equipmentholder=holder,
+                              updated_by=admin or user)
+                    for k, holder in enumerate(holders)])
+                GroupAmbulancePermission.objects.bulk_create([
+                    GroupAmbulancePermission(group=group, ambulance=ambulance)
+                    for ambulance in ambulances])
+
+                # literal id list
+                can_read = Permissions(user).get_can_read('ambulances')
+                list_time, list_size = self.measure(Ambulance.objects.filter(id__in=can_read), repeat)
+
+                # subquery
+                can_read = get_permitted_ids(user, 'ambulances')
+                subquery_time, subquery_size = self.measure(Ambulance.objects.filter(id__in=can_read), repeat)
+
+                self.stdout.write('{:>8} {:>14.2f} {:>12} {:>14.2f} {:>12}'.format(size,
+                                                                                  1000 * list_time, list_size,
+                                                                                  1000 * subquery_time, subquery_size))
+
+                # discard benchmark data
+                transaction.set_rollback(True)
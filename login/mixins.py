@@ -1,20 +1,47 @@
-from mqtt.cache_clear import mqtt_cache_clear
+from django.db import transaction
+
+from mqtt.cache_clear import mqtt_cache_clear, snapshot_permissions
 
 
 class ClearPermissionCacheMixin:
 
+    def get_cache_clear_scope(self):
+        """
+        Scope of the permission cache invalidation, by default the user or group this object belongs to.
+        """
+        user_id = getattr(self, 'user_id', None)
+        if user_id is not None:
+            return {'users': [user_id]}
+        group_id = getattr(self, 'group_id', None)
+        if group_id is not None:
+            return {'groups': [group_id]}
+        return {}
+
     def save(self, *args, **kwargs):
 
-        # save to UserProfile
-        super().save(*args, **kwargs)
+        scope = self.get_cache_clear_scope()
+        with transaction.atomic():
+
+            # record permissions before they change
+            snapshot_permissions(**scope)
 
-        # invalidate permissions cache
-        mqtt_cache_clear()
+            # save to UserProfile
+            super().save(*args, **kwargs)
+
+            # invalidate permissions cache
+            mqtt_cache_clear(**scope)
 
     def delete(self, *args, **kwargs):
 
-        # delete from UserProfile
-        super().delete(*args, **kwargs)
+        # retrieve scope before the object is gone
+        scope = self.get_cache_clear_scope()
+        with transaction.atomic():
+
+            # record permissions before they change
+            snapshot_permissions(**scope)
+
+            # delete from UserProfile
+            super().delete(*args, **kwargs)
 
-        # invalidate permissions cache
-        mqtt_cache_clear()
+            # invalidate permissions cache
+            mqtt_cache_clear(**scope)
@@ -1,31 +1,330 @@
 import logging
+import threading
+import time
 
-from functools import lru_cache
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
 
+from django.db.models import BooleanField, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from rest_framework import permissions
 
 from ambulance.models import Ambulance
 from hospital.models import Hospital
 
+from environs import Env
+
+env = Env()
 logger = logging.getLogger(__name__)
 
-PERMISSION_CACHE_SIZE = 10
+PERMISSION_CACHE_SIZE = env.int('DJANGO_PERMISSION_CACHE_SIZE', default=10)
+
+# permission cache warm-up
+PERMISSION_WARMUP = env.bool('DJANGO_PERMISSION_WARMUP', default=False)
+PERMISSION_WARMUP_BUDGET = env.float('DJANGO_PERMISSION_WARMUP_BUDGET', default=2.0)
+PERMISSION_WARMUP_WINDOW = env.int('DJANGO_PERMISSION_WARMUP_WINDOW', default=24)
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+WarmupInfo = namedtuple('WarmupInfo', ['runs', 'warmed', 'saved', 'elapsed'])
+
+
+class PermissionsCache:
+    """
+    Least recently used cache of Permissions keyed by user id.
+    Unlike functools.lru_cache it can invalidate only the entries of given users or groups,
+    and it can be warmed up ahead of the first lookup.
+    """
+
+    def __init__(self, maxsize=PERMISSION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+        # incremented by every invalidation, so that entries built meanwhile are not stored stale
+        self.generation = 0
+
+        # keys of invalidated entries, candidates for warming up again
+        self.invalidated = set()
+
+        # warm-up statistics; warmed keys have not been looked up yet
+        self.warmed = set()
+        self.warmup_runs = 0
+        self.warmup_count = 0
+        self.warmup_saved = 0
+        self.warmup_elapsed = 0.0
+
+    def get(self, user):
+
+        key = None if user is None else user.pk
+        with self.lock:
+            try:
+                permissions = self.entries[key]
+                self.entries.move_to_end(key)
+                self.hits += 1
+                if key in self.warmed:
+                    # first lookup of a warmed entry saved a rebuild
+                    self.warmed.discard(key)
+                    self.warmup_saved += 1
+                return permissions
+            except KeyError:
+                self.misses += 1
+                generation = self.generation
+
+        # hit the database for permissions outside the lock
+        permissions = Permissions(user)
+
+        with self.lock:
+            if self.generation != generation:
+                # invalidated while building, may be stale
+                return permissions
+            self.entries[key] = permissions
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                (evicted, _) = self.entries.popitem(last=False)
+                self.warmed.discard(evicted)
+
+        return permissions
+
+    def clear(self, users=None, groups=None):
+        """
+        Invalidate the entries of the given user and group ids, or all entries if none are given.
+        Returns a dictionary with the evicted entries.
+        """
+
+        with self.lock:
+
+            self.generation += 1
+
+            if users is None and groups is None:
+
+                # clear everything, including statistics
+                evicted = dict(self.entries)
+                self.entries.clear()
+                self.hits = 0
+                self.misses = 0
+
+            else:
+
+                users = set(users or ())
+                groups = set(groups or ())
+                evicted = {key: entry
+                           for key, entry in self.entries.items()
+                           if key in users or not groups.isdisjoint(entry.group_ids)}
+                for key in evicted:
+                    del self.entries[key]
+
+            # remember invalidated entries, at most as many as fit in the cache
+            self.warmed.difference_update(evicted)
+            self.invalidated.update(key for key in evicted if key is not None)
+            for key in list(self.invalidated)[self.maxsize:]:
+                self.invalidated.discard(key)
+
+            return evicted
+
+    def warm(self, users, budget=PERMISSION_WARMUP_BUDGET):
+        """
+        Build permissions of users that are not cached yet, in order, until the time budget
+        in seconds runs out or the cache is full. Warming up never evicts existing entries,
+        and entries invalidated while being built are dropped. Returns the number of entries built.
+        """
+
+        start = time.perf_counter()
+        count = 0
+        seen = set()
+        for user in users:
+
+            # out of time?
+            if time.perf_counter() - start > budget:
+                break
+
+            # each user once
+            if user.pk in seen:
+                continue
+            seen.add(user.pk)
+
+            with self.lock:
+                if len(self.entries) >= self.maxsize:
+                    break
+                if user.pk in self.entries:
+                    continue
+                generation = self.generation
+
+            # hit the database for permissions outside the lock
+            permissions = Permissions(user)
+
+            with self.lock:
+                if self.generation == generation and \
+                        user.pk not in self.entries and len(self.entries) < self.maxsize:
+                    # warmed entries are the least recently used
+                    self.entries[user.pk] = permissions
+                    self.entries.move_to_end(user.pk, last=False)
+                    self.warmed.add(user.pk)
+                    count += 1
+
+        with self.lock:
+            self.warmup_runs += 1
+            self.warmup_count += count
+            self.warmup_elapsed += time.perf_counter() - start
+
+        return count
+
+    def pop_invalidated(self):
+        with self.lock:
+            invalidated = self.invalidated
+            self.invalidated = set()
+            return invalidated
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+    def warmup_info(self):
+        with self.lock:
+            return WarmupInfo(self.warmup_runs, self.warmup_count, self.warmup_saved, self.warmup_elapsed)
+
+
+permissions_cache = PermissionsCache()
 
 
-@lru_cache(maxsize=PERMISSION_CACHE_SIZE)
 def get_permissions(user):
-    # hit the database for permissions
-    return Permissions(user)
+    # hit the cache, then the database for permissions
+    return permissions_cache.get(user)
+
+
+cache_clear = permissions_cache.clear
+cache_info = permissions_cache.info
+warmup_info = permissions_cache.warmup_info
+
+
+def get_recently_active_users(window=PERMISSION_WARMUP_WINDOW, limit=PERMISSION_CACHE_SIZE):
+    """
+    Return up to limit active users, those with online clients first,
+    followed by those with the most recent client activity in the last window hours.
+    """
+
+    from django.contrib.auth.models import User
+    from login.models import Client, ClientLog, ClientStatus
+
+    # users with online clients
+    user_ids = list(Client.objects
+                    .filter(status__in=(ClientStatus.O.name, ClientStatus.R.name))
+                    .order_by('-updated_on')
+                    .values_list('user_id', flat=True)[:limit])
+
+    # users with recent client activity
+    recent = ClientLog.objects \
+        .filter(updated_on__gte=timezone.now() - timedelta(hours=window)) \
+        .values('user_id') \
+        .annotate(last_activity=Max('updated_on')) \
+        .order_by('-last_activity') \
+        .values_list('user_id', flat=True)[:limit]
+    for user_id in recent:
+        if user_id not in user_ids:
+            user_ids.append(user_id)
+
+    # retrieve users in order
+    users = User.objects.filter(id__in=user_ids[:limit], is_active=True).in_bulk()
+    return [users[user_id] for user_id in user_ids[:limit] if user_id in users]
+
+
+def warm_up(users=None, budget=PERMISSION_WARMUP_BUDGET):
+    """
+    Precompute permissions of users, by default the recently active ones, within a time budget in seconds.
+    """
+
+    if users is None:
+        users = get_recently_active_users(limit=permissions_cache.maxsize)
+
+    count = permissions_cache.warm(users, budget)
 
+    info = warmup_info()
+    logger.info('Permission cache warm-up: built {} entries; '
+                'total of {} runs, {} entries, {} lookups saved, {:.3f}s'.format(count, *info))
 
-cache_clear = get_permissions.cache_clear
-cache_info = get_permissions.cache_info
+    return count
+
+
+def warm_up_invalidated():
+    """
+    Warm up again, in the background, the permissions of users whose cache entries were invalidated.
+    Does nothing unless DJANGO_PERMISSION_WARMUP is set.
+    """
+
+    if not PERMISSION_WARMUP:
+        return
+
+    user_ids = permissions_cache.pop_invalidated()
+    if not user_ids:
+        return
+
+    def target():
+
+        from django.contrib.auth.models import User
+        from django.db import connection
+
+        try:
+            warm_up(User.objects.filter(id__in=user_ids, is_active=True))
+        except Exception as e:
+            logger.warning('Permission cache warm-up failed: {}'.format(e))
+        finally:
+            # threads open their own database connection
+            connection.close()
+
+    threading.Thread(target=target, daemon=True).start()
+
+
+def get_permitted_ids(user, profile_field, can_write=False):
+    """
+    Return a values queryset with the ids of the objects in profile_field that user can read or write to.
+    The query runs entirely in the database: user permissions override group permissions,
+    which are resolved by group priority as in Permissions.
+    """
+
+    from equipment.models import EquipmentHolder
+    from login.models import UserAmbulancePermission, UserHospitalPermission, \
+        GroupAmbulancePermission, GroupHospitalPermission
+
+    if profile_field == 'equipments':
+        # equipment permissions follow from the ambulance or hospital holding the equipment
+        ambulances = get_permitted_ids(user, 'ambulances', can_write)
+        hospitals = get_permitted_ids(user, 'hospitals', can_write)
+        return EquipmentHolder.objects.filter(Q(ambulance__id__in=ambulances) |
+                                              Q(hospital__id__in=hospitals)).values('id')
+
+    (model, object_field, user_permission_model, group_permission_model) = {
+        'ambulances': (Ambulance, 'ambulance', UserAmbulancePermission, GroupAmbulancePermission),
+        'hospitals': (Hospital, 'hospital', UserHospitalPermission, GroupHospitalPermission),
+    }[profile_field]
+    flag = 'can_write' if can_write else 'can_read'
+
+    # e.g.: user.userambulancepermission_set.filter(ambulance=outer_ambulance).can_read
+    user_permission = user_permission_model.objects \
+        .filter(user=user, **{object_field: OuterRef('pk')}) \
+        .values(flag)[:1]
+
+    # e.g.: can_read of the highest priority group of user with permissions on outer_ambulance
+    group_permission = group_permission_model.objects \
+        .filter(group__user=user, **{object_field: OuterRef('pk')}) \
+        .order_by('-group__groupprofile__priority', 'group__name') \
+        .values(flag)[:1]
+
+    return model.objects \
+        .annotate(is_permitted=Coalesce(Subquery(user_permission),
+                                        Subquery(group_permission),
+                                        Value(False),
+                                        output_field=BooleanField())) \
+        .filter(is_permitted=True) \
+        .values('id')
 
 
 class Permissions:
     object_fields = ('ambulance', 'hospital')
     profile_fields = ('ambulances', 'hospitals')
     models = (Ambulance, Hospital)
+    listing_fields = (('id', 'identifier'), ('id', 'name'))
 
     def __init__(self, user, **kwargs):
 
@@ -41,84 +340,32 @@ class Permissions:
         if 'models' in kwargs:
             self.models = kwargs.pop('models')
 
-        # initialize permissions
-        self.can_read = {}
-        self.can_write = {}
-        for profile_field in self.profile_fields:
-            # e.g.: self.ambulances = {}
-            setattr(self, profile_field, {})
-            # e.g.: self.can_read['ambulances'] = {}
-            self.can_read[profile_field] = []
-            self.can_write[profile_field] = []
+        # groups these permissions were built from, used for scoped cache invalidation
+        self.group_ids = set()
 
-        # add equipments
-        self.equipments = {}
-        self.can_read['equipments'] = []
-        self.can_write['equipments'] = []
+        # superuser and staff can read and write to everything that exists:
+        # answer checks without loading any objects, which are loaded only if listed
+        self.unrestricted = user is not None and (user.is_superuser or user.is_staff)
+        if self.unrestricted:
+            # (profile_field, id) of the objects known to exist
+            self.existing = set()
+            return
+
+        # initialize permissions
+        self.initialize()
 
         # retrieve permissions if not None
         if user is not None:
 
-            if user.is_superuser or user.is_staff:
-
-                # superuser, add all permissions
-                for (model, profile_field, object_field) in zip(self.models, self.profile_fields, self.object_fields):
-                    # e.g.: objs = group.groupprofile.hospitals.all()
-                    objs = model.objects.all()
-
-                    # e.g.: self.hospitals.update({e.hospital_id: {...} for e in Hospitals.objects.all()})
-                    permissions = {}
-                    equipment_permissions = {}
-                    for e in objs:
-                        permissions[e.id] = {
-                            object_field: e,
-                            'can_read': True,
-                            'can_write': True
-                        }
-                        equipment_permissions[e.equipmentholder.id] = {
-                            'equipmentholder': e.equipmentholder,
-                            'can_read': True,
-                            'can_write': True
-                        }
-                    getattr(self, profile_field).update(permissions)
-                    self.equipments.update(equipment_permissions)
-                    # logger.debug('superuser, {} = {}'.format(profile_field, getattr(self, profile_field)))
-                    # logger.debug('superuser, {} = {}'.format('equipments', self.equipments))
-
-            else:
-
-                # regular users, loop through groups
-                for group in user.groups.all().order_by('groupprofile__priority', '-name'):
-                    for (profile_field, object_field) in zip(self.profile_fields, self.object_fields):
-
-                        # e.g.: objs = group.groupambulancepermission_set.all()
-                        objs = getattr(group, 'group' + object_field + 'permission_set').all()
-
-                        # e.g.: self.ambulances.update({e.ambulance_id: {...} for e in objs})
-                        permissions = {}
-                        equipment_permissions = {}
-                        for e in objs:
-                            id = getattr(e, object_field + '_id')
-                            obj = getattr(e, object_field)
-                            permissions[id] = {
-                                object_field: obj,
-                                'can_read': e.can_read,
-                                'can_write': e.can_write
-                            }
-                            equipment_permissions[obj.equipmentholder.id] = {
-                                'equipmentholder': obj.equipmentholder,
-                                'can_read': e.can_read,
-                                'can_write': e.can_write
-                            }
-                        getattr(self, profile_field).update(permissions)
-                        self.equipments.update(equipment_permissions)
-
-                # add user permissions
+            # regular users, loop through groups
+            for group in user.groups.all().order_by('groupprofile__priority', '-name'):
+                self.group_ids.add(group.id)
                 for (profile_field, object_field) in zip(self.profile_fields, self.object_fields):
-                    # e.g.: objs = user.userhospitalpermission_set.all()
-                    objs = getattr(user, 'user' + object_field + 'permission_set').all()
 
-                    # e.g.: self.hospitals.update({e.hospital_id: {...} for e in user.profile.hospitals.all()})
+                    # e.g.: objs = group.groupambulancepermission_set.all()
+                    objs = getattr(group, 'group' + object_field + 'permission_set').all()
+
+                    # e.g.: self.ambulances.update({e.ambulance_id: {...} for e in objs})
                     permissions = {}
                     equipment_permissions = {}
                     for e in objs:
@@ -137,29 +384,144 @@ class Permissions:
                     getattr(self, profile_field).update(permissions)
                     self.equipments.update(equipment_permissions)
 
+            # add user permissions
+            for (profile_field, object_field) in zip(self.profile_fields, self.object_fields):
+                # e.g.: objs = user.userhospitalpermission_set.all()
+                objs = getattr(user, 'user' + object_field + 'permission_set').all()
+
+                # e.g.: self.hospitals.update({e.hospital_id: {...} for e in user.profile.hospitals.all()})
+                permissions = {}
+                equipment_permissions = {}
+                for e in objs:
+                    id = getattr(e, object_field + '_id')
+                    obj = getattr(e, object_field)
+                    permissions[id] = {
+                        object_field: obj,
+                        'can_read': e.can_read,
+                        'can_write': e.can_write
+                    }
+                    equipment_permissions[obj.equipmentholder.id] = {
+                        'equipmentholder': obj.equipmentholder,
+                        'can_read': e.can_read,
+                        'can_write': e.can_write
+                    }
+                getattr(self, profile_field).update(permissions)
+                self.equipments.update(equipment_permissions)
+
             # build permissions
-            for profile_field in self.profile_fields:
-                for (id, obj) in getattr(self, profile_field).items():
-                    if obj['can_read']:
-                        # e.g.: self.can_read['ambulances'].append(obj['id'])
-                        self.can_read[profile_field].append(id)
-                    if obj['can_write']:
-                        # e.g.: self.can_write['ambulances'].append(obj['id'])
-                        self.can_write[profile_field].append(id)
-                # logger.debug('can_read[{}] = {}'.format(profile_field, self.can_read[profile_field]))
-                # logger.debug('can_write[{}] = {}'.format(profile_field, self.can_write[profile_field]))
-
-            # add equipments
-            for (id, obj) in self.equipments.items():
+            self.build()
+
+    def __getattr__(self, name):
+
+        # only called for missing attributes: load objects of unrestricted permissions on first use
+        if self.__dict__.get('unrestricted') and \
+                name in (*self.profile_fields, 'equipments', 'can_read', 'can_write'):
+            self.load()
+            return self.__dict__[name]
+
+        raise AttributeError(name)
+
+    def initialize(self):
+
+        # initialize permissions
+        self.can_read = {}
+        self.can_write = {}
+        for profile_field in self.profile_fields:
+            # e.g.: self.ambulances = {}
+            setattr(self, profile_field, {})
+            # e.g.: self.can_read['ambulances'] = {}
+            self.can_read[profile_field] = []
+            self.can_write[profile_field] = []
+
+        # add equipments
+        self.equipments = {}
+        self.can_read['equipments'] = []
+        self.can_write['equipments'] = []
+
+    def load(self):
+
+        # initialize permissions
+        self.initialize()
+
+        # superuser, add all permissions
+        for (model, profile_field, object_field) in zip(self.models, self.profile_fields, self.object_fields):
+            # e.g.: objs = group.groupprofile.hospitals.all()
+            objs = model.objects.all()
+
+            # e.g.: self.hospitals.update({e.hospital_id: {...} for e in Hospitals.objects.all()})
+            permissions = {}
+            equipment_permissions = {}
+            for e in objs:
+                permissions[e.id] = {
+                    object_field: e,
+                    'can_read': True,
+                    'can_write': True
+                }
+                equipment_permissions[e.equipmentholder.id] = {
+                    'equipmentholder': e.equipmentholder,
+                    'can_read': True,
+                    'can_write': True
+                }
+            getattr(self, profile_field).update(permissions)
+            self.equipments.update(equipment_permissions)
+
+        # build permissions
+        self.build()
+
+    def build(self):
+
+        # build permissions
+        for profile_field in self.profile_fields:
+            for (id, obj) in getattr(self, profile_field).items():
                 if obj['can_read']:
-                    self.can_read['equipments'].append(id)
+                    # e.g.: self.can_read['ambulances'].append(obj['id'])
+                    self.can_read[profile_field].append(id)
                 if obj['can_write']:
-                    self.can_write['equipments'].append(id)
+                    # e.g.: self.can_write['ambulances'].append(obj['id'])
+                    self.can_write[profile_field].append(id)
+            # logger.debug('can_read[{}] = {}'.format(profile_field, self.can_read[profile_field]))
+            # logger.debug('can_write[{}] = {}'.format(profile_field, self.can_write[profile_field]))
+
+        # add equipments
+        for (id, obj) in self.equipments.items():
+            if obj['can_read']:
+                self.can_read['equipments'].append(id)
+            if obj['can_write']:
+                self.can_write['equipments'].append(id)
+
+    def check_exists(self, profile_field, id):
+        """
+        Whether object id in profile_field exists, for unrestricted permissions.
+        Objects are looked up once; deleting ambulances and hospitals clears the whole cache.
+        """
+
+        if profile_field not in (*self.profile_fields, 'equipments'):
+            return False
+
+        # loaded objects
+        if profile_field in self.__dict__:
+            return id in self.__dict__[profile_field]
+
+        if (profile_field, id) in self.existing:
+            return True
+
+        if profile_field == 'equipments':
+            from equipment.models import EquipmentHolder
+            model = EquipmentHolder
+        else:
+            model = self.models[self.profile_fields.index(profile_field)]
+        if not model.objects.filter(id=id).exists():
+            return False
+
+        self.existing.add((profile_field, id))
+        return True
 
     def check_can_read(self, **kwargs):
         assert len(kwargs) == 1
         (key, id) = kwargs.popitem()
         # logger.debug('key = {}, id = {}'.format(key, id))
+        if self.unrestricted:
+            return self.check_exists(key + 's', id)
         try:
             return id in self.can_read[key + 's']
         except KeyError:
@@ -168,6 +530,8 @@ class Permissions:
     def check_can_write(self, **kwargs):
         assert len(kwargs) == 1
         (key, id) = kwargs.popitem()
+        if self.unrestricted:
+            return self.check_exists(key + 's', id)
         try:
             return id in self.can_write[key + 's']
         except KeyError:
@@ -181,6 +545,39 @@ class Permissions:
     def get_permissions(self, profile_field):
         return getattr(self, profile_field)
 
+    def get_permission_set(self):
+        """
+        Set of (profile_field, id, can_read, can_write) tuples used to compare permissions.
+        Unrestricted permissions are compared without loading any objects.
+        """
+
+        if self.unrestricted:
+            return frozenset([('unrestricted',)])
+
+        return frozenset((profile_field, id, obj['can_read'], obj['can_write'])
+                         for profile_field in self.profile_fields
+                         for (id, obj) in getattr(self, profile_field).items())
+
+    def iterate_permissions(self, profile_field):
+        """
+        Iterate over the permissions in profile_field.
+        Unrestricted permissions are streamed from the database with only the fields needed for listings.
+        """
+
+        if not self.unrestricted or profile_field in self.__dict__:
+            yield from getattr(self, profile_field).values()
+            return
+
+        # e.g.: Ambulance.objects.only('id', 'identifier')
+        k = self.profile_fields.index(profile_field)
+        object_field = self.object_fields[k]
+        for obj in self.models[k].objects.only(*self.listing_fields[k]).iterator():
+            yield {
+                object_field: obj,
+                'can_read': True,
+                'can_write': True
+            }
+
     def get_can_read(self, profile_field):
         return self.can_read[profile_field]
 
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import logging
 
 from rest_framework import serializers
@@ -11,6 +13,15 @@ logger = logging.getLogger(__name__)
 
 # Profile serializers
 
+def get_profile_version(data):
+    """
+    Short digest of the profile contents; clients can skip reprocessing a profile whose version did not change.
+    """
+    content = json.dumps({'ambulances': data['ambulances'], 'hospitals': data['hospitals']},
+                         sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(content.encode()).hexdigest()[:16]
+
+
 class AmbulancePermissionSerializer(serializers.ModelSerializer):
     ambulance_id = serializers.IntegerField(source='ambulance.id')
     ambulance_identifier = serializers.CharField(source='ambulance.identifier')
@@ -36,7 +47,7 @@ class UserProfileSerializer(serializers.Serializer):
     hospitals = serializers.SerializerMethodField()
 
     class Meta:
-        fields = ('ambulances', 'hospitals')
+        fields = ('ambulances', 'hospitals', 'version')
 
     def __init__(self, *args, **kwargs):
         # call super
@@ -46,10 +57,17 @@ class UserProfileSerializer(serializers.Serializer):
         self._permissions = get_permissions(self.instance)
 
     def get_ambulances(self, user):
-        return AmbulancePermissionSerializer(self._permissions.get_permissions('ambulances').values(), many=True).data
+        return AmbulancePermissionSerializer(self._permissions.iterate_permissions('ambulances'), many=True).data
 
     def get_hospitals(self, user):
-        return HospitalPermissionSerializer(self._permissions.get_permissions('hospitals').values(), many=True).data
+        return HospitalPermissionSerializer(self._permissions.iterate_permissions('hospitals'), many=True).data
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+
+        # add version
+        data['version'] = get_profile_version(data)
+        return data
 
 
 # Client serializers
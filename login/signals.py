@@ -3,17 +3,27 @@ from django.dispatch import receiver
 
 from django.contrib.auth.models import User, Group
 
-from mqtt.cache_clear import mqtt_cache_clear
+from mqtt.cache_clear import mqtt_cache_clear, snapshot_permissions
 from .models import UserProfile, GroupProfile
 
 
 # Add signal to automatically clear cache when group permissions change
 @receiver(m2m_changed, sender=User.groups.through)
-def user_groups_changed_handler(sender, instance, action, **kwargs):
-    if action == 'post_add' or action == 'post_remove':
+def user_groups_changed_handler(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_add' or action == 'pre_remove':
 
-        # invalidate permissions cache
-        mqtt_cache_clear()
+        # record permissions of the affected users before they change
+        snapshot_permissions(users=pk_set if reverse else [instance.pk])
+
+    elif action == 'post_add' or action == 'post_remove':
+
+        # invalidate permissions cache of the affected users only
+        if reverse:
+            # users were added to or removed from group
+            mqtt_cache_clear(users=pk_set)
+        else:
+            # groups were added to or removed from user
+            mqtt_cache_clear(users=[instance.pk])
 
 
 # Add signal to automatically extend group profile
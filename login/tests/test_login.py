@@ -13,7 +13,7 @@ from hospital.models import Hospital
 
 from ..models import TemporaryPassword
 
-from ..serializers import UserProfileSerializer
+from ..serializers import UserProfileSerializer, get_profile_version
 
 from mqtt.tests.client import MQTTTestCase
 
@@ -63,6 +63,7 @@ class TestProfile(MyTestCase):
                 for e in Hospital.objects.all()
             ]
         }
+        result['version'] = get_profile_version(result)
         self.assertDictEqual(serializer.data, result)
 
         # regular users is just like ProfileSerializer
@@ -88,6 +89,7 @@ class TestProfile(MyTestCase):
                     for e in u.userhospitalpermission_set.all()
                 ]
             }
+            result['version'] = get_profile_version(result)
             self.assertDictEqual(serializer.data, result)
 
         # regular users is just like ProfileSerializer with groups
@@ -114,6 +116,7 @@ class TestProfile(MyTestCase):
                 for e in g.grouphospitalpermission_set.all()
             ]
         }
+        result['version'] = get_profile_version(result)
         self.assertDictEqual(serializer.data, result)
 
         # regular users is just like ProfileSerializer with groups
@@ -1,5 +1,14 @@
-from login.permissions import Permissions, get_permissions, cache_info, cache_clear
+from django.contrib.auth.models import User
+from django.db import transaction
+
+import mqtt.cache_clear
+
+from login.permissions import Permissions, get_permissions, cache_info, cache_clear, get_permitted_ids, \
+    warm_up, warmup_info
+from login.models import UserAmbulancePermission
+from login.serializers import UserProfileSerializer
 from login.tests.setup_data import TestSetup
+from mqtt.cache_clear import get_pending_scope, mqtt_cache_clear
 
 
 class TestPermissions(TestSetup):
@@ -675,3 +684,186 @@ class TestPermissions(TestSetup):
         self.assertEqual(info.hits, 0)
         self.assertEqual(info.misses, 0)
         self.assertEqual(info.currsize, 0)
+
+    def test_cache_scoped_clear(self):
+
+        # clear cache
+        cache_clear()
+
+        # retrieve permissions for users u1, u4 (group g2) and u5 (groups g1 and g3)
+        get_permissions(self.u1)
+        get_permissions(self.u4)
+        get_permissions(self.u5)
+        info = cache_info()
+        self.assertEqual(info.misses, 3)
+        self.assertEqual(info.currsize, 3)
+
+        # clear user u1 only
+        evicted = cache_clear(users=[self.u1.id])
+        self.assertCountEqual([self.u1.id], evicted.keys())
+        info = cache_info()
+        self.assertEqual(info.misses, 3)
+        self.assertEqual(info.currsize, 2)
+
+        # clear group g3 only
+        evicted = cache_clear(groups=[self.g3.id])
+        self.assertCountEqual([self.u5.id], evicted.keys())
+        info = cache_info()
+        self.assertEqual(info.currsize, 1)
+
+        # u4 is still cached
+        get_permissions(self.u4)
+        info = cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 3)
+
+        # clearing unrelated scope evicts nothing
+        evicted = cache_clear(users=[self.u2.id], groups=[self.g6.id])
+        self.assertEqual({}, evicted)
+        self.assertEqual(cache_info().currsize, 1)
+
+    def test_cache_clear_rollback(self):
+
+        # nothing cached or pending
+        cache_clear()
+        mqtt.cache_clear._pending.scope = None
+
+        # invalidations in a transaction that rolls back are dropped
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                mqtt_cache_clear(users=[self.u2.id])
+                self.assertEqual(get_pending_scope()['users'], {self.u2.id})
+                raise ValueError
+        self.assertEqual(get_pending_scope()['users'], set())
+
+        # invalidations in a transaction still open are kept
+        mqtt_cache_clear(users=[self.u3.id])
+        mqtt_cache_clear(groups=[self.g3.id])
+        scope = get_pending_scope()
+        self.assertEqual(scope['users'], {self.u3.id})
+        self.assertEqual(scope['groups'], {self.g3.id})
+
+    def test_cache_clear_snapshot(self):
+
+        # nothing cached or pending
+        cache_clear()
+        mqtt.cache_clear._pending.scope = None
+
+        # permissions of u2, which is not cached, are recorded before they change
+        previous = Permissions(self.u2).get_permission_set()
+        UserAmbulancePermission.objects.create(user=self.u2, ambulance=self.a1, can_read=True, can_write=False)
+        scope = get_pending_scope()
+        self.assertEqual(scope['users'], {self.u2.id})
+        self.assertEqual(scope['previous'][self.u2.id], previous)
+
+        # and so are those of the members of a group, from before the first change only
+        previous = Permissions(self.u5).get_permission_set()
+        self.u5.groups.remove(self.g3)
+        self.u5.groups.add(self.g3)
+        self.assertEqual(get_pending_scope()['previous'][self.u5.id], previous)
+
+    def test_cache_warm_up(self):
+
+        # clear cache
+        cache_clear()
+        runs, warmed, saved, _ = warmup_info()
+
+        # warm up users u1 and u4
+        self.assertEqual(warm_up([self.u1, self.u4]), 2)
+        info = cache_info()
+        self.assertEqual(info.misses, 0)
+        self.assertEqual(info.currsize, 2)
+
+        # warming up again builds nothing
+        self.assertEqual(warm_up([self.u1, self.u4]), 0)
+
+        # lookups of warmed entries are hits
+        get_permissions(self.u1)
+        get_permissions(self.u1)
+        info = cache_info()
+        self.assertEqual(info.hits, 2)
+        self.assertEqual(info.misses, 0)
+
+        # only the first lookup counts as saved
+        info = warmup_info()
+        self.assertEqual(info.runs, runs + 2)
+        self.assertEqual(info.warmed, warmed + 2)
+        self.assertEqual(info.saved, saved + 1)
+
+        # users are built once
+        cache_clear()
+        self.assertEqual(warm_up([self.u4, self.u1, self.u4]), 2)
+        self.assertEqual(cache_info().currsize, 2)
+
+        # no time budget, no warm up
+        cache_clear()
+        self.assertEqual(warm_up([self.u1], budget=-1), 0)
+        self.assertEqual(cache_info().currsize, 0)
+
+    def test_permission_set(self):
+
+        # u2 has no ambulances
+        cache_clear()
+        previous = get_permissions(self.u2).get_permission_set()
+        version = UserProfileSerializer(self.u2).data['version']
+
+        # unchanged permissions compare equal
+        self.assertEqual(previous, Permissions(self.u2).get_permission_set())
+
+        # add permission to u2
+        UserAmbulancePermission.objects.create(user=self.u2, ambulance=self.a1, can_read=True, can_write=False)
+        permissions = get_permissions(self.u2)
+        self.assertIn(('ambulances', self.a1.id, True, False), permissions.get_permission_set())
+        self.assertNotEqual(previous, permissions.get_permission_set())
+        self.assertNotEqual(version, UserProfileSerializer(self.u2).data['version'])
+
+        # unrestricted permissions compare without loading objects
+        with self.assertNumQueries(0):
+            self.assertEqual(Permissions(self.u1).get_permission_set(), frozenset([('unrestricted',)]))
+
+    def test_permitted_ids(self):
+
+        # subquery permissions must match Permissions for every regular user
+        for user in User.objects.filter(is_superuser=False, is_staff=False):
+            perms = Permissions(user)
+            for profile_field in ('ambulances', 'hospitals', 'equipments'):
+                self.assertCountEqual(perms.get_can_read(profile_field),
+                                      get_permitted_ids(user, profile_field).values_list('id', flat=True))
+                self.assertCountEqual(perms.get_can_write(profile_field),
+                                      get_permitted_ids(user, profile_field, can_write=True)
+                                      .values_list('id', flat=True))
+
+    def test_unrestricted(self):
+
+        # superuser permissions are built without hitting the database
+        with self.assertNumQueries(0):
+            perms = Permissions(self.u1)
+            self.assertTrue(perms.unrestricted)
+            self.assertFalse(perms.check_can_read(unknown=self.a1.id))
+
+        # and checked by looking up each object once
+        with self.assertNumQueries(3):
+            self.assertTrue(perms.check_can_read(ambulance=self.a1.id))
+            self.assertTrue(perms.check_can_write(hospital=self.h1.id))
+            self.assertTrue(perms.check_can_write(equipment=self.a1.equipmentholder.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(perms.check_can_write(ambulance=self.a1.id))
+            self.assertTrue(perms.check_can_read(hospital=self.h1.id))
+        self.assertNotIn('ambulances', perms.__dict__)
+
+        # objects that do not exist cannot be read or written to
+        missing = self.a1.id + self.a2.id + self.a3.id
+        self.assertFalse(perms.check_can_read(ambulance=missing))
+        self.assertFalse(perms.check_can_write(ambulance=missing))
+
+        # listings are streamed without loading permissions
+        answer = [{'ambulance': a, 'can_read': True, 'can_write': True} for a in (self.a1, self.a2, self.a3)]
+        self.assertCountEqual(answer, list(perms.iterate_permissions('ambulances')))
+        self.assertNotIn('ambulances', perms.__dict__)
+
+        # permissions are loaded on first access
+        self.assertCountEqual([self.h1.id, self.h2.id, self.h3.id], perms.get_can_read('hospitals'))
+        self.assertIn('ambulances', perms.__dict__)
+
+        # regular users are not unrestricted
+        self.assertFalse(Permissions(self.u2).unrestricted)
@@ -18,6 +18,7 @@ from django.contrib.auth.models import User, Group
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.db import transaction
 from django.http.response import HttpResponse, HttpResponseForbidden
 from django.shortcuts import redirect, render
 from django.utils import timezone
@@ -37,7 +38,7 @@ from ambulance.models import AmbulanceStatus, AmbulanceCapability, LocationType,
     WaypointStatus
 from emstrack import CURRENT_VERSION, MINIMUM_VERSION
 from emstrack.mixins import SuccessMessageWithInlinesMixin, UpdatedByMixin, ExportModelMixin, ImportModelMixin, \
-    ProcessImportModelMixin, PaginationViewMixin
+    ProcessImportModelMixin, PaginationViewMixin, AtomicWithInlinesMixin
 from emstrack.models import defaults
 from emstrack.views import get_page_links, get_page_size_links
 from equipment.models import EquipmentType, EquipmentTypeDefaults
@@ -171,6 +172,7 @@ class GroupAdminCreateView(SuccessMessageMixin,
 
 
 class GroupAdminUpdateView(SuccessMessageWithInlinesMixin,
+                           AtomicWithInlinesMixin,
                            UpdateWithInlinesView):
     model = Group
     template_name = 'login/group_form.html'
@@ -255,22 +257,25 @@ class UserAdminCreateView(SuccessMessageWithInlinesMixin,
 
     def forms_valid(self, form, inlines):
 
-        # process form
-        response = self.form_valid(form)
+        # save user and inlines in a single transaction
+        with transaction.atomic():
 
-        # update userprofile without creating
-        # userprofile is created by a signal
-        # not sure if the signal is called synchronously with the call to save()
-        # if not, this could be subject to a concurrency issue
-        # the following post claims they are not asynchronous
-        # https://stackoverflow.com/questions/11899088/is-django-post-save-signal-asynchronous
-        userprofile_form = inlines[0][0]
-        userprofile_form.cleaned_data.pop('id', None)
-        UserProfile.objects.filter(user=form.instance).update(**userprofile_form.cleaned_data)
+            # process form
+            response = self.form_valid(form)
 
-        # process other inlines
-        for formset in inlines[1:]:
-            formset.save()
+            # update userprofile without creating
+            # userprofile is created by a signal
+            # not sure if the signal is called synchronously with the call to save()
+            # if not, this could be subject to a concurrency issue
+            # the following post claims they are not asynchronous
+            # https://stackoverflow.com/questions/11899088/is-django-post-save-signal-asynchronous
+            userprofile_form = inlines[0][0]
+            userprofile_form.cleaned_data.pop('id', None)
+            UserProfile.objects.filter(user=form.instance).update(**userprofile_form.cleaned_data)
+
+            # process other inlines
+            for formset in inlines[1:]:
+                formset.save()
 
         return response
 
@@ -282,6 +287,7 @@ class UserAdminCreateView(SuccessMessageWithInlinesMixin,
 
 
 class UserAdminUpdateView(SuccessMessageWithInlinesMixin,
+                          AtomicWithInlinesMixin,
                           UpdateWithInlinesView):
     model = User
     template_name = 'login/user_form.html'
@@ -1,15 +1,189 @@
-from login.permissions import cache_clear
+import logging
+import threading
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Q
+
+from emstrack.util import is_on_commit_pending
+from login.permissions import Permissions, cache_clear, get_permissions, warm_up_invalidated
 from environs import Env
 
 env = Env()
+logger = logging.getLogger(__name__)
 
+# scope of the invalidations pending on the current thread
+_pending = threading.local()
 
-def mqtt_cache_clear():
 
-    # call cache_clear locally
-    cache_clear()
+def get_pending_scope():
+    scope = getattr(_pending, 'scope', None)
+    if scope is None or not is_on_commit_pending(scope['flush']):
+        # nothing pending, or left over from a transaction that rolled back;
+        # each scope is flushed by a callback of its own, which is discarded on rollback
+        scope = _pending.scope = {'all': False, 'users': set(), 'groups': set(), 'previous': {},
+                                  'flush': partial(mqtt_cache_clear_flush)}
+    return scope
+
+
+def cache_clear_scope(scope):
+    """
+    Invalidate the local permission cache according to a message scope,
+    either 'all' or a dictionary with lists of 'users' and 'groups' ids.
+    """
+
+    if scope == 'all':
+        cache_clear()
+    else:
+        cache_clear(users=scope.get('users', []), groups=scope.get('groups', []))
+
+
+def mqtt_cache_clear_flush():
+
+    # retrieve and reset pending scope
+    scope = getattr(_pending, 'scope', None)
+    _pending.scope = None
+    if scope is None or not (scope['all'] or scope['users'] or scope['groups']):
+        # already flushed, or nothing invalidated
+        return
+
+    if scope['all']:
+        message_scope = 'all'
+    else:
+        message_scope = {'users': sorted(scope['users']),
+                         'groups': sorted(scope['groups'])}
+
+    # clear locally once more in case entries were rebuilt during the transaction
+    cache_clear_scope(message_scope)
 
     if env.bool("DJANGO_ENABLE_MQTT_PUBLISH", default=True):
         # and signal through mqtt
         from mqtt.publish import SingletonPublishClient
-        SingletonPublishClient().publish_message('cache_clear')
+        SingletonPublishClient().publish_message({'cache_clear': message_scope})
+
+        # republish the profiles of the affected users in the background
+        if scope['all']:
+            republish_profiles_later(previous=scope['previous'])
+        else:
+            republish_profiles_later(scope['users'], scope['groups'], scope['previous'])
+
+    # rebuild invalidated entries in the background
+    warm_up_invalidated()
+
+
+def get_affected_users(users=None, groups=None):
+    from django.contrib.auth.models import User
+
+    return User.objects.filter(Q(id__in=users or ()) | Q(groups__id__in=groups or ())).distinct()
+
+
+def snapshot_permissions(users=None, groups=None):
+    """
+    Record the permissions of the given users and of the members of the given groups before they change
+    in the current transaction, to compare them with their permissions once it commits.
+    Does nothing outside a transaction.
+    """
+
+    if (not users and not groups) or not transaction.get_connection().in_atomic_block:
+        return
+
+    # keep the permissions from before the first change in this transaction
+    scope = get_pending_scope()
+    for user in get_affected_users(users, groups).exclude(id__in=list(scope['previous'])):
+        scope['previous'][user.id] = Permissions(user).get_permission_set()
+
+    # keep the scope until the transaction commits
+    transaction.on_commit(scope['flush'])
+
+
+def republish_profiles(users=None, groups=None, previous=None):
+    """
+    Republish the profiles of the given users and of the members of the given groups, or of every
+    active user if none are given, whose permissions differ from the previous ones, a dictionary of
+    permission sets by user id. Users without previous permissions are always republished.
+    """
+
+    from django.contrib.auth.models import User
+    from mqtt.publish import SingletonPublishClient
+
+    everyone = users is None and groups is None
+    if everyone:
+        users = User.objects.filter(is_active=True)
+    elif not users and not groups:
+        return 0
+    else:
+        users = get_affected_users(users, groups)
+    previous = previous or {}
+
+    client = SingletonPublishClient()
+    count = 0
+    for user in users:
+
+        # skip if permissions did not change; unrestricted profiles list every ambulance and hospital,
+        # which change when everyone is affected
+        if user.id in previous:
+            permissions = get_permissions(user)
+            if previous[user.id] == permissions.get_permission_set() and \
+                    not (everyone and permissions.unrestricted):
+                continue
+
+        client.publish_profile(user, retain=True)
+        count += 1
+
+    logger.debug('Republished {} profiles'.format(count))
+    return count
+
+
+def republish_profiles_later(users=None, groups=None, previous=None):
+    """
+    Republish profiles as in republish_profiles, in the background.
+    """
+
+    def target():
+
+        from django.db import connection
+
+        try:
+            republish_profiles(users, groups, previous)
+        except Exception as e:
+            logger.warning('Could not republish profiles: {}'.format(e))
+        finally:
+            # threads open their own database connection
+            connection.close()
+
+    threading.Thread(target=target, daemon=True).start()
+
+
+def mqtt_cache_clear(users=None, groups=None):
+    """
+    Invalidate the permission cache of the given user and group ids, or of everyone if none are given.
+    The local cache is cleared right away; invalidations are collected and broadcast through mqtt
+    only once, when the current transaction commits.
+    """
+
+    # call cache_clear locally
+    if users is None and groups is None:
+        evicted = cache_clear()
+    else:
+        evicted = cache_clear(users=users, groups=groups)
+
+    # collect scope
+    scope = get_pending_scope()
+    if users is None and groups is None:
+        scope['all'] = True
+    else:
+        scope['users'].update(users or ())
+        scope['groups'].update(groups or ())
+
+        # evicted users are affected even if they no longer belong to the groups
+        scope['users'].update(key for key in evicted if key is not None)
+
+    # keep the permissions from before the first change in this transaction,
+    # unless recorded by snapshot_permissions
+    for (key, permissions) in evicted.items():
+        if key is not None:
+            scope['previous'].setdefault(key, permissions.get_permission_set())
+
+    # flush on commit, or right away if not in a transaction;
+    # only the first callback to run finds a pending scope to flush
+    transaction.on_commit(scope['flush'])
@@ -3,6 +3,8 @@ import logging
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
+from ambulance.geofence import GEOFENCE_ENABLED, GeofenceIndex
+from login.permissions import PERMISSION_WARMUP, warm_up
 from mqtt.subscribe import SubscribeClient
 
 logger = logging.getLogger(__name__)
@@ -27,16 +29,27 @@ class Command(BaseCommand):
         broker.update(settings.MQTT)
         broker['CLIENT_ID'] = broker['CLIENT_ID'] + '_' + str(os.getpid())
 
+        # load geofences before listening to ambulances
+        geofence = None
+        if GEOFENCE_ENABLED:
+            geofence = GeofenceIndex()
+            geofence.reload()
+
         client = SubscribeClient(broker,
                                  stdout=self.stdout,
                                  style=self.style,
-                                 verbosity=options['verbosity'])
+                                 verbosity=options['verbosity'],
+                                 geofence=geofence)
 
         logger.info("* * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *")
         logger.info("* * *                    M Q T T   C L I E N T                    * * *")
         logger.info("* * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *")
         logger.info(datetime.datetime.now())
 
+        if PERMISSION_WARMUP:
+            # precompute permissions of the recently active users
+            warm_up()
+
         try:
             client.loop_forever()
 
@@ -1,3 +1,4 @@
+import json
 import logging
 from io import BytesIO
 
@@ -9,6 +10,7 @@ from rest_framework.parsers import JSONParser
 from rest_framework.renderers import JSONRenderer
 
 from ambulance.models import Ambulance, CallStatus, AmbulanceCallStatus, AmbulanceCall, Waypoint
+from ambulance.geofence import apply_geofence_event
 from ambulance.models import Call
 from ambulance.serializers import AmbulanceSerializer, AmbulanceUpdateSerializer, WaypointSerializer
 from equipment.models import EquipmentItem
@@ -16,7 +18,8 @@ from equipment.serializers import EquipmentItemSerializer
 from hospital.models import Hospital
 from hospital.serializers import HospitalSerializer
 from login.models import Client, ClientLog, ClientStatus, ClientActivity
-from login.permissions import cache_clear
+from login.permissions import cache_clear, warm_up_invalidated
+from .cache_clear import cache_clear_scope
 from .client import BaseClient
 
 logger = logging.getLogger(__name__)
@@ -38,6 +41,14 @@ class ClientException(Exception):
 
 class SubscribeClient(BaseClient):
 
+    def __init__(self, broker, **kwargs):
+
+        # geofence index, if ambulance positions are to be evaluated
+        self.geofence = kwargs.pop('geofence', None)
+
+        # call super
+        super().__init__(broker, **kwargs)
+
     # The callback for when the client receives a CONNACK
     # response from the server.
     def on_connect(self, client, userdata, flags, rc):
@@ -308,6 +319,11 @@ class SubscribeClient(BaseClient):
                     serializer.save(updated_by=user)
                     is_valid = True
 
+            if is_valid and self.geofence is not None and ambulance.location is not None:
+
+                # evaluate position, saved ambulance is current
+                self.on_geofence(user, ambulance)
+
             if not is_valid:
 
                 logger.debug('on_ambulance: INVALID serializer')
@@ -326,6 +342,21 @@ class SubscribeClient(BaseClient):
 
         logger.debug('on_ambulance: DONE')
 
+    # Geofence events
+
+    def on_geofence(self, user, ambulance):
+
+        events = self.geofence.locate(ambulance.id, ambulance.location.x, ambulance.location.y)
+        for (event, fence) in events:
+            try:
+
+                apply_geofence_event(event, fence, ambulance, user)
+
+            except Exception as e:
+
+                logger.warning("on_geofence: could not apply {} of ambulance '{}' at location {}: {}"
+                               .format(event, ambulance.identifier, fence.location_id, e))
+
     # Update hospital
 
     def on_hospital(self, clnt, userdata, msg):
@@ -756,13 +787,32 @@ class SubscribeClient(BaseClient):
 
         try:
 
-            if data == '"cache_clear"':
+            message = json.loads(data)
+
+            if message == 'cache_clear':
 
                 logger.info(" > Clearing cache")
 
                 # call cache clear
                 cache_clear()
 
+            elif isinstance(message, dict) and 'cache_clear' in message:
+
+                logger.info(" > Clearing cache, scope = '{}'".format(message['cache_clear']))
+
+                # call scoped cache clear
+                cache_clear_scope(message['cache_clear'])
+
+                # and rebuild invalidated entries in the background
+                warm_up_invalidated()
+
+            elif isinstance(message, dict) and message.get('geofence') == 'reload':
+
+                logger.info(" > Reloading geofence index")
+
+                if self.geofence is not None:
+                    self.geofence.reload()
+
             else:
 
                 logger.debug("on_message: unknown message '{}'".format(data))
@@ -15,6 +15,7 @@ let map;
 let apiClient;
 const vehicles = {};
 let xAxesMode, detailVehicleId = -1;
+let currentRange;
 
 let movingSpeedThreshold = 5 / 3.6; // (m/s)
 let movingDistanceThreshold = 5;    // m
@@ -217,11 +218,56 @@ function reportDetail(id) {
     // set new detail title
     idElement.text(vehicle['identifier']);
 
+    // history already retrieved?
+    if (Object.entries(vehicle['data']).length !== 0) {
+        showDetail(vehicle);
+        return;
+    }
+
+    // show please wait sign
+    $('#pleaseWaitMessage')
+        .text('Retrieving data...');
+    $('#pleaseWaitVehicle').text(vehicle['identifier']);
+    $('#pleaseWait')
+        .show();
+
+    // retrieve updates
+    const url = `ambulance/${vehicle['id']}/updates/?filter=${currentRange}`;
+    new ReadVehiclePages(vehicle, function() {
+            $('#pleaseWait')
+                .hide();
+            showDetail(vehicle);
+        },
+        apiClient, url)
+        .getPages();
+
+}
+
+// show detail
+function showDetail(vehicle) {
+
+    const data = vehicle['data'];
+
+    // nothing to show?
+    if (Object.entries(data).length === 0) {
+        logger.log('info', "No updates for vehicle '%s'", vehicle['identifier']);
+        return;
+    }
+
+    // calculate speed profile
+    if (!('speed' in data)) {
+        const [, , , , , distance, speed, time]
+            = calculateMotionStatistics(movingSpeedThreshold, movingDistanceThreshold, ...data['segments']);
+        data['distance'] = distance;
+        data['speed'] = speed;
+        data['time'] = time;
+    }
+
     // render detail
     renderDetail(vehicle, xAxesMode);
 
     logger.log('info', "showing...");
-    detailElement.collapse('show');
+    $('#detail').collapse('show');
 
 }
 
@@ -234,41 +280,22 @@ function reportSummary() {
     let noActivities = true;
     for (const vehicle of Object.values(vehicles)) {
 
-        // get history
-        const data = vehicle['data'];
-
-        // nothing to do?
-        if (Object.entries(data).length === 0) {
-            continue;
-        }
+        // statistics calculated by the server
+        const mileage = vehicle['mileage'];
 
         // set no activities to false
         noActivities = false;
 
-        // retrieve segments
-        const segments = data['segments'];
-
-        // calculate statistics
-        let [totalDistance, totalTime, totalMovingDistance, totalMovingTime, maxSpeed, distance, speed, time]
-            = calculateMotionStatistics(movingSpeedThreshold, movingDistanceThreshold, ...segments);
-        let avgSpeed = totalTime > 0 ? totalDistance / totalTime : 0.0;
-        let avgMovingSpeed = totalMovingTime > 0 ? totalMovingDistance / totalMovingTime : 0.0;
-
-        // store distance and speed
-        vehicle['data']['distance'] = distance;
-        vehicle['data']['speed'] = speed;
-        vehicle['data']['time'] = time;
-
         // convert to proper units
-        totalTime /= 3600;             // h
-        totalMovingTime /= 3600;       // h
+        const totalTime = mileage['time'] / 3600;                   // h
+        const totalMovingTime = mileage['moving_time'] / 3600;      // h
 
-        totalDistance /= 1000;         // km
-        totalMovingDistance /= 1000;   // km
+        const totalDistance = mileage['distance'] / 1000;           // km
+        const totalMovingDistance = mileage['moving_distance'] / 1000;   // km
 
-        maxSpeed *= 3.6;               // km/h
-        avgSpeed *= 3.6;               // km/h
-        avgMovingSpeed *= 3.6;         // km/h
+        const maxSpeed = mileage['max_speed'] * 3.6;                // km/h
+        const avgSpeed = mileage['avg_speed'] * 3.6;                // km/h
+        const avgMovingSpeed = mileage['avg_moving_speed'] * 3.6;   // km/h
 
         const element = getOrCreateElement(`vehicle_${vehicle['id']}`, (id) => {
             $('#vehiclesTable> tbody:last-child').append(`<tr id="${id}"></tr>`);
@@ -296,90 +323,6 @@ function reportSummary() {
 
 }
 
-function processVehicleHistory(vehicle, history) {
-
-    logger.log('debug', "Got '%s' updates for vehicle '%s' from API", history.length, vehicle['identifier']);
-
-    if (history.length) {
-
-        // get id
-        const id = vehicle['id'];
-
-        // segment and store
-        const [segments, durations, status, user] = segmentHistory(history);
-        vehicles[id]['data'] = {
-            'history': history,
-            'segments': segments,
-            'durations': durations,
-            'status': status,
-            'user': user
-        };
-
-        // add to map
-        addAmbulanceRoute(map, history, ambulance_status, false);
-
-    }
-
-}
-
-function retrieveVehicleHistory(data, range, index, page_size=1000, page=1, history=[]) {
-
-    // get current vehicle
-    const vehicle = data[index];
-
-    logger.log('debug', 'Retrieving vehicle %s page %d...', vehicle['identifier'], page);
-
-    const url = `ambulance/${vehicle['id']}/updates/?page=${page}&page_size=${page_size}&filter=${range}`;
-    return apiClient.httpClient.get(url)
-        .then( response => {
-
-            // retrieve updates and add to history
-            const pageData = response.data;
-            history = history.concat(pageData.results);
-            const totalPages = Math.ceil(pageData.count / page_size);
-
-            logger.log('debug', 'Processing vehicle %s data, page %d of %d...',
-                vehicle['identifier'], page, totalPages);
-
-            // update message
-            $('#pleaseWaitVehicle').text(`${vehicle['identifier']}, page ${page} of ${totalPages}`);
-
-            logger.log('debug', 'page %d: vehicle %s history has %d records, next=%s',
-                page, vehicle['identifier'], history.length, pageData.next);
-
-            // has next page?
-            if (pageData.next !== null)
-
-                // retrieve next page
-                retrieveVehicleHistory(data, range, index, page_size, page+1, history);
-
-            else {
-
-                try {
-
-                    // process vehicle history
-                    processVehicleHistory(vehicle, history);
-
-                } catch(error) {
-                    console.log(error);
-                }
-
-                // retrieve next vehicle
-                retrieveVehicles(data, range, index + 1);
-
-            }
-
-        })
-        .catch((error) => {
-            logger.log('error', "'Failed to retrieve vehicle %s, page %d, error: %s",
-                vehicle['identifier'], page, error);
-
-            // retrieve next vehicle
-            retrieveVehicles(data, range, index + 1);
-        });
-
-}
-
 class ReadVehiclePages extends ReadPages {
 
     constructor(vehicle, callback, apiClient, url, page_size = 1000) {
@@ -430,54 +373,6 @@ class ReadVehiclePages extends ReadPages {
 
 }
 
-function retrieveVehicles(data, range, index = 0) {
-
-    if (index === data.length) {
-
-        // no more vehicles, produce report
-        logger.log('debug', 'Generating report...');
-
-        // Update please wait message
-        $('#pleaseWaitMessage')
-            .text("Generating report...");
-
-        // report summary
-        reportSummary();
-
-        // enable generate report button
-        $('#submitButton')
-            .prop('disabled', false);
-
-        // hide please wait sign
-        $('#pleaseWait')
-            .hide();
-
-        // and return
-        return
-
-    }
-
-    // get current vehicle
-    const vehicle = data[index];
-
-    logger.log('debug', 'Adding vehicle %s', vehicle['identifier']);
-
-    // save vehicle in global variable vehicles
-    vehicles[vehicle['id']] = vehicle;
-    vehicles[vehicle['id']]['data'] = {};
-
-    $('#pleaseWaitVehicle').text(vehicle['identifier']);
-
-    // retrieve updates
-    const url = `ambulance/${vehicle['id']}/updates/?filter=${range}`;
-    new ReadVehiclePages(vehicle, function() {
-            retrieveVehicles(data, range, index+1)
-        },
-        apiClient, url)
-        .getPages();
-
-}
-
 function retrieveData(range) {
 
     // disable generate report button
@@ -487,26 +382,55 @@ function retrieveData(range) {
     // show retrieving data message
     $('#pleaseWaitMessage')
         .text('Retrieving data...');
+    $('#pleaseWaitVehicle').text('');
 
     // show please wait sign
     $('#pleaseWait')
         .show();
 
-    // clear vehicles table body
+    // clear vehicles table body and detail
     $('#vehiclesTable > tbody')
         .empty();
+    $('#detail').collapse('hide');
+    detailVehicleId = -1;
+
+    // forget previous vehicles
+    currentRange = range;
+    for (const id of Object.keys(vehicles))
+        delete vehicles[id];
 
-    // Retrieve vehicles
-    return apiClient.httpClient.get('ambulance/')
+    // Retrieve mileage, calculated by the server
+    const [start, end] = range.split(',');
+    return apiClient.httpClient.get(`ambulance/mileage/?start=${encodeURIComponent(start)}&end=${encodeURIComponent(end)}`)
         .then(response => {
 
-            // retrieve vehicles
-            logger.log('debug', "Got vehicle data from API");
+            logger.log('debug', "Got mileage data from API");
 
-            // loop through vehicle records
-            retrieveVehicles(response.data, range);
+            // save vehicles in global variable vehicles
+            for (const mileage of response.data) {
+                vehicles[mileage['id']] = {
+                    'id': mileage['id'],
+                    'identifier': mileage['identifier'],
+                    'mileage': mileage,
+                    'data': {}
+                };
+            }
+
+            // report summary
+            reportSummary();
 
         })
+        .finally(() => {
+
+            // enable generate report button
+            $('#submitButton')
+                .prop('disabled', false);
+
+            // hide please wait sign
+            $('#pleaseWait')
+                .hide();
+
+        });
 
 }
 